@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_UPSTREAM = 32  # Upstream requests in flight across all users
+MAX_CONCURRENT_PER_USER = 2   # Upstream requests in flight per user
+# 'background' is server-initiated work (summary refreshes) that no user is waiting on
+TIER_WEIGHTS = {'premium': 3, 'free': 1, 'background': 0.5}
+MAX_QUEUE_WAIT = {'premium': 60, 'free': 20, 'background': 120}  # seconds a request may wait before it is rejected
+QUEUE_POLL_INTERVAL = 1.0
+BUSY_RETRY_AFTER = 10  # seconds suggested to clients whose request timed out in the queue
+BUSY_MESSAGE = 'The server is busy right now. Please try again in a moment.'
+
+
+class AdmissionRejected(Exception):
+    """A request waited longer than MAX_QUEUE_WAIT for an upstream slot."""
+
+    def __init__(self, message: str = BUSY_MESSAGE, retry_after: int = BUSY_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    __slots__ = ('user_key', 'tier', 'start_tag', 'finish_tag', 'enqueued_at', 'admitted_at', 'future', 'released')
+
+    def __init__(self, user_key, tier, start_tag, finish_tag, future):
+        self.user_key = user_key
+        self.tier = tier
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.enqueued_at = time.monotonic()
+        self.admitted_at = None
+        self.future = future
+        self.released = False
+
+    @property
+    def admitted(self):
+        return self.admitted_at is not None
+
+
+class AdmissionController:
+    """
+    Admission control for upstream LLM requests, run on the background event loop.
+
+    Requests beyond the global or per-user cap wait in a weighted fair queue: each
+    ticket gets a virtual finish tag of max(virtual_time, user's last tag) + 1/weight,
+    and the eligible ticket with the smallest tag is admitted first. Premium users get
+    a larger weight, and a user with many tabs only competes with their own requests.
+    All methods except stats() must be called on the background loop.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_UPSTREAM, max_per_user=MAX_CONCURRENT_PER_USER,
+                 weights=None, max_wait=None):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.weights = weights or TIER_WEIGHTS
+        self.max_wait = max_wait or MAX_QUEUE_WAIT
+        self._waiting = []
+        self._active = 0
+        self._active_per_user = {}
+        self._last_finish = {}
+        self._virtual_time = 0.0
+        self._wait_samples = deque(maxlen=1000)
+        self._admitted_total = 0
+        self._rejected_total = 0
+
+    def enqueue(self, user_key, premium=False, background=False) -> Ticket:
+        tier = 'background' if background else 'premium' if premium else 'free'
+        start = max(self._virtual_time, self._last_finish.get(user_key, 0.0))
+        finish = start + 1.0 / self.weights.get(tier, 1)
+        self._last_finish[user_key] = finish
+        ticket = Ticket(user_key, tier, start, finish, asyncio.get_running_loop().create_future())
+        self._waiting.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self):
+        while self._waiting and self._active < self.max_concurrent:
+            eligible = [t for t in self._waiting if self._active_per_user.get(t.user_key, 0) < self.max_per_user]
+            if not eligible:
+                break
+            ticket = min(eligible, key=lambda t: t.finish_tag)
+            self._waiting.remove(ticket)
+            self._admit(ticket)
+
+    def _admit(self, ticket):
+        ticket.admitted_at = time.monotonic()
+        self._active += 1
+        self._active_per_user[ticket.user_key] = self._active_per_user.get(ticket.user_key, 0) + 1
+        self._virtual_time = max(self._virtual_time, ticket.start_tag)
+        self._admitted_total += 1
+        self._wait_samples.append(ticket.admitted_at - ticket.enqueued_at)
+        if not ticket.future.done():
+            ticket.future.set_result(True)
+
+    def position(self, ticket) -> int:
+        """1-based position among waiting requests (0 once admitted)."""
+        if ticket.admitted:
+            return 0
+        return 1 + sum(1 for t in self._waiting if t.finish_tag < ticket.finish_tag)
+
+    def wait_expired(self, ticket) -> bool:
+        return not ticket.admitted and time.monotonic() - ticket.enqueued_at > self.max_wait.get(ticket.tier, 20)
+
+    def reject(self, ticket):
+        self._rejected_total += 1
+        self.release(ticket)
+
+    def release(self, ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted:
+            self._active -= 1
+            remaining = self._active_per_user.get(ticket.user_key, 1) - 1
+            if remaining > 0:
+                self._active_per_user[ticket.user_key] = remaining
+            else:
+                self._active_per_user.pop(ticket.user_key, None)
+        elif ticket in self._waiting:
+            self._waiting.remove(ticket)
+        if not ticket.future.done():
+            ticket.future.cancel()
+        # Forget fairness state for users with nothing in flight or queued
+        if ticket.user_key not in self._active_per_user and not any(t.user_key == ticket.user_key for t in self._waiting):
+            self._last_finish.pop(ticket.user_key, None)
+        self._dispatch()
+
+    async def wait_for_admission(self, ticket, timeout):
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def queue_length(self) -> int:
+        """Requests users are waiting on (background work queueing is not overload)."""
+        return sum(1 for t in self._waiting if t.tier != 'background')
+
+    def stats(self) -> dict:
+        samples = sorted(self._wait_samples)
+        waiting = list(self._waiting)
+
+        def percentile(p):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))], 3) if samples else 0.0
+
+        return {
+            'active': self._active,
+            'queued': len(waiting),
+            'queued_premium': sum(1 for t in waiting if t.tier == 'premium'),
+            'queued_free': sum(1 for t in waiting if t.tier == 'free'),
+            'queued_background': sum(1 for t in waiting if t.tier == 'background'),
+            'admitted_total': self._admitted_total,
+            'rejected_total': self._rejected_total,
+            'wait_p50': percentile(0.5),
+            'wait_p95': percentile(0.95),
+            'wait_max': round(samples[-1], 3) if samples else 0.0
+        }
+
+
+admission_controller = AdmissionController()
@@ -4,11 +4,22 @@ import logging
 import base64
 import re
 import json
+import os
 import threading
 import queue
+import time
 from io import BytesIO
 from PIL import Image
 from config import API_KEY, API_BASE_URL, MODEL_NAME
+from admission import admission_controller, QUEUE_POLL_INTERVAL, AdmissionRejected, BUSY_MESSAGE
+from load_shedding import overload_detector
+import tracing
+import weakref
+from loop_monitor import watch_loop
+from metrics import (
+    UPSTREAM_TTFT_SECONDS, UPSTREAM_TOKENS_PER_SECOND, UPSTREAM_TOKENS,
+    STREAM_QUEUE_DEPTH, IMAGE_PROCESSING_SECONDS, RATE_LIMIT_REJECTIONS
+)
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +27,7 @@ logger = logging.getLogger(__name__)
 _loop = None
 _thread = None
 _session = None
+_loop_pid = None
 _init_lock = threading.Lock()
 
 def start_background_loop(loop):
@@ -23,14 +35,34 @@ def start_background_loop(loop):
     loop.run_forever()
 
 def get_background_loop():
-    global _loop, _thread
+    """Start the loop once per process: a forked worker inherits _loop but not its thread."""
+    global _loop, _thread, _session, _loop_pid
     with _init_lock:
-        if _loop is None:
+        if _loop is None or _loop_pid != os.getpid():
             _loop = asyncio.new_event_loop()
+            # The inherited session belongs to the parent's loop and sockets
+            _session = None
+            _loop_pid = os.getpid()
             _thread = threading.Thread(target=start_background_loop, args=(_loop,), daemon=True)
             _thread.start()
+            # Lag probe, blocked-loop watchdog and per-coroutine time accounting
+            watch_loop(_loop, _thread)
     return _loop
 
+def stop_background_loop(timeout: float = 5.0):
+    """Close the aiohttp session and stop this process's loop (server shutdown)."""
+    global _loop
+    with _init_lock:
+        loop = _loop if _loop_pid == os.getpid() else None
+        _loop = None
+    if loop is None:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(close_session(), loop).result(timeout)
+    except Exception as e:
+        logger.warning(f"Error closing HTTP session on shutdown: {e}")
+    loop.call_soon_threadsafe(loop.stop)
+
 async def get_session():
     global _session
     if _session is None or _session.closed:
@@ -42,15 +74,38 @@ async def close_session():
     if _session and not _session.closed:
         await _session.close()
 
+# Yielded by run_stream_global after `keepalive` seconds without an item. Writing something
+# (an SSE comment) is the only way the WSGI server notices a client that has gone away.
+KEEPALIVE = object()
+KEEPALIVE_INTERVAL = 5
+
+# Seconds a stream may wait for its first token (including response headers), and for each
+# later line; a stalled upstream ends the stream with a 'timeout' error event instead of
+# holding an upstream slot until the total timeout
+FIRST_TOKEN_TIMEOUT = 60
+STREAM_READ_TIMEOUT = 60
+TIMEOUT_MESSAGE = 'The model took too long to respond. Please try again.'
+
+# Queues of the streams currently being consumed, for the queue depth gauge
+_stream_queues = weakref.WeakSet()
+STREAM_QUEUE_DEPTH.set_function(lambda: sum(q.qsize() for q in list(_stream_queues)))
+
 def run_async_global(coro):
     """Run a coroutine on the background loop and return the result synchronously."""
     loop = get_background_loop()
-    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    future = asyncio.run_coroutine_threadsafe(tracing.bind(coro), loop)
     return future.result()
 
-def run_stream_global(async_gen):
-    """Consume an async generator on the background loop and yield items synchronously."""
+def run_stream_global(async_gen, keepalive: float = None):
+    """
+    Consume an async generator on the background loop and yield items synchronously.
+
+    Closing this generator early (the client disconnected) cancels the producer, which
+    stops the upstream request and frees its admission slot. With `keepalive`, KEEPALIVE
+    is yielded whenever that many seconds pass without an item.
+    """
     q = queue.Queue()
+    _stream_queues.add(q)
     loop = get_background_loop()
     
     async def producer():
@@ -62,17 +117,30 @@ def run_stream_global(async_gen):
             logger.error(f"Error in stream producer: {e}")
             q.put(e) # Sentinel for error
 
-    asyncio.run_coroutine_threadsafe(producer(), loop)
+    stream = producer()
+    stream.__qualname__ = getattr(async_gen, '__qualname__', stream.__qualname__)
+    future = asyncio.run_coroutine_threadsafe(tracing.bind(stream), loop)
     
-    while True:
-        item = q.get()
-        if item is None:
-            break
-        if isinstance(item, Exception):
-            # Re-raise exception from the async generator
-            raise item
-        yield item
+    try:
+        while True:
+            try:
+                item = q.get(timeout=keepalive)
+            except queue.Empty:
+                yield KEEPALIVE
+                continue
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                # Re-raise exception from the async generator
+                raise item
+            yield item
+    finally:
+        if not future.done():
+            # Cancellation is thrown into async_gen at its current await, running its cleanup
+            future.cancel()
 
+@tracing.traced('ai.encode_image')
+@IMAGE_PROCESSING_SECONDS.time(operation='encode_for_chat')
 async def encode_image_to_base64(image_data: bytes) -> str:
     try:
         image = Image.open(BytesIO(image_data))
@@ -116,7 +184,13 @@ def prepare_messages(question, model, context, image_data):
     
     return messages
 
-async def _ask_ai_stream_internal(question: str, model: str = MODEL_NAME, context=None, image_data: bytes = None):
+async def _next_line(content, deadline=None):
+    """Read one line, giving up with asyncio.TimeoutError at `deadline` (monotonic) if set."""
+    if deadline is None:
+        return await content.readline()
+    return await asyncio.wait_for(content.readline(), max(0.0, deadline - time.monotonic()))
+
+async def _ask_ai_stream_internal(question: str, model: str = MODEL_NAME, context=None, image_data: bytes = None, max_tokens: int = 10000, web_search: bool = True):
     api_key = API_KEY
     if not api_key:
         yield json.dumps({"type": "error", "text": "Error: API key not found."})
@@ -144,7 +218,7 @@ async def _ask_ai_stream_internal(question: str, model: str = MODEL_NAME, contex
                     break
 
     # Disable web search if an image is provided or a document is present in context
-    web_search_flag = True
+    web_search_flag = web_search
     if image_data:
         web_search_flag = False
     else:
@@ -160,7 +234,7 @@ async def _ask_ai_stream_internal(question: str, model: str = MODEL_NAME, contex
     data = {
         "model": model,
         "messages": messages,
-        "max_tokens": 10000,
+        "max_tokens": max_tokens,
         "temperature": 0.7,
         "web_search": web_search_flag,
         "stream": True,
@@ -173,23 +247,34 @@ async def _ask_ai_stream_internal(question: str, model: str = MODEL_NAME, contex
     }
     
     if model in ["o1-preview-2024-09-12", "o1-mini-2024-09-12"]:
-        data["max_completion_tokens"] = 10000
+        data["max_completion_tokens"] = max_tokens
 
+    request_start_ns = time.time_ns()
+    upstream_status = None
     try:
+        request_start = time.monotonic()
+        first_token_seen = False
+        first_token_at = None
+        token_count = 0
         session = await get_session()
         async with session.post(
             f"{API_BASE_URL}/chat/completions",
             json=data,
             headers=headers,
-            timeout=aiohttp.ClientTimeout(total=300)
+            timeout=aiohttp.ClientTimeout(total=300, sock_read=STREAM_READ_TIMEOUT)
         ) as response:
+            upstream_status = response.status
             if response.status == 200:
                 full_response = ""
                 current_buffer = ""
                 in_think_block = False
                 think_buffer = ""
+                first_token_deadline = request_start + FIRST_TOKEN_TIMEOUT
                 
-                async for line in response.content:
+                while True:
+                    line = await _next_line(response.content, None if first_token_seen else first_token_deadline)
+                    if not line:
+                        break
                     line = line.decode('utf-8').strip()
                     if line.startswith('data: '):
                         data_str = line[6:]
@@ -202,6 +287,13 @@ async def _ask_ai_stream_internal(question: str, model: str = MODEL_NAME, contex
                                 if 'delta' in choice and 'content' in choice['delta']:
                                     content = choice['delta']['content']
                                     if content:
+                                        token_count += 1
+                                        if not first_token_seen:
+                                            first_token_seen = True
+                                            first_token_at = time.monotonic()
+                                            overload_detector.record_ttft(first_token_at - request_start)
+                                            UPSTREAM_TTFT_SECONDS.observe(first_token_at - request_start, model=model)
+                                            tracing.record('ai.first_token', request_start_ns, model=model)
                                         full_response += content
                                         current_buffer += content
                                         
@@ -241,23 +333,65 @@ async def _ask_ai_stream_internal(question: str, model: str = MODEL_NAME, contex
                         except json.JSONDecodeError:
                             continue
                 
+                overload_detector.record_result(True)
+                UPSTREAM_TOKENS.inc(token_count, model=model)
+                generation_time = time.monotonic() - first_token_at if first_token_at else 0
+                if token_count > 1 and generation_time > 0:
+                    UPSTREAM_TOKENS_PER_SECOND.observe((token_count - 1) / generation_time, model=model)
                 if current_buffer:
                     if in_think_block:
                         yield json.dumps({'type': 'thinking', 'text': current_buffer})
                     else:
                         yield json.dumps({'type': 'content', 'text': current_buffer})
             else:
+                overload_detector.record_result(False)
                 error_text = await response.text()
                 logger.error(f"Error from API: {response.status} - {error_text}")
                 yield f"Error: API error ({response.status}). Please try again later."
+    except asyncio.TimeoutError:
+        # No first token by FIRST_TOKEN_TIMEOUT, or a read stalled for STREAM_READ_TIMEOUT
+        overload_detector.record_result(False)
+        logger.warning(f"Upstream stream from {model} timed out ({token_count} tokens received)")
+        yield json.dumps({'type': 'error', 'code': 'timeout', 'text': TIMEOUT_MESSAGE})
     except Exception as e:
+        overload_detector.record_result(False)
         logger.error(f"Error asking AI: {e}")
         yield f"Error: An error occurred with the bot: {str(e)}"
+    finally:
+        tracing.record('ai.upstream', request_start_ns, model=model, status=upstream_status, stream=True)
+
+async def _ask_ai_stream_admitted(question: str, model: str, context, image_data: bytes, user_key: str, premium: bool, max_tokens: int, web_search: bool):
+    """
+    Wait for an upstream slot (yielding 'queued' events with the queue position), then stream.
+    A wait that times out yields a single 'error' event with code 'busy'.
+    """
+    ticket = admission_controller.enqueue(user_key, premium)
+    enqueued_ns = time.time_ns()
+    try:
+        last_position = None
+        while not ticket.admitted:
+            if admission_controller.wait_expired(ticket):
+                admission_controller.reject(ticket)
+                RATE_LIMIT_REJECTIONS.inc(limiter='admission')
+                tracing.record('ai.admission_wait', enqueued_ns, admitted=False)
+                yield json.dumps({'type': 'error', 'code': 'busy', 'text': BUSY_MESSAGE})
+                return
+            position = admission_controller.position(ticket)
+            if position != last_position:
+                yield json.dumps({'type': 'queued', 'position': position})
+                last_position = position
+            await admission_controller.wait_for_admission(ticket, QUEUE_POLL_INTERVAL)
+        tracing.record('ai.admission_wait', enqueued_ns, admitted=True)
+
+        async for item in _ask_ai_stream_internal(question, model, context, image_data, max_tokens, web_search):
+            yield item
+    finally:
+        admission_controller.release(ticket)
 
-def ask_ai_stream(question: str, model: str = MODEL_NAME, context=None, image_data: bytes = None):
-    return run_stream_global(_ask_ai_stream_internal(question, model, context, image_data))
+def ask_ai_stream(question: str, model: str = MODEL_NAME, context=None, image_data: bytes = None, user_key: str = None, premium: bool = False, max_tokens: int = 10000, web_search: bool = True, keepalive: float = None):
+    return run_stream_global(_ask_ai_stream_admitted(question, model, context, image_data, user_key, premium, max_tokens, web_search), keepalive)
 
-async def _ask_ai_internal(question: str, model: str = MODEL_NAME, context=None, image_data: bytes = None) -> str:
+async def _ask_ai_internal(question: str, model: str = MODEL_NAME, context=None, image_data: bytes = None, max_tokens: int = 10000, web_search: bool = True) -> str:
     api_key = API_KEY
     if not api_key:
         return "Error: API key not found."
@@ -282,7 +416,7 @@ async def _ask_ai_internal(question: str, model: str = MODEL_NAME, context=None,
                         })
                     break
 
-    web_search_flag = True
+    web_search_flag = web_search
     if image_data:
         web_search_flag = False
     else:
@@ -298,7 +432,7 @@ async def _ask_ai_internal(question: str, model: str = MODEL_NAME, context=None,
     data = {
         "model": model,
         "messages": messages,
-        "max_tokens": 10000,
+        "max_tokens": max_tokens,
         "temperature": 0.7,
         "web_search": web_search_flag,
         "stream": False,
@@ -311,8 +445,10 @@ async def _ask_ai_internal(question: str, model: str = MODEL_NAME, context=None,
     }
     
     if model in ["o1-preview-2024-09-12", "o1-mini-2024-09-12"]:
-        data["max_completion_tokens"] = 10000
+        data["max_completion_tokens"] = max_tokens
     
+    request_start_ns = time.time_ns()
+    upstream_status = None
     try:
         session = await get_session()
         async with session.post(
@@ -321,6 +457,8 @@ async def _ask_ai_internal(question: str, model: str = MODEL_NAME, context=None,
             headers=headers,
             timeout=aiohttp.ClientTimeout(total=120)
         ) as response:
+            upstream_status = response.status
+            overload_detector.record_result(response.status == 200)
             if response.status == 200:
                 result = await response.json()
                 if result.get("choices") and len(result["choices"]) > 0:
@@ -335,8 +473,29 @@ async def _ask_ai_internal(question: str, model: str = MODEL_NAME, context=None,
                 logger.error(f"Error from API: {response.status} - {error_text}")
                 return f"Error: API error ({response.status}). Please try again later."
     except Exception as e:
+        overload_detector.record_result(False)
         logger.error(f"Error asking AI: {e}")
         return f"Error: An error occurred with the bot: {str(e)}"
+    finally:
+        tracing.record('ai.upstream', request_start_ns, model=model, status=upstream_status, stream=False)
+
+async def _ask_ai_admitted(question: str, model: str, context, image_data: bytes, user_key: str, premium: bool, max_tokens: int, web_search: bool, background: bool) -> str:
+    """Wait for an upstream slot, then ask. Raises AdmissionRejected if the wait times out."""
+    ticket = admission_controller.enqueue(user_key, premium, background)
+    enqueued_ns = time.time_ns()
+    try:
+        while not ticket.admitted:
+            if admission_controller.wait_expired(ticket):
+                admission_controller.reject(ticket)
+                RATE_LIMIT_REJECTIONS.inc(limiter='admission')
+                tracing.record('ai.admission_wait', enqueued_ns, admitted=False)
+                raise AdmissionRejected()
+            await admission_controller.wait_for_admission(ticket, QUEUE_POLL_INTERVAL)
+        tracing.record('ai.admission_wait', enqueued_ns, admitted=True)
+        return await _ask_ai_internal(question, model, context, image_data, max_tokens, web_search)
+    finally:
+        admission_controller.release(ticket)
 
-def ask_ai(question: str, model: str = MODEL_NAME, context=None, image_data: bytes = None) -> str:
-    return run_async_global(_ask_ai_internal(question, model, context, image_data))
\ No newline at end of file
+def ask_ai(question: str, model: str = MODEL_NAME, context=None, image_data: bytes = None, user_key: str = None, premium: bool = False, max_tokens: int = 10000, web_search: bool = True, background: bool = False) -> str:
+    """background=True queues the call in the low-weight background tier; user_key is then its fairness key."""
+    return run_async_global(_ask_ai_admitted(question, model, context, image_data, user_key, premium, max_tokens, web_search, background))
\ No newline at end of file
@@ -1,18 +1,24 @@
 import aiohttp
+import asyncio
 import logging
 import base64
+import time
 from io import BytesIO
 from PIL import Image
 from config import API_KEY, API_BASE_URL
 from ai_client import get_session
+from metrics import IMAGE_PROCESSING_SECONDS
 
 logger = logging.getLogger(__name__)
 
+MAX_BATCH_CONCURRENCY = 4
+
 class AIImageClient:
     def __init__(self):
         self.api_key = API_KEY
         self.base_url = API_BASE_URL
 
+    @IMAGE_PROCESSING_SECONDS.time(operation='encode_for_edit')
     async def encode_image_to_base64(self, image_data: bytes) -> str:
         try:
             image = Image.open(BytesIO(image_data))
@@ -79,6 +85,42 @@ class AIImageClient:
             logger.error(f"Error generating image: {e}")
             return (None, None) if return_url else None
 
+    async def generate_images_batch(self, prompt: str, models, variants: int = 1, max_concurrency: int = MAX_BATCH_CONCURRENCY):
+        """
+        Generate `variants` images for each model concurrently and yield results as they complete.
+
+        Each yielded item is a dict with the model, variant index, image bytes/url and elapsed seconds.
+        """
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        batch_start = time.monotonic()
+
+        async def run_one(model, variant):
+            async with semaphore:
+                start = time.monotonic()
+                image_bytes, image_url = await self.generate_image(prompt, model, return_url=True)
+                return {
+                    'model': model,
+                    'variant': variant,
+                    'image_bytes': image_bytes,
+                    'image_url': image_url,
+                    'elapsed': round(time.monotonic() - start, 3),
+                    'since_start': round(time.monotonic() - batch_start, 3)
+                }
+
+        tasks = [
+            asyncio.ensure_future(run_one(model, variant))
+            for model in models
+            for variant in range(variants)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # Client went away or the consumer stopped early: don't leave requests running
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
     async def edit_image(self, image_data: bytes, prompt: str, model: str = "flux-1-kontext-max") -> bytes:
         base64_image = await self.encode_image_to_base64(image_data)
         if not base64_image:
@@ -6,6 +6,10 @@ from routes.general import general_bp
 from routes.chat import chat_bp
 from routes.image import image_bp
 from routes.upload import upload_bp
+from routes.assets import assets_bp
+from routes.admin import admin_bp
+import tracing
+import metrics
 
 app = Flask(__name__)
 app.secret_key = FLASK_SECRET_KEY
@@ -15,6 +19,11 @@ compress.init_app(app)
 app.config['COMPRESS_MIMETYPES'] = ['text/html', 'text/css', 'text/javascript', 'application/json', 'application/javascript']
 app.config['COMPRESS_LEVEL'] = 6
 app.config['COMPRESS_MIN_SIZE'] = 500
+# Never compress streamed responses: it buffers SSE chunks. Built assets are served precompressed.
+app.config['COMPRESS_STREAMS'] = False
+
+# Reject oversized request bodies while they are being received (uploads are limited to 20MB)
+app.config['MAX_CONTENT_LENGTH'] = 25 * 1024 * 1024
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -37,6 +46,13 @@ app.register_blueprint(general_bp)
 app.register_blueprint(chat_bp)
 app.register_blueprint(image_bp)
 app.register_blueprint(upload_bp)
+app.register_blueprint(assets_bp)
+app.register_blueprint(admin_bp)
+
+# Per-request traces with spans for each phase of a chat turn, viewable at /admin/traces
+tracing.init_app(app)
+# Request latency histograms for /metrics
+metrics.init_app(app)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,54 @@
+import contextvars
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def run_in_background(target, name: str = None) -> threading.Thread:
+    """
+    Run target() in a daemon thread that shutdown can wait for.
+
+    Used for work a request hands off after responding (Firestore saves, summary
+    refreshes). The threads are daemons so a hung write never blocks exit, which is
+    why a graceful shutdown has to drain them explicitly. The caller's context is
+    carried over, so the work shows up in the request's trace.
+    """
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            context.run(target)
+        finally:
+            with _pending_lock:
+                _pending.discard(thread)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    with _pending_lock:
+        _pending.add(thread)
+    thread.start()
+    return thread
+
+
+def pending_count() -> int:
+    with _pending_lock:
+        return len(_pending)
+
+
+def drain(timeout: float) -> bool:
+    """Wait up to `timeout` seconds for background work, including work it starts in turn."""
+    deadline = time.monotonic() + timeout
+    while True:
+        with _pending_lock:
+            pending = next(iter(_pending), None)
+        if pending is None:
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.warning(f"Shutting down with {pending_count()} background task(s) still running")
+            return False
+        pending.join(remaining)
@@ -0,0 +1,71 @@
+"""
+Benchmark streaming (iterparse) vs. python-docx DOCX text extraction.
+
+Usage:
+    python benchmarks/docx_extraction.py path/to/large.docx [repeats]
+    python benchmarks/docx_extraction.py --synthetic [paragraphs] [repeats]
+"""
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+from document_processor import DocumentProcessor
+
+
+def synthetic_docx(paragraphs):
+    """A large document mixing paragraphs and tables, built with python-docx."""
+    doc = Document()
+    for i in range(paragraphs):
+        doc.add_paragraph(f"Paragraph {i}: " + "lorem ipsum dolor sit amet " * 8)
+        if i % 50 == 0:
+            table = doc.add_table(rows=10, cols=4)
+            for r, row in enumerate(table.rows):
+                for c, cell in enumerate(row.cells):
+                    cell.text = f"r{r}c{c} value {i}"
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+def timed(file_data, streaming, repeats):
+    timings = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = DocumentProcessor.extract_text_from_docx(file_data, streaming=streaming)
+        timings.append(time.perf_counter() - start)
+    return result, timings
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    if sys.argv[1] == '--synthetic':
+        paragraphs = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+        repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+        label = f"synthetic ({paragraphs} paragraphs)"
+        file_data = synthetic_docx(paragraphs)
+    else:
+        repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+        label = sys.argv[1]
+        with open(sys.argv[1], 'rb') as f:
+            file_data = f.read()
+
+    docx_result, docx_times = timed(file_data, False, repeats)
+    stream_result, stream_times = timed(file_data, True, repeats)
+
+    print(f"file: {label} ({len(file_data) / 1024:.0f} KB)")
+    print(f"python-docx: best {min(docx_times):.3f}s  mean {sum(docx_times) / repeats:.3f}s")
+    print(f"streaming:   best {min(stream_times):.3f}s  mean {sum(stream_times) / repeats:.3f}s")
+    print(f"speedup:     {min(docx_times) / min(stream_times):.2f}x")
+    # Tables are emitted in document order by the streaming extractor, so compare sizes only
+    print(f"extracted chars: python-docx {len(docx_result[1])}, streaming {len(stream_result[1])}")
+
+
+if __name__ == '__main__':
+    main()
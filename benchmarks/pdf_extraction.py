@@ -0,0 +1,49 @@
+"""
+Benchmark serial vs. process-pool PDF text extraction.
+
+Usage:
+    python benchmarks/pdf_extraction.py path/to/large.pdf [repeats]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_processor import DocumentProcessor, get_pdf_pool
+
+
+def timed(file_data, parallel, repeats):
+    timings = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = DocumentProcessor.extract_text_from_pdf(file_data, parallel=parallel)
+        timings.append(time.perf_counter() - start)
+    return result, timings
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    path = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with open(path, 'rb') as f:
+        file_data = f.read()
+
+    # Warm the pool so worker start-up isn't billed to the first parallel run
+    get_pdf_pool().submit(os.getpid).result()
+
+    serial_result, serial_times = timed(file_data, False, repeats)
+    parallel_result, parallel_times = timed(file_data, True, repeats)
+
+    print(f"file: {path} ({len(file_data) / 1024:.0f} KB), workers: {DocumentProcessor.PDF_WORKERS}")
+    print(f"serial:   best {min(serial_times):.3f}s  mean {sum(serial_times) / repeats:.3f}s")
+    print(f"parallel: best {min(parallel_times):.3f}s  mean {sum(parallel_times) / repeats:.3f}s")
+    print(f"speedup:  {min(serial_times) / min(parallel_times):.2f}x")
+    print(f"identical output: {serial_result == parallel_result}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,561 @@
+"""
+Build fingerprinted, precompressed static assets.
+
+Copies everything under static/ into static/dist/ with a content hash in each file
+name. Relative ES module imports and CSS @import/url() references are rewritten to
+the hashed names, and brotli and gzip variants are written next to text assets.
+
+Bundle mode (the default) then replaces the entry points with minified bundles:
+- css/style.css with its @imports inlined;
+- js/app.js split into the entry itself, a shared core bundle (everything it imports
+  statically, scope-hoisted into one module) and one lazy chunk per dynamic import().
+The modules folded into a bundle are left out of dist/ and the manifest. If the module
+graph can't be hoisted safely (aliased or default imports, clashing top-level names)
+the entry keeps its per-module build and gets modulepreload hints.
+
+manifest.json holds {"assets": logical path -> built path, "preload": entry -> built
+paths to preload}; logical paths are as passed to url_for('static', ...).
+
+Usage:
+    python build_assets.py [--no-bundle]
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:  # brotli variants are skipped; gzip is always produced
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIRNAME = 'dist'
+# Top-level static trees that are not shipped: the build output itself and dev-only pages
+# (bench/ holds the render benchmark and its recorded stream, served from source in dev)
+EXCLUDED_DIRS = {DIST_DIRNAME, 'bench'}
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 10
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.mjs', '.json', '.svg', '.txt', '.html', '.map'}
+JS_ENTRY = 'js/app.js'
+CSS_ENTRY = 'css/style.css'
+
+# Relative specifiers only; bare and absolute URLs are left alone
+_JS_IMPORT = re.compile(r'''((?:\bfrom|\bimport)\s*\(?\s*)(['"])(\.{1,2}/[^'"]+)\2''')
+_CSS_IMPORT = re.compile(r'''(@import\s+)(['"])([^'"]+)\2''')
+_CSS_URL = re.compile(r'''(url\(\s*)(['"]?)([^'")]+)\2(\s*\))''')
+
+
+def _is_relative(ref: str) -> bool:
+    return not re.match(r'^([a-z]+:|/|#|data:)', ref, re.IGNORECASE)
+
+def _resolve(path: str, ref: str) -> str:
+    return posixpath.normpath(posixpath.join(posixpath.dirname(path), ref.split('?')[0].split('#')[0]))
+
+def _references(path: str, text: str):
+    """Logical paths of the local assets a CSS/JS file refers to."""
+    refs = []
+    if path.endswith('.js') or path.endswith('.mjs'):
+        refs = [m.group(3) for m in _JS_IMPORT.finditer(text)]
+    elif path.endswith('.css'):
+        refs = [m.group(3) for m in _CSS_IMPORT.finditer(text)] + [m.group(3) for m in _CSS_URL.finditer(text)]
+    return [_resolve(path, ref) for ref in refs if _is_relative(ref)]
+
+def _rewrite(path: str, text: str, manifest: dict) -> str:
+    base = posixpath.dirname(path)
+
+    def hashed(ref):
+        if not _is_relative(ref):
+            return ref
+        target = _resolve(path, ref)
+        if target not in manifest:
+            return ref
+        rel = posixpath.relpath(manifest[target], base or '.')
+        if ref.startswith('./') and not rel.startswith('.'):
+            rel = './' + rel
+        return rel
+
+    if path.endswith('.js') or path.endswith('.mjs'):
+        return _JS_IMPORT.sub(lambda m: f"{m.group(1)}{m.group(2)}{hashed(m.group(3))}{m.group(2)}", text)
+    if path.endswith('.css'):
+        text = _CSS_IMPORT.sub(lambda m: f"{m.group(1)}{m.group(2)}{hashed(m.group(3))}{m.group(2)}", text)
+        return _CSS_URL.sub(lambda m: f"{m.group(1)}{m.group(2)}{hashed(m.group(3))}{m.group(2)}{m.group(4)}", text)
+    return text
+
+def _hashed_name(path: str, data: bytes) -> str:
+    root, ext = posixpath.splitext(path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+
+def _write_compressed(dist_path: str, data: bytes):
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+        with open(dist_path + '.gz', 'wb') as f:
+            f.write(gz)
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        if len(br) < len(data):
+            with open(dist_path + '.br', 'wb') as f:
+                f.write(br)
+
+def _write_asset(dist_dir: str, built: str, data: bytes):
+    out = os.path.join(dist_dir, built)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'wb') as f:
+        f.write(data)
+    if posixpath.splitext(built)[1] in COMPRESSIBLE_EXTENSIONS:
+        _write_compressed(out, data)
+
+
+# ---------------------------------------------------------------------------
+# Minification (whitespace and comments only; identifiers are never renamed)
+# ---------------------------------------------------------------------------
+
+_REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+_REGEX_KEYWORDS = {'return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete',
+                   'void', 'throw', 'instanceof', 'yield', 'await'}
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch in '_$'
+
+def minify_js(source: str) -> str:
+    """
+    Strip comments, indentation and blank lines from JavaScript. Newlines are kept so
+    automatic semicolon insertion behaves exactly as in the source; strings, template
+    literals and regex literals are copied verbatim.
+    """
+    out = []
+    n = len(source)
+    i = 0
+    last = ''             # last significant character emitted
+    last_word = ''        # last identifier/keyword emitted, for regex detection
+    template_braces = []  # brace depth at each open ${ inside a template literal
+    braces = 0
+    space = False
+    line_start = True
+
+    def emit(text):
+        nonlocal last, space, line_start
+        if space and not line_start and out:
+            prev = out[-1][-1]
+            if (_is_word_char(prev) and _is_word_char(text[0])) or (prev in '+-' and text[0] in '+-'):
+                out.append(' ')
+        space = False
+        line_start = False
+        out.append(text)
+        last = text[-1]
+
+    def newline():
+        nonlocal line_start, space
+        if out and not line_start:
+            out.append('\n')
+        line_start = True
+        space = False
+
+    def scan_template(j):
+        # From inside a template literal to just past its closing ` or an opening ${
+        while j < n:
+            if source[j] == '\\':
+                j += 2
+            elif source[j] == '`':
+                return j + 1, False
+            elif source.startswith('${', j):
+                return j + 2, True
+            else:
+                j += 1
+        raise ValueError("Unterminated template literal")
+
+    while i < n:
+        c = source[i]
+        if c in ' \t\r﻿':
+            space = True
+            i += 1
+        elif c == '\n':
+            newline()
+            i += 1
+        elif source.startswith('//', i):
+            end = source.find('\n', i)
+            i = n if end < 0 else end
+        elif source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            if end < 0:
+                raise ValueError("Unterminated comment")
+            if '\n' in source[i:end]:
+                newline()
+            else:
+                space = True
+            i = end + 2
+        elif c in '\'"':
+            j = i + 1
+            while j < n and source[j] != c:
+                if source[j] == '\n':
+                    raise ValueError("Unterminated string literal")
+                j += 2 if source[j] == '\\' else 1
+            emit(source[i:j + 1])
+            last_word = ''
+            i = j + 1
+        elif c == '`' or (c == '}' and template_braces and template_braces[-1] == braces):
+            if c == '}':
+                template_braces.pop()
+            j, opened = scan_template(i + 1)
+            emit(source[i:j])
+            if opened:
+                template_braces.append(braces)
+            last_word = ''
+            i = j
+        elif c == '/' and (not last or last in _REGEX_PRECEDERS or last_word in _REGEX_KEYWORDS):
+            j = i + 1
+            in_class = False
+            while j < n and (in_class or source[j] != '/'):
+                if source[j] == '\n':
+                    raise ValueError("Unterminated regex literal")
+                if source[j] == '\\':
+                    j += 1
+                elif source[j] == '[':
+                    in_class = True
+                elif source[j] == ']':
+                    in_class = False
+                j += 1
+            j += 1
+            while j < n and source[j].isalpha():
+                j += 1  # flags
+            emit(source[i:j])
+            last_word = ''
+            i = j
+        elif _is_word_char(c):
+            j = i
+            while j < n and _is_word_char(source[j]):
+                j += 1
+            word = source[i:j]
+            emit(word)
+            last_word = word
+            i = j
+        else:
+            if c == '{':
+                braces += 1
+            elif c == '}':
+                braces -= 1
+            emit(c)
+            last_word = ''
+            i += 1
+    return "".join(out).strip() + "\n"
+
+def minify_css(source: str) -> str:
+    """Strip comments and collapse whitespace; strings are copied verbatim."""
+    parts = []
+    n = len(source)
+    i = 0
+    while i < n:
+        if source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+            parts.append(' ')
+        elif source[i] in '\'"':
+            quote = source[i]
+            j = i + 1
+            while j < n and source[j] != quote:
+                j += 2 if source[j] == '\\' else 1
+            parts.append(source[i:j + 1])
+            i = j + 1
+        else:
+            j = i
+            while j < n and source[j] not in '\'"' and not source.startswith('/*', j):
+                j += 1
+            chunk = re.sub(r'\s+', ' ', source[i:j])
+            parts.append(re.sub(r'\s*([{};,])\s*', r'\1', chunk))
+            i = j
+    return "".join(parts).replace(';}', '}').strip() + "\n"
+
+
+# ---------------------------------------------------------------------------
+# Bundling
+# ---------------------------------------------------------------------------
+
+class BundleError(Exception):
+    pass
+
+_STATIC_IMPORT = re.compile(r'''^import\s*(?:(\{[^}]*\})|([^'"\s{][^'"]*?))?\s*(?:from\s*)?(['"])(\.{1,2}/[^'"]+)\3\s*;?[ \t]*$''', re.M)
+_DYNAMIC_IMPORT = re.compile(r'''\bimport\(\s*(['"])(\.{1,2}/[^'"]+)\1\s*\)''')
+_TOP_LEVEL_DECL = re.compile(r'^(?:export\s+)?(?:async\s+)?(?:function\s*\*?|class|const|let|var)\s+([^\s=(]+)', re.M)
+_EXPORT_DECL = re.compile(r'^export\s+(?=(?:async\s+)?function|class|const|let|var)', re.M)
+
+def _static_imports(path: str, text: str):
+    """[(target, [names]), ...] for a module's static imports; raises if it can't be hoisted."""
+    imports = []
+    for m in _STATIC_IMPORT.finditer(text):
+        names_block, other = m.group(1), m.group(2)
+        if other:
+            raise BundleError(f"{path}: default/namespace import '{other.strip()}' can't be hoisted")
+        names = []
+        for name in (names_block or '').strip('{}').split(','):
+            name = name.strip()
+            if not name:
+                continue
+            if ' as ' in name:
+                raise BundleError(f"{path}: aliased import '{name}' can't be hoisted")
+            names.append(name)
+        imports.append((_resolve(path, m.group(4)), names))
+    if re.search(r'^export\s+(default|\{|\*)', text, re.M):
+        raise BundleError(f"{path}: only 'export <declaration>' can be hoisted")
+    return imports
+
+def _static_closure(root: str, texts: dict, stop=frozenset(), strict: bool = True):
+    """Modules statically reachable from root (root included), dependencies first."""
+    order, seen = [], set()
+
+    def visit(path):
+        if path in seen or path in stop:
+            return
+        if path not in texts:
+            if strict:
+                raise BundleError(f"Missing module {path}")
+            return
+        seen.add(path)
+        if strict:
+            deps = [dep for dep, _ in _static_imports(path, texts[path])]
+        else:
+            deps = [_resolve(path, m.group(4)) for m in _STATIC_IMPORT.finditer(texts[path])]
+        for dep in deps:
+            visit(dep)
+        order.append(path)
+
+    visit(root)
+    return order
+
+def _exported_names(text: str):
+    return re.findall(r'^export\s+(?:async\s+)?(?:function\s*\*?|class|const|let|var)\s+([\w$]+)', text, re.M)
+
+def _hoist(paths, texts):
+    """Concatenate modules into one scope. Returns (code, {outside module: names imported})."""
+    declared = {}
+    external = {}
+    members = set(paths)
+    body = []
+    for path in paths:
+        text = texts[path]
+        for name in _TOP_LEVEL_DECL.findall(text):
+            if name[0] in '{[':
+                raise BundleError(f"{path}: destructuring at top level can't be hoisted")
+            if name in declared:
+                raise BundleError(f"'{name}' is declared in both {declared[name]} and {path}")
+            declared[name] = path
+        for dep, names in _static_imports(path, text):
+            if dep not in members:
+                external.setdefault(dep, set()).update(names)
+        body.append(_EXPORT_DECL.sub('', _STATIC_IMPORT.sub('', text)))
+    return "\n".join(body), external
+
+def _import_line(names, built: str, base: str) -> str:
+    return f"import {{ {', '.join(sorted(names))} }} from './{posixpath.relpath(built, base)}';\n"
+
+def _emit_js(dist_dir: str, logical: str, code: str) -> str:
+    data = minify_js(code).encode('utf-8')
+    built = _hashed_name(logical, data)
+    _write_asset(dist_dir, built, data)
+    return built
+
+def bundle_js(dist_dir: str, texts: dict, entry: str = JS_ENTRY):
+    """
+    Split `entry` into entry + core bundle + lazy chunks. Returns (entry built path,
+    [built paths to modulepreload], source modules folded into the bundles).
+
+    The core bundle has no references to the entry or the chunks, so every bundle's
+    hash can be computed from its final content without cycles.
+    """
+    base = posixpath.dirname(entry)
+    stem = posixpath.splitext(posixpath.basename(entry))[0]
+    core_paths = [p for p in _static_closure(entry, texts) if p != entry]
+    core_set = set(core_paths)
+    for path in core_paths:
+        if _DYNAMIC_IMPORT.search(texts[path]):
+            raise BundleError(f"{path}: dynamic import() is only supported in the entry module")
+
+    chunk_roots = []
+    for m in _DYNAMIC_IMPORT.finditer(texts[entry]):
+        target = _resolve(entry, m.group(2))
+        if target in core_set:
+            raise BundleError(f"{entry}: dynamic import of {target}, which is also imported statically")
+        if target not in chunk_roots:
+            chunk_roots.append(target)
+    chunks = {root: _static_closure(root, texts, stop=core_set) for root in chunk_roots}
+    claimed = set()
+    for members in chunks.values():
+        if claimed & set(members):
+            raise BundleError("Lazy chunks share modules")
+        claimed |= set(members)
+
+    # Whatever the entry and chunks import from core becomes the core bundle's exports
+    needed = set()
+    for path in [entry] + [p for members in chunks.values() for p in members]:
+        for dep, names in _static_imports(path, texts[path]):
+            if dep in core_set:
+                needed.update(names)
+
+    core_code, external = _hoist(core_paths, texts)
+    if external:
+        raise BundleError(f"Core bundle imports modules outside itself: {sorted(external)}")
+    if needed:
+        core_code += f"\nexport {{ {', '.join(sorted(needed))} }};\n"
+    core_built = _emit_js(dist_dir, f"{base}/{stem}.core.js", core_code)
+
+    chunk_built = {}
+    for root, members in chunks.items():
+        code, external = _hoist(members, texts)
+        if set(external) - core_set:
+            raise BundleError(f"Chunk {root} imports unknown modules: {sorted(set(external) - core_set)}")
+        names = set().union(*external.values()) if external else set()
+        if names:
+            code = _import_line(names, core_built, base) + code
+        exports = _exported_names(texts[root])
+        if exports:
+            code += f"\nexport {{ {', '.join(sorted(exports))} }};\n"
+        chunk_stem = posixpath.splitext(posixpath.basename(root))[0]
+        chunk_built[root] = _emit_js(dist_dir, f"{base}/{stem}.{chunk_stem}.js", code)
+
+    entry_names = set()
+    for dep, names in _static_imports(entry, texts[entry]):
+        entry_names.update(names)
+    entry_code = _STATIC_IMPORT.sub('', texts[entry])
+    entry_code = _DYNAMIC_IMPORT.sub(
+        lambda m: f"import({m.group(1)}./{posixpath.relpath(chunk_built[_resolve(entry, m.group(2))], base)}{m.group(1)})",
+        entry_code
+    )
+    if entry_names:
+        entry_code = _import_line(entry_names, core_built, base) + entry_code
+    return _emit_js(dist_dir, entry, entry_code), [core_built], [entry] + core_paths + sorted(claimed)
+
+def bundle_css(dist_dir: str, texts: dict, manifest: dict, entry: str = CSS_ENTRY):
+    """
+    Inline the @imports of `entry` recursively, rebasing url() references onto the bundle.
+    Returns (built path, stylesheets folded into the bundle).
+    """
+    base = posixpath.dirname(entry)
+    seen = set()
+
+    def inline(path):
+        if path in seen:
+            return ''
+        seen.add(path)
+
+        def replace_import(m):
+            target = _resolve(path, m.group(2))
+            if target not in texts or m.group(3).strip():
+                return m.group(0)  # remote or media-qualified imports stay as they are
+            return inline(target)
+
+        text = re.sub(r'''@import\s+(['"])([^'"]+)\1([^;]*);''', replace_import, texts[path])
+
+        def rebase(m):
+            if not _is_relative(m.group(3)):
+                return m.group(0)
+            target = _resolve(path, m.group(3))
+            built = manifest.get(target, target)
+            return f"{m.group(1)}{m.group(2)}{posixpath.relpath(built, base)}{m.group(2)}{m.group(4)}"
+
+        return _CSS_URL.sub(rebase, text) + "\n"
+
+    data = minify_css(inline(entry)).encode('utf-8')
+    built = _hashed_name(entry, data)
+    _write_asset(dist_dir, built, data)
+    return built, sorted(seen)
+
+
+# ---------------------------------------------------------------------------
+# Build
+# ---------------------------------------------------------------------------
+
+def _collect(static_dir: str):
+    assets = {}
+    for root, dirs, files in os.walk(static_dir):
+        # Hidden entries (.DS_Store, editor swap files) are never assets
+        dirs[:] = [d for d in dirs if not d.startswith('.') and not (root == static_dir and d in EXCLUDED_DIRS)]
+        for name in files:
+            if name.startswith('.'):
+                continue
+            full = os.path.join(root, name)
+            assets[os.path.relpath(full, static_dir).replace(os.sep, '/')] = full
+    return assets
+
+def build(static_dir: str = STATIC_DIR, bundle: bool = True) -> dict:
+    """Build static/dist and return the manifest."""
+    dist_dir = os.path.join(static_dir, DIST_DIRNAME)
+    assets = _collect(static_dir)
+    sources = {}
+    for path, full in assets.items():
+        if path.endswith(('.js', '.mjs', '.css')):
+            with open(full, 'r', encoding='utf-8-sig') as f:
+                sources[path] = f.read()
+
+    # Dependencies are hashed first so a file's hash covers the names it refers to.
+    # Writing waits until bundling has decided which modules are still served on their own.
+    manifest = {}
+    built_data = {}
+    visiting = set()
+
+    def visit(path):
+        if path in manifest:
+            return
+        if path in visiting:
+            raise ValueError(f"Circular asset reference involving {path}")
+        visiting.add(path)
+        if path in sources:
+            for dep in _references(path, sources[path]):
+                if dep in assets:
+                    visit(dep)
+            data = _rewrite(path, sources[path], manifest).encode('utf-8')
+        else:
+            with open(assets[path], 'rb') as f:
+                data = f.read()
+        manifest[path] = _hashed_name(path, data)
+        built_data[path] = data
+        visiting.discard(path)
+
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    os.makedirs(dist_dir)
+    for path in sorted(assets):
+        visit(path)
+
+    preload = {}
+    bundled = set()
+    if JS_ENTRY in sources:
+        try:
+            if not bundle:
+                raise BundleError("bundling disabled")
+            manifest[JS_ENTRY], preload[JS_ENTRY], modules = bundle_js(dist_dir, sources)
+            bundled.update(modules)
+        except BundleError as e:
+            logger.warning(f"Serving {JS_ENTRY} as separate modules: {e}")
+            # Preload the whole static graph so the browser doesn't discover it level by level
+            graph = _static_closure(JS_ENTRY, sources, strict=False)
+            preload[JS_ENTRY] = [manifest[p] for p in graph if p != JS_ENTRY]
+    if bundle and CSS_ENTRY in sources:
+        manifest[CSS_ENTRY], stylesheets = bundle_css(dist_dir, sources, manifest)
+        bundled.update(stylesheets)
+
+    for path, data in built_data.items():
+        if path in bundled:
+            # Only reachable through its bundle; the entry's manifest entry now names the bundle
+            if path not in (JS_ENTRY, CSS_ENTRY):
+                del manifest[path]
+            continue
+        _write_asset(dist_dir, manifest[path], data)
+
+    result = {'assets': manifest, 'preload': preload}
+    with open(os.path.join(dist_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    return result
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    built = build(bundle='--no-bundle' not in sys.argv[1:])
+    if brotli is None:
+        logger.warning("brotli is not installed; only gzip variants were written")
+    print(f"Built {len(built['assets'])} assets into {os.path.join(STATIC_DIR, DIST_DIRNAME)}")
@@ -0,0 +1,163 @@
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional
+
+from google.cloud import firestore
+
+from background_tasks import run_in_background
+
+logger = logging.getLogger(__name__)
+
+CACHE_INVALIDATIONS_COLLECTION = "cache_invalidations"
+LISTENER_CACHE_TTL = 600  # Safety-net TTL for cached entries while the listener is healthy
+POLLING_CACHE_TTL = 15    # TTL when no listener is running (other workers' writes show up this late)
+LISTENER_LOOKBACK = 60    # Seconds of past invalidations replayed on start, to absorb clock skew
+INVALIDATION_RETENTION = 3600  # Seconds a record is kept; only the last LISTENER_LOOKBACK are ever read
+PRUNE_INTERVAL = 600      # Seconds between prunes of expired records, per worker
+PRUNE_BATCH = 200
+
+
+class CacheInvalidationBus:
+    """
+    Keeps per-worker caches coherent across processes and hosts.
+
+    A write that changes cached state publishes a tiny record to the
+    cache_invalidations collection, one document per (kind, key). Each worker runs a
+    Firestore on_snapshot listener on that collection and calls the handler registered
+    for the kind, skipping records it published itself. Without a listener (no
+    Firestore, or the watch failed) callers fall back to a short cache TTL.
+
+    Records carry an `expire_at` timestamp for a Firestore TTL policy on the
+    collection; publishers also delete expired records themselves now and then, so
+    the collection stays small without one.
+    """
+
+    def __init__(self, client_getter: Callable):
+        self._client_getter = client_getter
+        self._handlers: Dict[str, Callable] = {}
+        self._lock = threading.Lock()
+        self._watch = None
+        self._pid = None
+        self._last_prune = 0.0
+        self.worker_id = None
+
+    def register(self, kind: str, handler: Callable[[str, Optional[dict]], None]):
+        """handler(key, value) is called when another worker publishes for `kind`."""
+        self._handlers[kind] = handler
+
+    @property
+    def listening(self) -> bool:
+        return self._watch is not None and self._pid == os.getpid()
+
+    def cache_ttl(self) -> float:
+        self.ensure_listening()
+        return LISTENER_CACHE_TTL if self.listening else POLLING_CACHE_TTL
+
+    def ensure_listening(self):
+        """Start the listener once per process (forked workers start their own)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._watch = None
+            self.worker_id = f"{os.getpid()}-{secrets.token_hex(4)}"
+            client = self._client_getter()
+            if not client:
+                return
+            try:
+                since = datetime.now(timezone.utc) - timedelta(seconds=LISTENER_LOOKBACK)
+                query = client.collection(CACHE_INVALIDATIONS_COLLECTION).where("updated_at", ">=", since)
+                self._watch = query.on_snapshot(self._on_snapshot)
+                logger.info("Cache invalidation listener started")
+            except Exception as e:
+                logger.error(f"Could not start cache invalidation listener, falling back to TTL: {e}")
+                self._watch = None
+
+    def _on_snapshot(self, snapshot, changes, read_time):
+        for change in changes:
+            if change.type.name == 'REMOVED':
+                continue
+            data = change.document.to_dict() or {}
+            if data.get('worker') == self.worker_id:
+                continue
+            handler = self._handlers.get(data.get('kind'))
+            if handler is None:
+                continue
+            try:
+                handler(data.get('key'), data.get('value'))
+            except Exception as e:
+                logger.error(f"Error applying cache invalidation {data.get('kind')}/{data.get('key')}: {e}")
+
+    def publish(self, kind: str, key: str, value: Optional[dict] = None):
+        """Tell other workers that (kind, key) changed. Runs in a background thread."""
+        self.ensure_listening()
+        client = self._client_getter()
+        if not client:
+            return
+        record = {
+            'kind': kind,
+            'key': str(key),
+            'value': value,
+            'worker': self.worker_id,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+            'expire_at': datetime.now(timezone.utc) + timedelta(seconds=INVALIDATION_RETENTION)
+        }
+        now = time.monotonic()
+        prune = now - self._last_prune >= PRUNE_INTERVAL
+        if prune:
+            self._last_prune = now
+
+        def write():
+            try:
+                client.collection(CACHE_INVALIDATIONS_COLLECTION).document(f"{kind}__{key}").set(record, timeout=5.0)
+            except Exception as e:
+                logger.error(f"Error publishing cache invalidation {kind}/{key}: {e}")
+            if prune:
+                self._prune(client)
+
+        # Tracked so a graceful shutdown waits for the write
+        run_in_background(write, name='cache-invalidation')
+
+    def _prune(self, client):
+        """Delete records past their expire_at (a TTL policy does this too, but lazily)."""
+        try:
+            now = datetime.now(timezone.utc)
+            query = (client.collection(CACHE_INVALIDATIONS_COLLECTION)
+                     .where("expire_at", "<", now).limit(PRUNE_BATCH))
+            removed = 0
+            for doc in query.stream(timeout=10.0):
+                doc.reference.delete(timeout=5.0)
+                removed += 1
+            if removed:
+                logger.debug(f"Pruned {removed} expired cache invalidation records")
+        except Exception as e:
+            logger.error(f"Error pruning cache invalidations: {e}")
+
+
+class TimedCache(dict):
+    """dict that remembers when each key was stored, for TTL checks against the bus."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stored_at = {}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._stored_at[key] = time.monotonic()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._stored_at.pop(key, None)
+
+    def pop(self, key, *default):
+        self._stored_at.pop(key, None)
+        return super().pop(key, *default)
+
+    def fresh(self, key, ttl: float) -> bool:
+        return key in self and time.monotonic() - self._stored_at.get(key, 0) < ttl
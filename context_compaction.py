@@ -0,0 +1,164 @@
+import logging
+import threading
+from typing import List, Dict, Optional, Tuple
+
+from ai_client import ask_ai
+from admission import AdmissionRejected
+from shared_context import estimate_tokens, get_firestore_conversation_state, set_conversation_summary
+from background_tasks import run_in_background
+from tracing import traced
+from usage_quota import record_token_usage
+
+logger = logging.getLogger(__name__)
+
+RECENT_WINDOW_TOKENS = {'premium': 24000, 'free': 8000}  # History kept verbatim after the summary
+COMPACTION_CHUNK_TOKENS = 4000   # Aged-out history needed before the summary is refreshed
+SUMMARY_INPUT_TOKENS = 12000     # Transcript fed to one summarization call
+SUMMARY_MAX_TOKENS = 1200
+SUMMARY_MODEL = 'gpt-4o-mini-search-preview-2025-03-11'
+# Admission fairness key shared by all summary calls: they queue in the background tier and
+# hold at most the per-user cap of upstream slots between them, never the user's own slots
+SUMMARY_FAIRNESS_KEY = 'background:summary'
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Update the existing summary with the new messages below. Keep facts, decisions, names, "
+    "numbers, code identifiers, open questions and the user's preferences; drop pleasantries. "
+    "Write in the conversation's language, as concise bullet points, at most 400 words. "
+    "Reply with the updated summary only.\n\n"
+    "Existing summary:\n{summary}\n\n"
+    "New messages:\n{transcript}"
+)
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _message_text(message: Dict) -> str:
+    content = message.get('content', '')
+    if isinstance(content, list):
+        return "".join(item.get('text', '') for item in content if item.get('type') == 'text')
+    return content or ""
+
+def _stored_tokens(message: Dict) -> int:
+    # Stored counts are approximate for legacy messages, which is fine for picking a window
+    return message.get('token_count') or estimate_tokens(_message_text(message))
+
+def recent_window_start(messages: List[Dict], budget: int) -> int:
+    """Index of the oldest message in the newest run of messages that fits `budget` tokens."""
+    used = 0
+    for idx in range(len(messages) - 1, -1, -1):
+        used += _stored_tokens(messages[idx])
+        if used > budget:
+            return idx + 1
+    return 0
+
+def summary_message(summary: Dict) -> Dict:
+    # Pinned: context limiting keeps it while trimming the oldest messages
+    return {
+        'role': 'system',
+        'pinned': True,
+        'content': (
+            "Summary of the earlier part of this conversation (older messages are not shown):\n\n"
+            f"{summary['text']}"
+        )
+    }
+
+def _valid_summary(messages: List[Dict], summary: Optional[Dict]) -> Optional[Dict]:
+    if summary and summary.get('text') and 0 < summary.get('covers', 0) <= len(messages):
+        return summary
+    return None
+
+def _needs_refresh(messages: List[Dict], covered: int, premium: bool) -> int:
+    """Index up to which history should be summarized, or 0 if not enough has aged out yet."""
+    window_start = recent_window_start(messages, RECENT_WINDOW_TOKENS['premium' if premium else 'free'])
+    if window_start <= covered:
+        return 0
+    aged_out = sum(_stored_tokens(m) for m in messages[covered:window_start])
+    return window_start if aged_out >= COMPACTION_CHUNK_TOKENS else 0
+
+@traced('compaction.compact_context')
+def compact_context(messages: List[Dict], summary: Optional[Dict], premium: bool) -> Tuple[List[Dict], bool]:
+    """
+    Replace history covered by the conversation's rolling summary with the summary itself.
+
+    Returns (context, needs_refresh). Messages not yet summarized stay verbatim, so nothing
+    is lost while a refresh is pending; needs_refresh is True once enough history has aged
+    out of the recent window to be worth folding into the summary.
+    """
+    if not messages:
+        return messages, False
+    summary = _valid_summary(messages, summary)
+    covered = summary['covers'] if summary else 0
+    needs_refresh = bool(_needs_refresh(messages, covered, premium))
+    if not summary:
+        return messages, needs_refresh
+    return [summary_message(summary)] + messages[covered:], needs_refresh
+
+def _transcript(messages: List[Dict]) -> str:
+    lines = []
+    for message in messages:
+        # Document injections are not conversation; their content is re-retrievable
+        if message.get('role') not in ('user', 'assistant'):
+            continue
+        lines.append(f"{message['role'].upper()}: {_message_text(message).strip()}")
+    return "\n\n".join(lines)
+
+@traced('compaction.refresh_summary')
+def refresh_summary(user_key: str, conversation_id: str, premium: bool):
+    """Fold history that has aged out of the recent window into the stored summary."""
+    messages, summary = get_firestore_conversation_state(user_key, conversation_id)
+    summary = _valid_summary(messages, summary)
+    covered = summary['covers'] if summary else 0
+    upto = _needs_refresh(messages, covered, premium)
+    if not upto:
+        return
+    text = summary['text'] if summary else "(none yet)"
+
+    # Fold the aged-out range in bounded batches so one call never sees a huge transcript
+    while covered < upto:
+        batch_end = covered
+        used = 0
+        while batch_end < upto and (batch_end == covered or used + _stored_tokens(messages[batch_end]) <= SUMMARY_INPUT_TOKENS):
+            used += _stored_tokens(messages[batch_end])
+            batch_end += 1
+        transcript = _transcript(messages[covered:batch_end])
+        if transcript:
+            prompt = SUMMARY_PROMPT.format(summary=text, transcript=transcript)
+            try:
+                result = ask_ai(
+                    prompt, SUMMARY_MODEL, user_key=SUMMARY_FAIRNESS_KEY,
+                    max_tokens=SUMMARY_MAX_TOKENS, web_search=False, background=True
+                )
+            except AdmissionRejected:
+                # Busy: the next turn that needs a refresh schedules it again
+                logger.info(f"Summary refresh for conversation {conversation_id} skipped, upstream busy")
+                return
+            # The user's conversation is what gets summarized, so they are charged for it
+            record_token_usage(user_key, estimate_tokens(prompt) + estimate_tokens(result or ""))
+            if not result or result.startswith("Error:"):
+                logger.warning(f"Summary refresh failed for conversation {conversation_id}: {result}")
+                return
+            text = result.strip()
+        covered = batch_end
+        set_conversation_summary(user_key, conversation_id, text, covered)
+    logger.debug(f"Summary for conversation {conversation_id} now covers {covered} messages")
+
+def schedule_summary_refresh(user_key: str, conversation_id: str, premium: bool):
+    """Refresh the summary in a background thread; at most one refresh per conversation at a time."""
+    key = f"{user_key}__{conversation_id}"
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        try:
+            refresh_summary(user_key, conversation_id, premium)
+        except Exception as e:
+            logger.error(f"Error refreshing summary for conversation {conversation_id}: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    run_in_background(run, name='summary-refresh')
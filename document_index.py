@@ -0,0 +1,211 @@
+import math
+import re
+import threading
+import logging
+from collections import OrderedDict, Counter
+from typing import List, Dict, Optional
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+CHUNK_TARGET_CHARS = 1200  # Paragraphs are packed into chunks of roughly this size
+DOCUMENT_TOP_K = 6
+DOCUMENT_CONTEXT_TOKENS = 6000  # Budget for retrieved excerpts injected per turn
+INDEX_CACHE_SIZE = 64
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_PAGE_MARKER = re.compile(r'^--- Page (\d+) ---$')
+# CJK characters are indexed one per token; everything else by word
+_TOKEN_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]|\w+', re.UNICODE)
+
+_encoding = None
+
+def get_encoding():
+    """The cl100k_base encoder, loaded once per process."""
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    try:
+        return len(get_encoding().encode(text))
+    except Exception as e:
+        logger.error(f"Error encoding tokens: {e}")
+        return len(text) // 4
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Longest prefix of `text` that fits in max_tokens."""
+    if max_tokens <= 0 or not text:
+        return ""
+    try:
+        encoding = get_encoding()
+        tokens = encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:max_tokens])
+    except Exception as e:
+        logger.error(f"Error encoding tokens: {e}")
+        return text[:max_tokens * 4]
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+def _split_line(line: str, limit: int = CHUNK_TARGET_CHARS) -> List[str]:
+    """Pieces of `line` of at most `limit` characters, cut at a space where there is one."""
+    pieces = []
+    while len(line) > limit:
+        cut = line.rfind(' ', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        pieces.append(line[:cut].rstrip())
+        line = line[cut:].lstrip()
+    pieces.append(line)
+    return pieces
+
+def chunk_document(text: str) -> List[Dict]:
+    """
+    Split extracted document text into page/paragraph-aware chunks.
+
+    Paragraphs are packed into chunks of about CHUNK_TARGET_CHARS without crossing a
+    page boundary; a single oversized paragraph is split on line breaks, and a line
+    longer than CHUNK_TARGET_CHARS (a DOCX paragraph, a PDF page without breaks) at
+    word boundaries.
+    """
+    chunks = []
+    page = None
+    parts = []
+    size = 0
+
+    def flush():
+        nonlocal parts, size
+        body = "\n".join(parts).strip()
+        if body:
+            chunks.append({'id': len(chunks), 'page': page, 'text': body, 'tokens': count_tokens(body)})
+        parts, size = [], 0
+
+    for paragraph in re.split(r'\n\s*\n', text):
+        lines = paragraph.split('\n')
+        for line in lines:
+            marker = _PAGE_MARKER.match(line.strip())
+            if marker:
+                flush()
+                page = int(marker.group(1))
+                continue
+            for piece in _split_line(line):
+                if size + len(piece) > CHUNK_TARGET_CHARS and parts:
+                    flush()
+                parts.append(piece)
+                size += len(piece) + 1
+        # Prefer to end chunks at paragraph boundaries once they are reasonably full
+        if size > CHUNK_TARGET_CHARS // 2:
+            flush()
+        elif parts:
+            parts.append("")
+    flush()
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 over document chunks with an in-memory inverted index."""
+
+    def __init__(self, chunks: List[Dict]):
+        self.chunks = chunks
+        self.postings = {}
+        self.doc_lengths = []
+        for idx, chunk in enumerate(chunks):
+            terms = Counter(tokenize(chunk['text']))
+            self.doc_lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self.postings.setdefault(term, []).append((idx, tf))
+        count = len(chunks)
+        self.avg_length = (sum(self.doc_lengths) / count) if count else 0.0
+        self.idf = {
+            term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+    def search(self, query: str, k: int = DOCUMENT_TOP_K) -> List[int]:
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for idx, tf in self.postings[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[idx] / (self.avg_length or 1))
+                scores[idx] = scores.get(idx, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores, key=lambda i: scores[i], reverse=True)
+        return ranked[:k]
+
+
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+def get_index(cache_key: str, chunks: List[Dict]) -> BM25Index:
+    """Return the BM25 index for a document, building it once per process."""
+    with _index_cache_lock:
+        index = _index_cache.get(cache_key)
+        if index is not None:
+            _index_cache.move_to_end(cache_key)
+            return index
+    index = BM25Index(chunks)
+    with _index_cache_lock:
+        _index_cache[cache_key] = index
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+def select_chunks(index: BM25Index, query: str, token_budget: int = DOCUMENT_CONTEXT_TOKENS, top_k: int = DOCUMENT_TOP_K) -> List[Dict]:
+    """
+    Pick the top-k chunks for the query that fit the token budget, returned in document
+    order. Queries with no matching terms ("summarize this") get the start of the document.
+    """
+    ranked = index.search(query, top_k)
+    in_order = not ranked
+    if in_order:
+        ranked = range(len(index.chunks))
+    selected = []
+    used = 0
+    for idx in ranked:
+        chunk = index.chunks[idx]
+        if used + chunk['tokens'] > token_budget:
+            if in_order:
+                break
+            continue
+        selected.append(chunk)
+        used += chunk['tokens']
+        if len(selected) >= top_k:
+            break
+    return sorted(selected, key=lambda c: c['id'])
+
+def build_document_excerpt(document: Dict, query: str, cache_key: str, token_budget: Optional[int] = None,
+                           return_tokens: bool = False):
+    """
+    System message text with the chunks of an uploaded document most relevant to `query`.
+
+    With return_tokens=True, returns (text, tokens) where tokens is summed from the
+    chunks' stored counts plus the framing, so the excerpt is never re-tokenized.
+    """
+    chunks = document.get('chunks')
+    if not chunks:
+        return (None, 0) if return_tokens else None
+    index = get_index(cache_key, chunks)
+    selected = select_chunks(index, query, token_budget or DOCUMENT_CONTEXT_TOKENS)
+    headings = [f"[Page {c['page']}]\n" if c.get('page') else "" for c in selected]
+    excerpts = "\n\n".join(heading + c['text'] for heading, c in zip(headings, selected))
+    header = (
+        f"The user has uploaded a document named '{document['filename']}' "
+        f"(type: {document['file_type']}). Below are the excerpts most relevant to the current question "
+        f"({len(selected)} of {len(chunks)} sections). Use them to answer; if they don't contain the answer, say so.\n\n"
+        f"--- DOCUMENT CONTENT START ---\n"
+    )
+    footer = "\n--- DOCUMENT CONTENT END ---"
+    text = header + excerpts + footer
+    if not return_tokens:
+        return text
+    tokens = sum(c['tokens'] for c in selected) + count_tokens(header + "".join(headings) + footer) + 2 * len(selected)
+    return text, tokens
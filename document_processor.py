@@ -1,155 +1,450 @@
 import io
 import os
+import mmap
 import logging
-from typing import Tuple, Optional
+import tempfile
+import time
+import zipfile
+import threading
+import multiprocessing
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, Optional, List, Iterable, Dict, Callable
 import pypdf
 from docx import Document
+from document_index import chunk_document, count_tokens, truncate_to_tokens
+from extraction_cache import ExtractionCache, file_digest, page_offsets
+from metrics import DOCUMENT_EXTRACTION_SECONDS
 
 logger = logging.getLogger(__name__)
 
+_W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_P, _W_T, _W_TAB, _W_BR, _W_CR = _W_NS + 'p', _W_NS + 't', _W_NS + 'tab', _W_NS + 'br', _W_NS + 'cr'
+_W_TBL, _W_TR, _W_TC, _W_BODY = _W_NS + 'tbl', _W_NS + 'tr', _W_NS + 'tc', _W_NS + 'body'
+
+class _TokenBudget:
+    """Accumulates extracted text block by block, counting tokens as it goes, until max_tokens is spent."""
+    
+    TRUNCATION_NOTE = "\n\n[Document truncated - maximum length reached]"
+    
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self.truncated = False
+        self._buf = io.StringIO()
+    
+    def write(self, text: str) -> bool:
+        """Append a block, cutting it to fit the budget. Returns False once the budget is spent."""
+        tokens = count_tokens(text)
+        remaining = self.max_tokens - self.tokens
+        if tokens > remaining:
+            text = truncate_to_tokens(text, remaining) + self.TRUNCATION_NOTE
+            tokens = remaining + count_tokens(self.TRUNCATION_NOTE)
+            self.truncated = True
+        self._buf.write(text)
+        self.tokens += tokens
+        return not self.truncated
+    
+    def getvalue(self) -> str:
+        return self._buf.getvalue()
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """Lazily create the process pool used for parallel PDF extraction."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn: forking a process that owns gRPC/asyncio threads is unsafe
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=DocumentProcessor.PDF_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+    return _pdf_pool
+
+def _extract_pdf_page_range(path: str, start: int, end: int) -> List[Tuple[int, Optional[str]]]:
+    """Worker: reopen the PDF from `path`, memory-mapped, and extract pages [start, end)."""
+    results = []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        reader = pypdf.PdfReader(mapped)
+        for page_num in range(start, end):
+            try:
+                results.append((page_num, reader.pages[page_num].extract_text()))
+            except Exception as e:
+                logger.warning(f"Error extracting text from page {page_num + 1}: {e}")
+                results.append((page_num, None))
+    return results
+
 class DocumentProcessor:
     """Utility class for processing PDF and Word documents"""
     
     MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
-    MAX_TEXT_LENGTH = 100000  # Limit extracted text to prevent token overflow
+    # Extracted text is cut at this many tokens (cl100k_base) per tier
+    MAX_TEXT_TOKENS = {'premium': 40000, 'free': 15000}
+    MAX_PDF_PAGES = 100  # Limit to first 100 pages to prevent excessive processing
+    PARALLEL_PDF_EXTRACTION = True
+    PARALLEL_PDF_MIN_PAGES = 16  # Below this the process hand-off costs more than it saves
+    PDF_PAGES_PER_SHARD = 8
+    PDF_WORKERS = min(4, os.cpu_count() or 1)
+    STREAMING_DOCX_EXTRACTION = True  # Parse document.xml directly; python-docx is the fallback
+    # Bump whenever extraction or chunking output changes so cached results are invalidated
+    EXTRACTOR_VERSION = "3"
+    
+    @staticmethod
+    def text_token_budget(premium: bool = True) -> int:
+        return DocumentProcessor.MAX_TEXT_TOKENS['premium' if premium else 'free']
+    
+    @staticmethod
+    def _as_stream(file_data):
+        """Wrap raw bytes in BytesIO; file-backed sources (e.g. a memory-mapped upload) are used in place."""
+        if hasattr(file_data, 'read') and hasattr(file_data, 'seek'):
+            file_data.seek(0)
+            return file_data
+        return io.BytesIO(file_data)
+    
+    @staticmethod
+    def _iter_pdf_pages(pdf_reader, page_count: int) -> Iterable[Tuple[int, Optional[str]]]:
+        for page_num in range(page_count):
+            try:
+                yield page_num, pdf_reader.pages[page_num].extract_text()
+            except Exception as e:
+                logger.warning(f"Error extracting text from page {page_num + 1}: {e}")
+                yield page_num, None
+    
+    @staticmethod
+    def _merge_pdf_pages(pages: Iterable[Tuple[int, Optional[str]]], page_count: int = None,
+                         progress: Optional[Callable[[int, Optional[int]], None]] = None,
+                         max_tokens: Optional[int] = None) -> Tuple[str, int]:
+        """Join (page_num, text) pairs in page order, stopping at the token budget. Returns (text, tokens)."""
+        budget = _TokenBudget(max_tokens or DocumentProcessor.text_token_budget())
+        for page_num, page_text in pages:
+            if progress:
+                progress(page_num + 1, page_count)
+            if page_text:
+                # Stop if we've extracted enough text
+                if not budget.write(f"\n--- Page {page_num + 1} ---\n{page_text}"):
+                    break
+        return budget.getvalue(), budget.tokens
+    
+    @staticmethod
+    def _extract_pdf_pages_parallel(file_data: bytes, page_count: int, progress=None,
+                                    max_tokens: Optional[int] = None) -> Tuple[str, int]:
+        """
+        Extract pages in shards across the process pool. Workers reopen the PDF by path:
+        the spooled upload's own path when it has one, otherwise a temp copy. Shards are
+        consumed in page order so output and truncation match the serial path, and
+        shards past the limit are cancelled.
+        """
+        path = getattr(file_data, 'path', None)
+        tmp = None
+        if not path:
+            tmp = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+            with tmp:
+                tmp.write(file_data)
+            path = tmp.name
+        try:
+            pool = get_pdf_pool()
+            step = DocumentProcessor.PDF_PAGES_PER_SHARD
+            futures = [
+                pool.submit(_extract_pdf_page_range, path, start, min(start + step, page_count))
+                for start in range(0, page_count, step)
+            ]
+            
+            def ordered_pages():
+                for future in futures:
+                    yield from future.result()
+            
+            try:
+                return DocumentProcessor._merge_pdf_pages(ordered_pages(), page_count, progress, max_tokens)
+            finally:
+                for future in futures:
+                    future.cancel()
+        finally:
+            if tmp is not None:
+                try:
+                    os.unlink(tmp.name)
+                except OSError:
+                    pass
     
     @staticmethod
-    def extract_text_from_pdf(file_data: bytes) -> Tuple[bool, str]:
+    def extract_text_from_pdf(file_data: bytes, parallel: Optional[bool] = None, progress=None,
+                              max_tokens: Optional[int] = None) -> Tuple[bool, str, int]:
         """
         Extract text from PDF file data
         
         Args:
-            file_data: Raw PDF file bytes
+            file_data: Raw PDF file bytes or a memory-mapped file
+            parallel: Shard pages across the process pool (defaults to PARALLEL_PDF_EXTRACTION)
+            progress: Optional callback(pages_done, pages_total) called as pages are merged
+            max_tokens: Token budget for the extracted text (defaults to the premium budget)
             
         Returns:
-            Tuple of (success: bool, text: str or error_message: str)
+            Tuple of (success: bool, text: str or error_message: str, token_count: int)
         """
+        if parallel is None:
+            parallel = DocumentProcessor.PARALLEL_PDF_EXTRACTION
         try:
-            pdf_file = io.BytesIO(file_data)
+            pdf_file = DocumentProcessor._as_stream(file_data)
             pdf_reader = pypdf.PdfReader(pdf_file)
             
             if len(pdf_reader.pages) == 0:
-                return False, "PDF file appears to be empty or corrupted"
+                return False, "PDF file appears to be empty or corrupted", 0
             
-            buf = io.StringIO()
-            max_pages = 100  # Limit to first 100 pages to prevent excessive processing
-            truncated = False
+            max_pages = DocumentProcessor.MAX_PDF_PAGES
+            page_count = min(len(pdf_reader.pages), max_pages)
             
-            for page_num, page in enumerate(pdf_reader.pages[:max_pages]):
-                try:
-                    page_text = page.extract_text()
-                    if page_text:
-                        buf.write(f"\n--- Page {page_num + 1} ---\n")
-                        buf.write(page_text)
-                        
-                        # Stop if we've extracted enough text
-                        if buf.tell() > DocumentProcessor.MAX_TEXT_LENGTH:
-                            truncated = True
-                            break
-                            
-                except Exception as e:
-                    logger.warning(f"Error extracting text from page {page_num + 1}: {e}")
-                    continue
-            
-            text_content = buf.getvalue()
-            if truncated:
-                text_content = text_content[:DocumentProcessor.MAX_TEXT_LENGTH]
-                text_content += "\n\n[Document truncated - maximum text length reached]"
+            if parallel and page_count >= DocumentProcessor.PARALLEL_PDF_MIN_PAGES:
+                text_content, token_count = DocumentProcessor._extract_pdf_pages_parallel(
+                    file_data, page_count, progress, max_tokens
+                )
+            else:
+                text_content, token_count = DocumentProcessor._merge_pdf_pages(
+                    DocumentProcessor._iter_pdf_pages(pdf_reader, page_count), page_count, progress, max_tokens
+                )
             
             if not text_content.strip():
-                return False, "No readable text found in PDF. The PDF might contain only images or be password-protected."
+                return False, "No readable text found in PDF. The PDF might contain only images or be password-protected.", 0
             
-            return True, text_content.strip()
+            return True, text_content.strip(), token_count
             
         except Exception as e:
             logger.error(f"Error processing PDF: {e}")
-            return False, f"Failed to process PDF file: {str(e)}"
+            return False, f"Failed to process PDF file: {str(e)}", 0
+    
+    @staticmethod
+    def _paragraph_text(paragraph) -> str:
+        """Text of a <w:p> element: runs, tabs and line breaks (deleted revisions are skipped)."""
+        parts = []
+        for node in paragraph.iter():
+            if node.tag == _W_T:
+                parts.append(node.text or "")
+            elif node.tag == _W_TAB:
+                parts.append("\t")
+            elif node.tag in (_W_BR, _W_CR):
+                parts.append("\n")
+        return "".join(parts)
+    
+    @staticmethod
+    def _iter_docx_blocks(file_data) -> Iterable[str]:
+        """
+        Stream word/document.xml and yield text lines in document order: body paragraphs,
+        a "--- Table ---" header per table, and one " | "-joined line per table row.
+        
+        Parsing is incremental, so a consumer that stops early never decompresses or
+        parses the rest of the document.
+        """
+        with zipfile.ZipFile(DocumentProcessor._as_stream(file_data)) as archive:
+            with archive.open('word/document.xml') as xml_stream:
+                body = None
+                table_depth = 0
+                cells = []
+                cell_parts = []
+                for event, elem in ET.iterparse(xml_stream, events=('start', 'end')):
+                    tag = elem.tag
+                    if event == 'start':
+                        if tag == _W_BODY:
+                            body = elem
+                        elif tag == _W_TBL:
+                            table_depth += 1
+                            if table_depth == 1:
+                                yield "\n--- Table ---"
+                        continue
+                    
+                    if tag == _W_P:
+                        text = DocumentProcessor._paragraph_text(elem)
+                        if table_depth:
+                            cell_parts.append(text)
+                        elif text.strip():
+                            yield text
+                        elem.clear()
+                    elif tag == _W_TC and table_depth == 1:
+                        cells.append("\n".join(cell_parts).strip())
+                        cell_parts = []
+                    elif tag == _W_TR and table_depth == 1:
+                        row_text = [cell for cell in cells if cell]
+                        cells = []
+                        if row_text:
+                            yield " | ".join(row_text)
+                        elem.clear()
+                    elif tag == _W_TBL:
+                        table_depth -= 1
+                    
+                    # Drop finished top-level blocks so memory stays flat on large documents
+                    if body is not None and table_depth == 0 and tag in (_W_P, _W_TBL):
+                        body.clear()
+    
+    @staticmethod
+    def _extract_docx_streaming(file_data, max_tokens: int) -> Tuple[str, int]:
+        budget = _TokenBudget(max_tokens)
+        blocks = DocumentProcessor._iter_docx_blocks(file_data)
+        try:
+            for line in blocks:
+                if not budget.write(line + "\n"):
+                    break
+        finally:
+            blocks.close()
+        return budget.getvalue(), budget.tokens
+    
+    @staticmethod
+    def _extract_docx_python_docx(file_data, max_tokens: int) -> Tuple[str, int]:
+        docx_file = DocumentProcessor._as_stream(file_data)
+        doc = Document(docx_file)
+        budget = _TokenBudget(max_tokens)
+        
+        # Extract text from paragraphs
+        for paragraph in doc.paragraphs:
+            if paragraph.text.strip():
+                if not budget.write(paragraph.text + "\n"):
+                    break
+        
+        # Extract text from tables if not too much text already
+        if not budget.truncated:
+            for table in doc.tables:
+                if not budget.write("\n--- Table ---\n"):
+                    break
+                for row in table.rows:
+                    row_text = [
+                        cell.text.strip()
+                        for cell in row.cells
+                        if cell.text.strip()
+                    ]
+                    if row_text and not budget.write(" | ".join(row_text) + "\n"):
+                        break
+                if budget.truncated:
+                    break
+        
+        return budget.getvalue(), budget.tokens
     
     @staticmethod
-    def extract_text_from_docx(file_data: bytes) -> Tuple[bool, str]:
+    def extract_text_from_docx(file_data: bytes, streaming: Optional[bool] = None,
+                               max_tokens: Optional[int] = None) -> Tuple[bool, str, int]:
         """
         Extract text from Word document file data
         
         Args:
-            file_data: Raw DOCX file bytes
+            file_data: Raw DOCX file bytes or a memory-mapped file
+            streaming: Use the iterparse extractor (defaults to STREAMING_DOCX_EXTRACTION);
+                python-docx is used if it is disabled or fails
+            max_tokens: Token budget for the extracted text (defaults to the premium budget)
             
         Returns:
-            Tuple of (success: bool, text: str or error_message: str)
+            Tuple of (success: bool, text: str or error_message: str, token_count: int)
         """
+        if streaming is None:
+            streaming = DocumentProcessor.STREAMING_DOCX_EXTRACTION
+        max_tokens = max_tokens or DocumentProcessor.text_token_budget()
         try:
-            docx_file = io.BytesIO(file_data)
-            doc = Document(docx_file)
-            
-            buf = io.StringIO()
-            truncated = False
-            
-            # Extract text from paragraphs
-            for paragraph in doc.paragraphs:
-                if paragraph.text.strip():
-                    buf.write(paragraph.text + "\n")
-                    if buf.tell() > DocumentProcessor.MAX_TEXT_LENGTH:
-                        truncated = True
-                        break
-            
-            # Extract text from tables if not too much text already
-            if not truncated:
-                for table in doc.tables:
-                    buf.write("\n--- Table ---\n")
-                    for row in table.rows:
-                        row_text = [
-                            cell.text.strip()
-                            for cell in row.cells
-                            if cell.text.strip()
-                        ]
-                        if row_text:
-                            buf.write(" | ".join(row_text) + "\n")
-                        if buf.tell() > DocumentProcessor.MAX_TEXT_LENGTH:
-                            truncated = True
-                            break
-                    if truncated:
-                        break
-            
-            text_content = buf.getvalue()
-            if truncated:
-                text_content = text_content[:DocumentProcessor.MAX_TEXT_LENGTH]
-                text_content += "\n\n[Document truncated - maximum text length reached]"
+            result = None
+            if streaming:
+                try:
+                    result = DocumentProcessor._extract_docx_streaming(file_data, max_tokens)
+                except Exception as e:
+                    logger.warning(f"Streaming DOCX extraction failed, falling back to python-docx: {e}")
+            if result is None:
+                result = DocumentProcessor._extract_docx_python_docx(file_data, max_tokens)
+            text_content, token_count = result
             
             if not text_content.strip():
-                return False, "No readable text found in Word document."
+                return False, "No readable text found in Word document.", 0
             
-            return True, text_content.strip()
+            return True, text_content.strip(), token_count
             
         except Exception as e:
             logger.error(f"Error processing Word document: {e}")
-            return False, f"Failed to process Word document: {str(e)}"
+            return False, f"Failed to process Word document: {str(e)}", 0
     
     @staticmethod
-    def process_document(file_data: bytes, filename: str) -> Tuple[bool, str, Optional[str]]:
+    def process_document(file_data: bytes, filename: str, progress=None,
+                         max_tokens: Optional[int] = None) -> Tuple[bool, str, Optional[str], int]:
         """
         Process document based on file extension
         
         Args:
-            file_data: Raw file bytes
+            file_data: Raw file bytes or a memory-mapped file
             filename: Original filename with extension
+            progress: Optional callback(pages_done, pages_total) for PDF extraction
+            max_tokens: Token budget for the extracted text (defaults to the premium budget)
             
         Returns:
-            Tuple of (success: bool, content: str, file_type: str or None)
+            Tuple of (success: bool, content: str, file_type: str or None, token_count: int)
         """
         if len(file_data) > DocumentProcessor.MAX_FILE_SIZE:
-            return False, "File size too large. Please upload a document smaller than 20MB.", None
+            return False, "File size too large. Please upload a document smaller than 20MB.", None, 0
         
         file_extension = os.path.splitext(filename.lower())[1]
         
+        start = time.perf_counter()
         if file_extension == '.pdf':
-            success, content = DocumentProcessor.extract_text_from_pdf(file_data)
-            return success, content, 'pdf'
+            success, content, token_count = DocumentProcessor.extract_text_from_pdf(
+                file_data, progress=progress, max_tokens=max_tokens
+            )
+            DOCUMENT_EXTRACTION_SECONDS.observe(time.perf_counter() - start, file_type='pdf', success=str(success).lower())
+            return success, content, 'pdf', token_count
         elif file_extension in ['.docx', '.doc']:
             if file_extension == '.doc':
-                return False, "Please convert .doc files to .docx format. Only .docx files are supported.", None
-            success, content = DocumentProcessor.extract_text_from_docx(file_data)
-            return success, content, 'docx'
+                return False, "Please convert .doc files to .docx format. Only .docx files are supported.", None, 0
+            success, content, token_count = DocumentProcessor.extract_text_from_docx(file_data, max_tokens=max_tokens)
+            DOCUMENT_EXTRACTION_SECONDS.observe(time.perf_counter() - start, file_type='docx', success=str(success).lower())
+            return success, content, 'docx', token_count
         else:
-            return False, f"Unsupported file type: {file_extension}. Only PDF (.pdf) and Word (.docx) documents are supported.", None
+            return False, f"Unsupported file type: {file_extension}. Only PDF (.pdf) and Word (.docx) documents are supported.", None, 0
+    
+    @staticmethod
+    def build_document_index(content: str) -> List[dict]:
+        """
+        Split extracted text into page/paragraph-aware chunks for retrieval
+        
+        Args:
+            content: Text returned by process_document
+            
+        Returns:
+            List of chunk dicts (id, page, text, tokens); the BM25 index is built from these
+        """
+        try:
+            return chunk_document(content)
+        except Exception as e:
+            logger.error(f"Error chunking document: {e}")
+            return []
+    
+    @staticmethod
+    def process_and_index(file_data: bytes, filename: str, progress=None,
+                          premium: bool = True) -> Tuple[bool, str, Optional[str], Dict]:
+        """
+        Process and chunk a document, reusing cached results for previously seen files
+        
+        Args:
+            file_data: Raw file bytes or a memory-mapped file
+            filename: Original filename with extension
+            progress: Optional callback(pages_done, pages_total) for PDF extraction
+            premium: Selects the tier's extraction token budget
+            
+        Returns:
+            Tuple of (success: bool, content: str, file_type: str or None, metadata: dict with
+            chunks, page_offsets, token_count and cached)
+        """
+        file_extension = os.path.splitext(filename.lower())[1]
+        tier = 'premium' if premium else 'free'
+        cache_key = f"{file_digest(file_data)}-{tier}{file_extension}"
+        entry = extraction_cache.get(cache_key)
+        if entry is not None:
+            metadata = {k: entry[k] for k in ('chunks', 'page_offsets', 'token_count')}
+            return True, entry['content'], entry['file_type'], dict(metadata, cached=True)
+        
+        success, content, file_type, token_count = DocumentProcessor.process_document(
+            file_data, filename, progress, DocumentProcessor.text_token_budget(premium)
+        )
+        if not success:
+            return success, content, file_type, {}
+        
+        chunks = DocumentProcessor.build_document_index(content)
+        metadata = {
+            'chunks': chunks,
+            'page_offsets': page_offsets(content),
+            'token_count': token_count
+        }
+        extraction_cache.put(cache_key, dict(metadata, content=content, file_type=file_type))
+        return True, content, file_type, dict(metadata, cached=False)
     
     @staticmethod
     def validate_document_file(filename: str, file_size: int) -> Tuple[bool, str]:
@@ -179,3 +474,6 @@ class DocumentProcessor:
             return False, "Please convert .doc files to .docx format. Only .docx files are supported."
         
         return True, ""
+
+
+extraction_cache = ExtractionCache(DocumentProcessor.EXTRACTOR_VERSION)
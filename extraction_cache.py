@@ -0,0 +1,115 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict
+
+logger = logging.getLogger(__name__)
+
+EXTRACTION_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.extraction_cache')
+EXTRACTION_CACHE_MAX_ENTRIES = 500
+EXTRACTION_CACHE_MAX_BYTES = 512 * 1024 * 1024
+MEMORY_CACHE_ENTRIES = 16
+
+_PAGE_MARKER = re.compile(r'^--- Page (\d+) ---$', re.MULTILINE)
+
+
+def file_digest(file_data) -> str:
+    """SHA-256 of raw bytes or a memory-mapped file."""
+    return hashlib.sha256(file_data).hexdigest()
+
+
+def page_offsets(content: str):
+    """[[page_number, char_offset], ...] for the page markers in extracted PDF text."""
+    return [[int(m.group(1)), m.start()] for m in _PAGE_MARKER.finditer(content)]
+
+
+class ExtractionCache:
+    """
+    Content-addressed cache of document extraction results.
+
+    Entries are JSON files named by the upload's SHA-256 and file type, with a small
+    in-memory LRU in front. Disk entries are evicted least-recently-used (by mtime,
+    refreshed on every hit) when the entry or byte limit is exceeded. Each entry
+    records the extractor version it was produced with; entries from other versions
+    are treated as misses.
+    """
+
+    def __init__(self, version: str, cache_dir: str = EXTRACTION_CACHE_DIR,
+                 max_entries: int = EXTRACTION_CACHE_MAX_ENTRIES, max_bytes: int = EXTRACTION_CACHE_MAX_BYTES):
+        self.version = version
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)  # LRU: mark as recently used
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Unreadable extraction cache entry {key}: {e}")
+            return None
+
+        if entry.get('version') != self.version:
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key: str, entry: Dict):
+        entry = dict(entry, version=self.version)
+        self._remember(key, entry)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+            self._evict()
+        except Exception as e:
+            logger.error(f"Error writing extraction cache entry {key}: {e}")
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > MEMORY_CACHE_ENTRIES:
+                self._memory.popitem(last=False)
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        while entries and (len(entries) > self.max_entries or total > self.max_bytes):
+            _, size, name = entries.pop(0)
+            total -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,276 @@
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable
+
+from document_processor import DocumentProcessor
+from shared_context import set_user_document
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_JOBS = 2      # Documents parsed at the same time per process
+MAX_PENDING_JOBS = 16        # Running + queued jobs before uploads are refused
+FINISHED_JOB_TTL = 600       # Seconds finished jobs stay queryable
+DOCUMENT_WAIT_SECONDS = 3.0  # How long a chat turn waits for a running ingestion
+JOB_DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ingestion_jobs.db')
+PROGRESS_WRITE_INTERVAL = 0.5  # Seconds between progress writes to the shared job table
+STALE_JOB_SECONDS = 300      # Unfinished jobs not updated for this long belong to a dead worker
+JOB_POLL_INTERVAL = 0.25     # Seconds between shared-table checks while waiting on another worker's job
+
+
+class IngestionJob:
+    def __init__(self, user_key: str, filename: str, premium: bool = True):
+        self.job_id = secrets.token_urlsafe(16)
+        self.user_key = user_key
+        self.filename = filename
+        self.premium = premium
+        self.status = 'queued'
+        self.pages_done = 0
+        self.pages_total = None
+        self.file_type = None
+        self.error = None
+        self.cached = False
+        self.created_at = time.time()
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'filename': self.filename,
+            'file_type': self.file_type,
+            'pages_done': self.pages_done,
+            'pages_total': self.pages_total,
+            'cached': self.cached,
+            'error': self.error
+        }
+
+
+class JobStore:
+    """
+    Job status in a SQLite table shared by every worker on the host, so status polls
+    and chat turns served by another worker see jobs this worker is running.
+    """
+
+    def __init__(self, db_path: str = JOB_DB_FILE):
+        self.db_path = db_path
+        self._local = threading.local()
+        self.available = self._init_db()
+
+    def _init_db(self) -> bool:
+        try:
+            conn = self._connection()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ingestion_jobs ("
+                "job_id TEXT PRIMARY KEY, user_key TEXT NOT NULL, status TEXT NOT NULL, filename TEXT, "
+                "file_type TEXT, pages_done INTEGER NOT NULL, pages_total INTEGER, cached INTEGER NOT NULL, "
+                "error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ingestion_jobs_user ON ingestion_jobs(user_key, created_at)")
+            return True
+        except Exception as e:
+            logger.error(f"Ingestion job database unavailable, job status is per-process: {e}")
+            return False
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=1.0, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def save(self, job: 'IngestionJob'):
+        if not self.available:
+            return
+        try:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO ingestion_jobs (job_id, user_key, status, filename, file_type, pages_done, "
+                "pages_total, cached, error, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.job_id, job.user_key, job.status, job.filename, job.file_type, job.pages_done,
+                 job.pages_total, int(job.cached), job.error, job.created_at, time.time())
+            )
+        except Exception as e:
+            logger.error(f"Error saving ingestion job {job.job_id}: {e}")
+
+    def get(self, job_id: str) -> Optional[dict]:
+        if not self.available:
+            return None
+        try:
+            row = self._connection().execute(
+                "SELECT job_id, user_key, status, filename, file_type, pages_done, pages_total, cached, error, "
+                "updated_at FROM ingestion_jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        except Exception as e:
+            logger.error(f"Error reading ingestion job {job_id}: {e}")
+            return None
+        if row is None:
+            return None
+        job_id, user_key, status, filename, file_type, pages_done, pages_total, cached, error, updated_at = row
+        return {
+            'job_id': job_id,
+            'user_key': user_key,
+            'status': status,
+            'filename': filename,
+            'file_type': file_type,
+            'pages_done': pages_done,
+            'pages_total': pages_total,
+            'cached': bool(cached),
+            'error': error,
+            'updated_at': updated_at
+        }
+
+    def latest_unfinished(self, user_key: str) -> Optional[str]:
+        """Job id of the user's latest upload if it is still queued or running on a live worker."""
+        if not self.available:
+            return None
+        try:
+            row = self._connection().execute(
+                "SELECT job_id, status, updated_at FROM ingestion_jobs WHERE user_key = ? "
+                "ORDER BY created_at DESC LIMIT 1", (user_key,)
+            ).fetchone()
+        except Exception as e:
+            logger.error(f"Error reading ingestion jobs for {user_key}: {e}")
+            return None
+        if row is None or row[1] in ('done', 'error') or time.time() - row[2] > STALE_JOB_SECONDS:
+            return None
+        return row[0]
+
+    def prune(self):
+        if not self.available:
+            return
+        now = time.time()
+        try:
+            self._connection().execute(
+                "DELETE FROM ingestion_jobs WHERE (status IN ('done', 'error') AND updated_at < ?) OR updated_at < ?",
+                (now - FINISHED_JOB_TTL, now - STALE_JOB_SECONDS - FINISHED_JOB_TTL)
+            )
+        except Exception as e:
+            logger.error(f"Error pruning ingestion jobs: {e}")
+
+
+class IngestionManager:
+    """
+    Runs document extraction, chunking and the Firestore write in a bounded worker pool
+    so /upload_document can return a job id immediately.
+
+    Jobs run in the worker that accepted the upload, which mirrors their status into
+    the shared JobStore so any worker can answer status queries and wait for them.
+    """
+
+    def __init__(self, max_workers: int = MAX_CONCURRENT_JOBS, max_pending: int = MAX_PENDING_JOBS,
+                 store: Optional[JobStore] = None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        self._max_pending = max_pending
+        self._store = store or JobStore()
+        self._jobs = {}
+        self._latest_by_user = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_key: str, file_data, filename: str, premium: bool = True,
+               cleanup: Optional[Callable] = None) -> Optional[IngestionJob]:
+        """Queue a document for ingestion. Returns None when too many jobs are pending."""
+        job = IngestionJob(user_key, filename, premium)
+        with self._lock:
+            self._prune()
+            pending = sum(1 for j in self._jobs.values() if not j.done.is_set())
+            if pending >= self._max_pending:
+                return None
+            self._jobs[job.job_id] = job
+            self._latest_by_user[user_key] = job
+        self._store.prune()
+        self._store.save(job)
+        self._executor.submit(self._run, job, file_data, cleanup)
+        return job
+
+    def _run(self, job: IngestionJob, file_data, cleanup):
+        job.status = 'running'
+        self._store.save(job)
+        last_write = time.monotonic()
+
+        def progress(pages_done, pages_total):
+            nonlocal last_write
+            job.pages_done = pages_done
+            job.pages_total = pages_total
+            now = time.monotonic()
+            if now - last_write >= PROGRESS_WRITE_INTERVAL:
+                last_write = now
+                self._store.save(job)
+
+        try:
+            success, content, file_type, metadata = DocumentProcessor.process_and_index(
+                file_data, job.filename, progress, job.premium
+            )
+            if not success:
+                job.status, job.error = 'error', content
+                return
+            job.file_type = file_type
+            job.cached = metadata.get('cached', False)
+            set_user_document(job.user_key, content, job.filename, file_type, metadata['chunks'],
+                              job_id=job.job_id, token_count=metadata['token_count'])
+            job.status = 'done'
+        except Exception as e:
+            logger.error(f"Error ingesting document {job.filename}: {e}", exc_info=True)
+            job.status, job.error = 'error', f'Error: {str(e)}'
+        finally:
+            if cleanup:
+                try:
+                    cleanup(file_data)
+                except Exception:
+                    pass
+            job.finished_at = time.time()
+            self._store.save(job)
+            job.done.set()
+
+    def _prune(self):
+        cutoff = time.time() - FINISHED_JOB_TTL
+        for job_id in [k for k, j in self._jobs.items() if j.finished_at and j.finished_at < cutoff]:
+            job = self._jobs.pop(job_id)
+            if self._latest_by_user.get(job.user_key) is job:
+                del self._latest_by_user[job.user_key]
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id: str) -> Optional[dict]:
+        """Status of a job run by any worker (with its user_key), or None if unknown."""
+        job = self.get(job_id)
+        if job is not None:
+            return dict(job.to_dict(), user_key=job.user_key)
+        return self._store.get(job_id)
+
+    @property
+    def shared(self) -> bool:
+        """Whether job status is visible to every worker."""
+        return self._store.available
+
+    def wait_for_user(self, user_key: str, timeout: float = DOCUMENT_WAIT_SECONDS) -> bool:
+        """
+        Wait up to `timeout` for the user's latest ingestion to finish, whichever
+        worker runs it. Returns False if it is still running afterwards.
+        """
+        with self._lock:
+            job = self._latest_by_user.get(user_key)
+        if job is not None and not job.done.is_set():
+            return job.done.wait(timeout)
+        # A newer upload may be running on another worker
+        job_id = self._store.latest_unfinished(user_key)
+        if job_id is None:
+            return True
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(JOB_POLL_INTERVAL)
+            status = self._store.get(job_id)
+            if status is None or status['status'] in ('done', 'error'):
+                return True
+        return False
+
+
+ingestion_manager = IngestionManager()
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import NamedTuple, Optional
+from admission import admission_controller
+
+logger = logging.getLogger(__name__)
+
+SIGNAL_WINDOW = 60  # seconds of upstream observations considered
+MIN_ERROR_SAMPLES = 10
+STATE_HOLD = 30  # seconds an elevated state is kept after its last trigger
+
+# Thresholds: (degraded, shedding)
+TTFT_THRESHOLDS = (8.0, 20.0)         # median time-to-first-token, seconds
+ERROR_RATE_THRESHOLDS = (0.2, 0.5)    # fraction of failed upstream calls
+QUEUE_DEPTH_THRESHOLDS = (8, 32)      # requests waiting for an upstream slot
+
+# Degradations applied to free-tier traffic while degraded
+DEGRADED_CONTEXT_TOKENS = 8000
+DEGRADED_MAX_TOKENS = 2000
+DEGRADED_WEB_SEARCH = False
+# Model free-tier requests are switched to while degraded. None keeps the requested model:
+# the default free model is already the cheapest, so there is nothing cheaper to fall back to
+DEGRADED_FREE_MODEL = None
+SHED_RETRY_AFTER = 30
+
+NORMAL = 'normal'
+DEGRADED = 'degraded'
+SHEDDING = 'shedding'
+_LEVELS = {NORMAL: 0, DEGRADED: 1, SHEDDING: 2}
+
+
+class Degradation(NamedTuple):
+    max_context_tokens: Optional[int]
+    max_tokens: int
+    web_search: bool
+    model: Optional[str]
+
+
+NO_DEGRADATION = Degradation(None, 10000, True, None)
+
+
+class OverloadDetector:
+    """
+    Tracks upstream health (TTFT, error rate) and queue depth over a sliding time window
+    and maps it to a load state. Elevated states are held for STATE_HOLD seconds so the
+    mode doesn't flap between requests.
+    """
+
+    def __init__(self, queue_length_fn=None):
+        self._lock = threading.Lock()
+        self._ttfts = deque()
+        self._results = deque()
+        self._queue_length_fn = queue_length_fn
+        self._held_state = NORMAL
+        self._held_until = 0.0
+
+    def _prune(self, now):
+        cutoff = now - SIGNAL_WINDOW
+        while self._ttfts and self._ttfts[0][0] < cutoff:
+            self._ttfts.popleft()
+        while self._results and self._results[0][0] < cutoff:
+            self._results.popleft()
+
+    def record_ttft(self, seconds: float):
+        now = time.monotonic()
+        with self._lock:
+            self._ttfts.append((now, seconds))
+            self._prune(now)
+
+    def record_result(self, ok: bool):
+        now = time.monotonic()
+        with self._lock:
+            self._results.append((now, ok))
+            self._prune(now)
+
+    def signals(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            ttfts = sorted(v for _, v in self._ttfts)
+            results = [ok for _, ok in self._results]
+        queue_length = self._queue_length_fn() if self._queue_length_fn else 0
+        return {
+            'ttft_median': ttfts[len(ttfts) // 2] if ttfts else 0.0,
+            'error_rate': (results.count(False) / len(results)) if len(results) >= MIN_ERROR_SAMPLES else 0.0,
+            'queue_length': queue_length
+        }
+
+    def state(self) -> str:
+        signals = self.signals()
+
+        def level(value, thresholds):
+            if value >= thresholds[1]:
+                return SHEDDING
+            if value >= thresholds[0]:
+                return DEGRADED
+            return NORMAL
+
+        observed = max(
+            level(signals['ttft_median'], TTFT_THRESHOLDS),
+            level(signals['error_rate'], ERROR_RATE_THRESHOLDS),
+            level(signals['queue_length'], QUEUE_DEPTH_THRESHOLDS),
+            key=_LEVELS.get
+        )
+        now = time.monotonic()
+        with self._lock:
+            if _LEVELS[observed] >= _LEVELS[self._held_state] and observed != NORMAL:
+                if observed != self._held_state:
+                    logger.warning(f"Upstream load state -> {observed} ({signals})")
+                self._held_state, self._held_until = observed, now + STATE_HOLD
+            elif now >= self._held_until and self._held_state != observed:
+                logger.info(f"Upstream load state -> {observed}")
+                self._held_state = observed
+            return self._held_state
+
+    def degradation_for(self, premium: bool) -> Optional[Degradation]:
+        """
+        Degradation to apply to a request, NO_DEGRADATION when none applies, or None
+        when the request should be shed with a 503. Premium traffic is never degraded.
+        """
+        if premium:
+            return NO_DEGRADATION
+        state = self.state()
+        if state == SHEDDING:
+            return None
+        if state == DEGRADED:
+            return Degradation(DEGRADED_CONTEXT_TOKENS, DEGRADED_MAX_TOKENS, DEGRADED_WEB_SEARCH, DEGRADED_FREE_MODEL)
+        return NO_DEGRADATION
+
+    def snapshot(self) -> dict:
+        return {'state': self.state(), **self.signals()}
+
+
+overload_detector = OverloadDetector(admission_controller.queue_length)
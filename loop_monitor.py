@@ -0,0 +1,147 @@
+import asyncio
+import collections.abc
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+import config
+from metrics import (
+    BACKGROUND_LOOP_LAG, LOOP_LAG_SECONDS, LOOP_STALLS, LOOP_BUSY_SECONDS, LOOP_SLOW_STEPS
+)
+
+logger = logging.getLogger(__name__)
+
+LOOP_PROBE_INTERVAL = getattr(config, 'LOOP_PROBE_INTERVAL', 0.25)  # seconds between lag probes
+# A callback or coroutine step running longer than this blocks every stream on the loop
+LOOP_SLOW_CALLBACK_THRESHOLD = getattr(config, 'LOOP_SLOW_CALLBACK_THRESHOLD', 0.1)
+# asyncio debug mode adds its own slow-callback log and coroutine origin tracking, at a cost
+LOOP_DEBUG = getattr(config, 'LOOP_DEBUG', False)
+LAG_WINDOW = 15.0  # seconds of probes the lag gauge reports the maximum of
+WATCHDOG_INTERVAL = 0.05  # seconds between watchdog checks
+STALL_LOG_INTERVAL = 10.0  # at most one stack dump per this many seconds
+
+
+class LoopMonitor:
+    """
+    Health checks for the background asyncio loop that runs every upstream call.
+
+    - A probe coroutine sleeps LOOP_PROBE_INTERVAL and records how late it wakes up.
+    - A watchdog thread notices when the probe stops beating, i.e. the loop thread is
+      stuck in one callback, and logs that thread's stack while it is still blocked.
+    - A task factory wraps each coroutine to add up the time its steps run on the loop.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, thread: threading.Thread):
+        self.loop = loop
+        self.thread = thread
+        self.running = None  # name of the coroutine whose step is executing, if any
+        self._last_beat = time.monotonic()
+        self._recent = deque()  # (monotonic time, lag)
+        self._last_stack_log = 0.0
+
+    def start(self):
+        self.loop.slow_callback_duration = LOOP_SLOW_CALLBACK_THRESHOLD
+        if LOOP_DEBUG:
+            self.loop.call_soon_threadsafe(self.loop.set_debug, True)
+        self.loop.set_task_factory(self._task_factory)
+        asyncio.run_coroutine_threadsafe(self._probe(), self.loop)
+        threading.Thread(target=self._watchdog, name='loop-watchdog', daemon=True).start()
+
+    def _task_factory(self, loop, coro, **kwargs):
+        name = getattr(coro, '__qualname__', type(coro).__name__)
+        return asyncio.Task(_AccountedCoroutine(coro, name, self), loop=loop, **kwargs)
+
+    async def _probe(self):
+        while True:
+            scheduled = time.monotonic()
+            self._last_beat = scheduled
+            await asyncio.sleep(LOOP_PROBE_INTERVAL)
+            now = time.monotonic()
+            lag = max(0.0, now - scheduled - LOOP_PROBE_INTERVAL)
+            LOOP_LAG_SECONDS.observe(lag)
+            self._recent.append((now, lag))
+            while self._recent and self._recent[0][0] < now - LAG_WINDOW:
+                self._recent.popleft()
+
+    def recent_lag(self) -> float:
+        """Highest lag over the last LAG_WINDOW seconds, including a stall in progress."""
+        stalled = time.monotonic() - self._last_beat - LOOP_PROBE_INTERVAL
+        return max([lag for _, lag in list(self._recent)] + [stalled, 0.0])
+
+    def _watchdog(self):
+        stalled_since = None
+        while self.thread.is_alive():
+            time.sleep(WATCHDOG_INTERVAL)
+            overdue = time.monotonic() - self._last_beat - LOOP_PROBE_INTERVAL
+            if overdue > LOOP_SLOW_CALLBACK_THRESHOLD:
+                if stalled_since is None:
+                    stalled_since = self._last_beat + LOOP_PROBE_INTERVAL
+                    LOOP_STALLS.inc()
+                    self._log_stall(overdue)
+            elif stalled_since is not None:
+                logger.warning(f"Background loop was blocked for {(time.monotonic() - stalled_since) * 1000:.0f} ms")
+                stalled_since = None
+
+    def _log_stall(self, overdue: float):
+        now = time.monotonic()
+        if now - self._last_stack_log < STALL_LOG_INTERVAL:
+            return
+        self._last_stack_log = now
+        frame = sys._current_frames().get(self.thread.ident)
+        stack = ''.join(traceback.format_stack(frame)) if frame else '(no stack)'
+        logger.warning(
+            f"Background loop blocked for over {overdue * 1000:.0f} ms"
+            f"{f' in {self.running}' if self.running else ''}; every stream is stalled. Loop thread stack:\n{stack}"
+        )
+
+
+class _AccountedCoroutine(collections.abc.Coroutine):
+    """Coroutine wrapper timing each step (the code between two awaits) on the loop thread."""
+    __slots__ = ('_coro', '_name', '_monitor')
+
+    def __init__(self, coro, name: str, monitor: LoopMonitor):
+        self._coro = coro
+        self._name = name
+        self._monitor = monitor
+
+    def _step(self, method, *args):
+        monitor = self._monitor
+        monitor.running = self._name
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            monitor.running = None
+            LOOP_BUSY_SECONDS.inc(elapsed, coroutine=self._name)
+            if elapsed > LOOP_SLOW_CALLBACK_THRESHOLD:
+                LOOP_SLOW_STEPS.inc(coroutine=self._name)
+
+    def send(self, value):
+        return self._step(self._coro.send, value)
+
+    def throw(self, *args):
+        return self._step(self._coro.throw, *args)
+
+    def close(self):
+        return self._coro.close()
+
+    def __await__(self):
+        return self._coro.__await__()
+
+
+_monitor: Optional[LoopMonitor] = None
+
+
+def watch_loop(loop: asyncio.AbstractEventLoop, thread: threading.Thread):
+    """Start monitoring a newly started background loop (once per process)."""
+    global _monitor
+    _monitor = LoopMonitor(loop, thread)
+    _monitor.start()
+
+
+BACKGROUND_LOOP_LAG.set_function(lambda: _monitor.recent_lag() if _monitor and _monitor.thread.is_alive() else None)
@@ -0,0 +1,437 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Optional, Sequence
+
+# Prometheus-style metrics for /metrics.
+#
+# Each thread records into its own shard (a plain dict only that thread writes), so
+# recording takes no lock; /metrics merges the shards at scrape time. Shards of threads
+# that have exited are folded into a retired total so short-lived threads don't pile up.
+#
+# Metrics are recorded per worker process and every series carries a `worker` label.
+# Under serve.py's forked workers, which share one listening socket, each worker also
+# writes a snapshot to a shared directory so whichever worker answers /metrics reports
+# all of them.
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_INTERVAL = 5  # seconds between a worker's snapshots
+SNAPSHOT_STALE_AFTER = 60  # snapshots older than this belong to a worker that is gone
+
+_registry = []
+_shared_dir = None
+_snapshot_pid = None
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []  # (thread, shard)
+        self._retired = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _merge(self, into: dict, key: tuple, value):
+        into[key] = into.get(key, 0) + value
+
+    def collect(self) -> dict:
+        """Label values -> merged value across all threads."""
+        with self._lock:
+            shards = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    shards.append((thread, shard))
+                else:
+                    for key, value in dict(shard).items():
+                        self._merge(self._retired, key, value)
+            self._shards = shards
+            live = [shard for _, shard in shards]
+            merged = {}
+            for key, value in self._retired.items():
+                self._merge(merged, key, value)
+        for shard in live:
+            # dict() copies in one step under the GIL, even while the owner thread writes
+            for key, value in dict(shard).items():
+                self._merge(merged, key, value)
+        return merged
+
+    def _labels(self, worker: str, key: tuple, extra: str = None) -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        pairs.append(f'worker="{worker}"')
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}'
+
+    def render(self, workers: list) -> list:
+        """Lines for [(worker, collected values), ...]."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for worker, collected in workers:
+            for key, value in sorted(collected.items()):
+                lines.append(f"{self.name}{self._labels(worker, key)} {_format(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Either moved with inc()/dec() (per-thread deltas summed at scrape time, so a stream
+    may start and end on different threads) or computed by a function at scrape time.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), function: Callable = None):
+        super().__init__(name, documentation, labelnames)
+        self._function = function
+
+    def set_function(self, function: Callable[[], Optional[float]]):
+        self._function = function
+
+    def inc(self, amount: float = 1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def collect(self) -> dict:
+        if self._function is None:
+            return super().collect()
+        value = self._function()
+        return {} if value is None else {(): value}
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        entry = shard.get(key)
+        if entry is None:
+            # Per-bucket counts (the last is +Inf), then sum and count
+            entry = shard[key] = [0] * (len(self.buckets) + 3)
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def _merge(self, into: dict, key: tuple, value):
+        current = into.get(key)
+        into[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+
+    def render(self, workers: list) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for worker, collected in workers:
+            for key, entry in sorted(collected.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), entry):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else _format(bound)
+                    bucket_labels = self._labels(worker, key, f'le="{le}"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{self.name}_sum{self._labels(worker, key)} {_format(entry[-2])}")
+                lines.append(f"{self.name}_count{self._labels(worker, key)} {entry[-1]}")
+        return lines
+
+    def time(self, **labels):
+        """Context manager and decorator observing elapsed seconds."""
+        return _Timer(self, labels)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', '_start')
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self._start, **self.labels)
+        return False
+
+    def __call__(self, func):
+        histogram, labels = self.histogram, self.labels
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _Timer(histogram, labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(histogram, labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value) -> str:
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render() -> str:
+    """All metrics of this worker, and of its sibling workers when shared, in the Prometheus text format."""
+    workers = [(str(os.getpid()), {metric.name: metric.collect() for metric in _registry})]
+    workers.extend(_sibling_snapshots())
+    workers.sort(key=lambda worker: worker[0])
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render([(worker, values.get(metric.name, {})) for worker, values in workers]))
+    return '\n'.join(lines) + '\n'
+
+
+def share_across_workers(directory: str):
+    """Report every worker's metrics from any of them, through snapshots in `directory`.
+
+    Called by the supervisor before forking; each worker then calls start_snapshots().
+    """
+    global _shared_dir
+    _shared_dir = directory
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(_shared_dir, f"{pid}.json")
+
+
+def write_snapshot():
+    if _shared_dir is None:
+        return
+    data = {metric.name: [[list(key), value] for key, value in metric.collect().items()] for metric in _registry}
+    path = _snapshot_path(os.getpid())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def remove_snapshot(pid: int = None):
+    if _shared_dir is None:
+        return
+    try:
+        os.remove(_snapshot_path(pid or os.getpid()))
+    except FileNotFoundError:
+        pass
+
+
+def start_snapshots():
+    """Start this worker's snapshot thread (once per process; no-op unless shared)."""
+    global _snapshot_pid
+    if _shared_dir is None or _snapshot_pid == os.getpid():
+        return
+    _snapshot_pid = os.getpid()
+
+    def run():
+        while True:
+            try:
+                write_snapshot()
+            except Exception as e:
+                logger.error(f"Error writing metrics snapshot: {e}")
+            time.sleep(SNAPSHOT_INTERVAL)
+
+    threading.Thread(target=run, name='metrics-snapshot', daemon=True).start()
+
+
+def _sibling_snapshots() -> list:
+    if _shared_dir is None:
+        return []
+    own = f"{os.getpid()}.json"
+    now = time.time()
+    workers = []
+    for name in sorted(os.listdir(_shared_dir)):
+        if not name.endswith('.json') or name == own:
+            continue
+        path = os.path.join(_shared_dir, name)
+        try:
+            if now - os.path.getmtime(path) > SNAPSHOT_STALE_AFTER:
+                continue
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # Removed or replaced while reading
+            continue
+        workers.append((name[:-len('.json')], {
+            metric_name: {tuple(key): value for key, value in values} for metric_name, values in data.items()
+        }))
+    return workers
+
+
+class MetricsMiddleware:
+    """WSGI middleware timing each request until its body is closed (the whole stream for SSE)."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        status = ['500']
+
+        def timed_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def observe():
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                blueprint=environ.get('longgbot.blueprint') or '',
+                route=environ.get('longgbot.route') or 'unmatched',
+                method=environ.get('REQUEST_METHOD', ''),
+                status=status[0]
+            )
+
+        try:
+            iterable = self.wsgi_app(environ, timed_start_response)
+        except Exception:
+            observe()
+            raise
+        return _TimedBody(iterable, observe)
+
+
+class _TimedBody:
+    __slots__ = ('_iterable', '_observe')
+
+    def __init__(self, iterable, observe):
+        self._iterable = iterable
+        self._observe = observe
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._observe()
+
+
+def init_app(app):
+    """Time requests to `app`, labelled by blueprint and route rule rather than URL."""
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+    from flask import request
+
+    @app.before_request
+    def label_request():
+        if request.url_rule is not None:
+            request.environ['longgbot.route'] = request.url_rule.rule
+            request.environ['longgbot.blueprint'] = request.blueprint
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'longgbot_http_request_duration_seconds',
+    'Request duration until the response body is closed, including the whole stream for SSE.',
+    ('blueprint', 'route', 'method', 'status'), LATENCY_BUCKETS
+)
+FIRESTORE_SECONDS = Histogram(
+    'longgbot_firestore_duration_seconds',
+    'Duration of Firestore-backed functions in shared_context.',
+    ('function',), (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+UPSTREAM_TTFT_SECONDS = Histogram(
+    'longgbot_upstream_ttft_seconds',
+    'Time from sending a streaming upstream request to its first content token.',
+    ('model',), (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+)
+UPSTREAM_TOKENS_PER_SECOND = Histogram(
+    'longgbot_upstream_tokens_per_second',
+    'Streaming output rate after the first token, counting each content delta as a token.',
+    ('model',), (5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+)
+UPSTREAM_TOKENS = Counter(
+    'longgbot_upstream_tokens_total',
+    'Streamed content deltas received from upstream.',
+    ('model',)
+)
+ACTIVE_STREAMS = Gauge(
+    'longgbot_active_streams',
+    'Server-sent event responses currently streaming.',
+    ('kind',)
+)
+BACKGROUND_LOOP_LAG = Gauge(
+    'longgbot_background_loop_lag_seconds',
+    'Highest background asyncio loop lag seen by the periodic probe over the last 15 seconds, including a stall in progress.'
+)
+LOOP_LAG_SECONDS = Histogram(
+    'longgbot_background_loop_probe_lag_seconds',
+    'How late each periodic probe on the background asyncio loop woke up.',
+    (), (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+LOOP_STALLS = Counter(
+    'longgbot_background_loop_stalls_total',
+    'Times the background loop was blocked beyond the slow-callback threshold.'
+)
+LOOP_BUSY_SECONDS = Counter(
+    'longgbot_background_loop_busy_seconds_total',
+    'Time coroutines spent running on the background loop (not awaiting), by coroutine.',
+    ('coroutine',)
+)
+LOOP_SLOW_STEPS = Counter(
+    'longgbot_background_loop_slow_steps_total',
+    'Coroutine steps that ran longer than the slow-callback threshold, by coroutine.',
+    ('coroutine',)
+)
+STREAM_QUEUE_DEPTH = Gauge(
+    'longgbot_stream_queue_depth',
+    'Items produced on the background loop but not yet consumed, across run_stream_global streams.'
+)
+IMAGE_PROCESSING_SECONDS = Histogram(
+    'longgbot_image_processing_seconds',
+    'Time spent decoding, resizing and re-encoding images.',
+    ('operation',), (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+DOCUMENT_EXTRACTION_SECONDS = Histogram(
+    'longgbot_document_extraction_seconds',
+    'Text extraction time for uploaded documents (cache misses only).',
+    ('file_type', 'success'), (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+RATE_LIMIT_REJECTIONS = Counter(
+    'longgbot_rate_limit_rejections_total',
+    'Requests refused by a limiter: requests (per-user rate), image_batch (per-user batch rate), tokens (quota), overload (load shedding), admission (upstream queue timeout).',
+    ('limiter',)
+)
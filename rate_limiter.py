@@ -0,0 +1,137 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# Next to the code rather than in the working directory, so every worker opens the same file
+RATE_LIMIT_DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rate_limits.db')
+EVICTION_INTERVAL = 60  # seconds between idle-key sweeps
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_after: float  # seconds until one more request would be allowed
+
+
+class SlidingWindowRateLimiter:
+    """
+    Sliding-window-counter rate limiter.
+
+    Each key keeps only two counters (current and previous fixed window), so memory is
+    constant per active user. State lives in a SQLite table so every worker process on
+    the host shares one budget; if the database is unusable the limiter falls back to
+    in-process counters with the same algorithm.
+    """
+
+    def __init__(self, limit: int, window: int, db_path: str = RATE_LIMIT_DB_FILE):
+        self.limit = limit
+        self.window = window
+        self.db_path = db_path
+        self._local = threading.local()
+        self._memory = {}
+        self._memory_lock = threading.Lock()
+        self._last_eviction = 0.0
+        self._use_sqlite = self._init_db()
+
+    def _init_db(self) -> bool:
+        try:
+            conn = self._connection()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits ("
+                "key TEXT PRIMARY KEY, window_start REAL NOT NULL, "
+                "count INTEGER NOT NULL, prev_count INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_window ON rate_limits(window_start)")
+            return True
+        except Exception as e:
+            logger.error(f"Rate limiter database unavailable, using per-process counters: {e}")
+            return False
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=1.0, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _evaluate(self, window_start, count, prev_count, now):
+        """Roll the stored counters forward to `now` and decide whether one more hit fits."""
+        current_start = math.floor(now / self.window) * self.window
+        if window_start == current_start:
+            prev, curr = prev_count, count
+        elif window_start == current_start - self.window:
+            prev, curr = count, 0
+        else:
+            prev, curr = 0, 0
+
+        weight = 1 - (now - current_start) / self.window
+        allowed = prev * weight + curr + 1 <= self.limit
+        if allowed:
+            curr += 1
+        remaining = max(0, int(self.limit - (prev * weight + curr)))
+        reset_after = 0.0 if remaining > 0 else self._time_until_allowed(prev, curr, current_start, now)
+        return current_start, curr, prev, RateLimitResult(allowed, self.limit, remaining, reset_after)
+
+    def _time_until_allowed(self, prev, curr, current_start, now):
+        if curr + 1 <= self.limit and prev > 0:
+            # Wait for enough of the previous window to slide out
+            at = current_start + self.window * (1 - (self.limit - curr - 1) / prev)
+        else:
+            # The current window alone is full; it becomes the previous window next
+            next_start = current_start + self.window
+            at = next_start + self.window * (1 - (self.limit - 1) / max(curr, 1))
+        return max(0.0, at - now)
+
+    def hit(self, key: str) -> RateLimitResult:
+        now = time.time()
+        if self._use_sqlite:
+            try:
+                return self._hit_sqlite(key, now)
+            except Exception as e:
+                logger.error(f"Rate limiter database error, using per-process counters: {e}")
+        return self._hit_memory(key, now)
+
+    def _hit_sqlite(self, key, now):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT window_start, count, prev_count FROM rate_limits WHERE key = ?", (key,)
+            ).fetchone()
+            window_start, count, prev_count = row if row else (None, 0, 0)
+            current_start, curr, prev, result = self._evaluate(window_start, count, prev_count, now)
+            if result.allowed:
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_limits (key, window_start, count, prev_count) VALUES (?, ?, ?, ?)",
+                    (key, current_start, curr, prev)
+                )
+            if now - self._last_eviction > EVICTION_INTERVAL:
+                self._last_eviction = now
+                conn.execute("DELETE FROM rate_limits WHERE window_start < ?", (now - 2 * self.window,))
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _hit_memory(self, key, now):
+        with self._memory_lock:
+            window_start, count, prev_count = self._memory.get(key, (None, 0, 0))
+            current_start, curr, prev, result = self._evaluate(window_start, count, prev_count, now)
+            if result.allowed:
+                self._memory[key] = (current_start, curr, prev)
+            if now - self._last_eviction > EVICTION_INTERVAL:
+                self._last_eviction = now
+                cutoff = now - 2 * self.window
+                for stale_key in [k for k, v in self._memory.items() if v[0] < cutoff]:
+                    del self._memory[stale_key]
+            return result
@@ -0,0 +1,87 @@
+from flask import Blueprint, request, jsonify, abort
+from functools import wraps
+import config
+import hmac
+import metrics
+import os
+import tracing
+
+admin_bp = Blueprint('admin', __name__)
+
+# Bearer token for /admin endpoints and /metrics (unset disables them)
+ADMIN_TOKEN = getattr(config, 'ADMIN_TOKEN', None)
+# Serve /metrics without the token, for scrapers on a private network
+METRICS_PUBLIC = getattr(config, 'METRICS_PUBLIC', False)
+MAX_TRACES_LISTED = 200
+
+def has_admin_token():
+    header = request.headers.get('Authorization', '')
+    token = header[7:] if header.startswith('Bearer ') else ''
+    return hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+def require_admin(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            abort(404)
+        if not has_admin_token():
+            return jsonify({'error': 'Unauthorized'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+@admin_bp.route('/metrics')
+def prometheus_metrics():
+    """Metrics of every worker in the Prometheus text format; needs ADMIN_TOKEN unless METRICS_PUBLIC."""
+    if not METRICS_PUBLIC:
+        if not ADMIN_TOKEN:
+            abort(404)
+        if not has_admin_token():
+            return jsonify({'error': 'Unauthorized'}), 401
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@admin_bp.route('/admin/traces')
+@require_admin
+def list_traces():
+    """
+    Recent request traces of this worker process, newest first.
+
+    ?min_ms=500 keeps traces at least that slow (in-progress ones included),
+    ?name=/chat/stream keeps those whose name contains the text, ?limit=N.
+    """
+    min_ms = request.args.get('min_ms', type=float)
+    name = request.args.get('name')
+    limit = min(request.args.get('limit', 50, type=int), MAX_TRACES_LISTED)
+    traces = []
+    for trace in tracing.recent_traces():
+        summary = trace.summary()
+        if name and name not in summary['name']:
+            continue
+        if min_ms is not None and summary['duration_ms'] is not None and summary['duration_ms'] < min_ms:
+            continue
+        traces.append(summary)
+        if len(traces) >= limit:
+            break
+    return jsonify({'worker': os.getpid(), 'traces': traces})
+
+@admin_bp.route('/admin/traces/<trace_id>')
+@require_admin
+def get_trace(trace_id):
+    """One trace with its spans; ?format=text renders an indented timeline."""
+    trace = tracing.get_trace(trace_id)
+    if trace is None:
+        return jsonify({'error': 'Trace not found in this worker'}), 404
+    data = trace.to_dict()
+    if request.args.get('format') != 'text':
+        return jsonify(data)
+
+    depth = {}
+    lines = [f"{data['name']}  trace {trace_id}"]
+    for span in data['span_list']:
+        depth[span['span_id']] = depth.get(span['parent_id'], -1) + 1
+        duration = 'open' if span['duration_ms'] is None else f"{span['duration_ms']:.1f} ms"
+        attributes = ' '.join(f"{k}={v}" for k, v in span['attributes'].items())
+        error = f"  ERROR {span['error']}" if span['error'] else ''
+        lines.append(f"{span['offset_ms']:9.1f} ms  {'  ' * depth[span['span_id']]}{span['name']}  {duration}  {attributes}{error}")
+    if data['dropped_spans']:
+        lines.append(f"({data['dropped_spans']} spans dropped)")
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; charset=utf-8'}
@@ -0,0 +1,78 @@
+from flask import Blueprint, current_app, request, send_file, url_for, abort
+from build_assets import DIST_DIRNAME, MANIFEST_NAME
+import json
+import logging
+import mimetypes
+import os
+
+assets_bp = Blueprint('assets', __name__)
+logger = logging.getLogger(__name__)
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Preferred first; each maps to the suffix written by build_assets.py
+PRECOMPRESSED_ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+_manifest = None
+
+def get_manifest():
+    """Build manifest ({'assets': logical -> built, 'preload': entry -> built}), empty when not built."""
+    global _manifest
+    if _manifest is None:
+        path = os.path.join(current_app.static_folder, DIST_DIRNAME, MANIFEST_NAME)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            logger.info("No static asset manifest found; serving unfingerprinted assets")
+            _manifest = {}
+        except Exception as e:
+            logger.error(f"Error loading static asset manifest: {e}")
+            _manifest = {}
+        _manifest.setdefault('assets', {})
+        _manifest.setdefault('preload', {})
+    return _manifest
+
+def _use_build():
+    # Debug serves sources directly so edits show up without a rebuild
+    return not current_app.debug
+
+def asset_url(filename):
+    """URL of a static asset: fingerprinted build when available, plain /static otherwise."""
+    if _use_build():
+        built = get_manifest()['assets'].get(filename)
+        if built:
+            return url_for('assets.built_asset', filename=built)
+    return url_for('static', filename=filename)
+
+def asset_preloads(entry):
+    """URLs to modulepreload alongside a JS entry (its bundles), empty when serving sources."""
+    if not _use_build():
+        return []
+    return [url_for('assets.built_asset', filename=built) for built in get_manifest()['preload'].get(entry, [])]
+
+@assets_bp.app_context_processor
+def inject_asset_url():
+    return {'asset_url': asset_url, 'asset_preloads': asset_preloads}
+
+@assets_bp.route('/assets/<path:filename>')
+def built_asset(filename):
+    dist_dir = os.path.realpath(os.path.join(current_app.static_folder, DIST_DIRNAME))
+    path = os.path.realpath(os.path.join(dist_dir, filename))
+    if not path.startswith(dist_dir + os.sep) or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    encoding = None
+    accepted = request.accept_encodings
+    for name, suffix in PRECOMPRESSED_ENCODINGS:
+        if accepted[name] and os.path.isfile(path + suffix):
+            path, encoding = path + suffix, name
+            break
+
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=True, max_age=31536000)
+    if encoding:
+        # Also keeps flask-compress from compressing the response again
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
@@ -1,17 +1,26 @@
 from flask import Blueprint, request, jsonify, current_app
-from ai_client import ask_ai, ask_ai_stream
+from ai_client import ask_ai, ask_ai_stream, KEEPALIVE, KEEPALIVE_INTERVAL
 from shared_context import (
-    get_user_model, get_firestore_conversation, create_firestore_conversation,
-    add_firestore_message, set_conversation_title_if_default, get_user_document,
-    add_firestore_messages_batch, mark_document_injected,
+    get_user_model, get_firestore_conversation_state, create_firestore_conversation,
+    new_conversation_id, add_firestore_message, get_user_document, commit_turn,
     sanitize_input
 )
 from routes.general import get_user_key, check_rate_limit, get_hashed_codes, is_free_model
+from usage_quota import check_token_quota, record_token_usage, refund_token_usage, quota_exceeded_message
+from load_shedding import overload_detector, SHED_RETRY_AFTER
+from admission import AdmissionRejected
+from document_index import build_document_excerpt
+from ingestion import ingestion_manager
+from context_compaction import compact_context, schedule_summary_refresh
+from background_tasks import run_in_background
+import tracing
+from metrics import ACTIVE_STREAMS, RATE_LIMIT_REJECTIONS
 import logging
 import json
+import math
 import base64
 import tiktoken
-import threading
+import time
 
 chat_bp = Blueprint('chat', __name__)
 logger = logging.getLogger(__name__)
@@ -29,40 +38,136 @@ def estimate_tokens(text):
         # Fallback to heuristic if tiktoken fails
         return len(str(text)) // 4 + 10
 
-def limit_context_to_tokens(messages, max_tokens=30000):
-    """Limit context messages to stay under max_tokens limit - optimized for speed"""
+def message_tokens(message):
+    """Estimated tokens for one context message.
+
+    Document messages built this turn carry an exact count from extraction; everything
+    else is re-counted because legacy stored counts might be wrong.
+    """
+    if message.get('role') == 'system' and message.get('document_tokens') is not None:
+        return message['document_tokens']
+    content = message.get('content', '')
+    if isinstance(content, list):
+        # Handle multimodal content
+        content = "".join(item.get('text', '') for item in content if item.get('type') == 'text')
+    return estimate_tokens(content)
+
+def limit_context_to_tokens(messages, max_tokens=30000, return_tokens=False):
+    """Limit context messages to stay under max_tokens limit - optimized for speed.
+
+    With return_tokens=True, returns (messages, total_tokens) so callers can reuse the count.
+    """
     if not messages:
-        return messages
+        return (messages, 0) if return_tokens else messages
     
     # Reserve tokens for system prompt and current user message
     reserved_tokens = 2000
     available_tokens = max_tokens - reserved_tokens
-    total_tokens = 0
-    limited_messages = []
+    # Pinned messages (the conversation summary) are always kept; they stand in for the
+    # oldest history, which is exactly what trimming would drop first
+    total_tokens = sum(message_tokens(message) for message in messages if message.get('pinned'))
+    kept = set()
     
     # Start from the most recent messages and work backwards
-    for message in reversed(messages):
-        # Always calculate tokens to ensure accuracy (legacy counts might be wrong)
-        # Benchmarking shows this takes ~50ms for 100k tokens, which is acceptable.
-        content = message.get('content', '')
-        if isinstance(content, list):
-            # Handle multimodal content
-            text_content = ""
-            for item in content:
-                if item.get('type') == 'text':
-                    text_content += item.get('text', '')
-            msg_tokens = estimate_tokens(text_content)
-        else:
-            msg_tokens = estimate_tokens(content)
+    for idx in range(len(messages) - 1, -1, -1):
+        message = messages[idx]
+        if message.get('pinned'):
+            continue
+        # Benchmarking shows re-counting takes ~50ms for 100k tokens, which is acceptable.
+        msg_tokens = message_tokens(message)
         
         if total_tokens + msg_tokens > available_tokens:
             break
             
         total_tokens += msg_tokens
-        limited_messages.append(message)
+        kept.add(idx)
+    
+    # Chronological order, pinned messages in their original place
+    limited_messages = [message for idx, message in enumerate(messages) if message.get('pinned') or idx in kept]
+    if return_tokens:
+        return limited_messages, total_tokens
+    return limited_messages
+
+def count_context_tokens(messages):
+    """Total estimated tokens for context messages (used when no limit was applied)."""
+    return sum(message_tokens(message) for message in messages or [])
+
+@tracing.traced('chat.limit_context')
+def apply_context_limit(context, premium, model, max_context_tokens=None):
+    """Limit context for the user's tier. Returns (context, context_tokens).
+
+    max_context_tokens (set under load shedding) overrides the tier budget.
+    """
+    if max_context_tokens:
+        return limit_context_to_tokens(context, max_tokens=max_context_tokens, return_tokens=True)
+    # Free models stay under 32k tokens, premium under 95k tokens (safety buffer)
+    if premium:
+        return limit_context_to_tokens(context, max_tokens=95000, return_tokens=True)
+    elif is_free_model(model):
+        return limit_context_to_tokens(context, max_tokens=30000, return_tokens=True)
+    return context, count_context_tokens(context)
+
+@tracing.traced('chat.document_context')
+def add_document_context(user_key, conversation_id, message, context):
+    """
+    Add the user's uploaded document to the context for this turn.
+
+    Indexed documents contribute only the chunks most relevant to the message, as a
+    per-turn system message that is not persisted. Documents uploaded before indexing
+    are injected once in full and persisted so they stay in the conversation history;
+    commit_turn records the injection once the turn is saved, so a turn that is rejected
+    or fails injects the document again next time.
+    Returns (context, messages_to_persist, document_added).
+    """
+    # A document still being ingested is skipped rather than holding up the turn
+    if not ingestion_manager.wait_for_user(user_key):
+        logger.info(f"Document for {user_key} still ingesting; answering without it")
+        return context, [], False
+    
+    document = get_user_document(user_key)
+    if not document:
+        return context, [], False
+    
+    if document.get('chunks'):
+        excerpt, excerpt_tokens = build_document_excerpt(
+            document, message, cache_key=f"{user_key}:{document.get('uploaded_at')}", return_tokens=True
+        )
+        return (context or []) + [{'role': 'system', 'content': excerpt, 'document_tokens': excerpt_tokens}], [], True
     
-    # Reverse back to chronological order
-    return list(reversed(limited_messages))
+    if document.get('injected_conversation_id') == conversation_id:
+        return context, [], False
+    system_text = (
+        f"The user has uploaded a document named '{document['filename']}' "
+        f"(type: {document['file_type']}). Here is its content for reference. "
+        f"Use it to answer future questions until the user uploads a new document or asks to ignore it.\n\n"
+        f"--- DOCUMENT CONTENT START ---\n"
+        f"{document['content']}\n"
+        f"--- DOCUMENT CONTENT END ---"
+    )
+    message_entry = {'role': 'system', 'content': system_text}
+    if document.get('token_count'):
+        # Extraction recorded the content's size; add a margin for the framing text
+        message_entry['document_tokens'] = document['token_count'] + 100
+    pending_messages = [message_entry]
+    return (context or []) + pending_messages, pending_messages, True
+
+def overloaded_response():
+    RATE_LIMIT_REJECTIONS.inc(limiter='overload')
+    resp = jsonify({'error': 'The service is under heavy load right now. Please try again shortly.'})
+    resp.headers['Retry-After'] = str(SHED_RETRY_AFTER)
+    return resp, 503
+
+def busy_response(error):
+    # Already counted as an admission rejection when the queue wait timed out
+    resp = jsonify({'error': str(error)})
+    resp.headers['Retry-After'] = str(error.retry_after)
+    return resp, 503
+
+def quota_exceeded_response(result):
+    RATE_LIMIT_REJECTIONS.inc(limiter='tokens')
+    resp = jsonify({'error': quota_exceeded_message(result)})
+    resp.headers['Retry-After'] = str(max(1, math.ceil(result.retry_after)))
+    return resp, 429
 
 @chat_bp.route('/chat', methods=['POST'])
 def chat():
@@ -91,18 +196,27 @@ def chat():
         else:
             model = get_user_model(user_key, 'chat') or 'gpt-4o-mini-search-preview-2025-03-11'
         
+        # Under upstream pressure free-tier requests are degraded or shed before any work is done
+        degradation = overload_detector.degradation_for(premium)
+        if degradation is None:
+            return overloaded_response()
+        if degradation.model:
+            model = degradation.model
+        tracing.annotate(model=model, premium=bool(premium), degraded=degradation.max_context_tokens is not None)
+        
+        needs_summary = False
+        needs_creation = not conversation_id
         if conversation_id:
-            context = get_firestore_conversation(user_key, conversation_id)
+            context, summary = get_firestore_conversation_state(user_key, conversation_id)
+            # History covered by the rolling summary is sent as the summary instead
+            context, needs_summary = compact_context(context, summary, bool(premium))
         else:
-            # Create new conversation without setting title yet (will be set later)
-            conversation_id = create_firestore_conversation(user_key)
+            # Created in Firestore only once the request is accepted: creating one may evict
+            # the user's oldest conversation, which a rejected request must not do
+            conversation_id = new_conversation_id()
             context = []
         
-        # Limit context for free models to stay under 32k tokens, premium to 95k tokens (safety buffer)
-        if premium:
-            context = limit_context_to_tokens(context, max_tokens=95000)
-        elif is_free_model(model):
-            context = limit_context_to_tokens(context, max_tokens=30000)
+        context, context_tokens = apply_context_limit(context, premium, model, degradation.max_context_tokens)
             
         image_keywords = [
             "generate image", "tạo ảnh", "tạo tranh", "tạo logo", "gen image", 
@@ -113,6 +227,8 @@ def chat():
         if is_image_request:
             if not premium:
                 return jsonify({'error': 'Image generation is only available for premium users.'}), 403
+            if needs_creation:
+                create_firestore_conversation(user_key, conversation_id=conversation_id)
             return jsonify({'type': 'image_request', 'prompt': message, 'conversation_id': conversation_id})
         
         image_bytes = None
@@ -125,37 +241,33 @@ def chat():
                 logger.error(f"Error decoding image data: {e}")
                 return jsonify({'error': 'Invalid image data'}), 400
         
-        # If there is a stored document and it hasn't been injected into this conversation yet,
-        # inject it once as a system message so it persists in history even after removal.
-        pending_messages = []
-        document = get_user_document(user_key)
-        if document:
-            injected_conv = document.get('injected_conversation_id')
-            if injected_conv != conversation_id:
-                system_text = (
-                    f"The user has uploaded a document named '{document['filename']}' "
-                    f"(type: {document['file_type']}). Here is its content for reference. "
-                    f"Use it to answer future questions until the user uploads a new document or asks to ignore it.\n\n"
-                    f"--- DOCUMENT CONTENT START ---\n"
-                    f"{document['content']}\n"
-                    f"--- DOCUMENT CONTENT END ---"
-                )
-                # Add to persistent history (batched later)
-                pending_messages.append({ 'role': 'system', 'content': system_text })
-                # Also include in the in-memory context for this immediate call
-                context = (context or []) + [{ 'role': 'system', 'content': system_text }]
-                # Mark as injected for this conversation (persisted to Firestore for multi-worker safety)
-                mark_document_injected(user_key, conversation_id)
-                
-                # Re-apply context limiting after document injection
-                if premium:
-                    context = limit_context_to_tokens(context, max_tokens=95000)
-                elif is_free_model(model):
-                    context = limit_context_to_tokens(context, max_tokens=30000)
+        # Add the user's uploaded document (relevant excerpts, or a one-time injection for legacy uploads)
+        context, pending_messages, document_added = add_document_context(user_key, conversation_id, message, context)
+        if document_added:
+            # Re-apply context limiting after document injection
+            context, context_tokens = apply_context_limit(context, premium, model, degradation.max_context_tokens)
 
         final_message = message
         
-        response = ask_ai(final_message, model, context, image_bytes)
+        # Enforce token quotas before the upstream call; prompt tokens are charged on admission
+        prompt_tokens = context_tokens + estimate_tokens(final_message)
+        quota = check_token_quota(user_key, premium, prompt_tokens)
+        if not quota.allowed:
+            return quota_exceeded_response(quota)
+        record_token_usage(user_key, prompt_tokens)
+        if needs_creation:
+            create_firestore_conversation(user_key, conversation_id=conversation_id)
+        
+        try:
+            response = ask_ai(
+                final_message, model, context, image_bytes, user_key=user_key, premium=bool(premium),
+                max_tokens=degradation.max_tokens, web_search=degradation.web_search
+            )
+        except AdmissionRejected as e:
+            # Never reached upstream: nothing to save, and the prompt charge is returned
+            refund_token_usage(user_key, prompt_tokens)
+            return busy_response(e)
+        record_token_usage(user_key, estimate_tokens(response))
         
         # Batch Firestore writes in background thread (non-blocking)
         messages_to_save = pending_messages + [
@@ -165,13 +277,15 @@ def chat():
         
         def save_to_firestore():
             try:
-                add_firestore_messages_batch(user_key, conversation_id, messages_to_save)
-                set_conversation_title_if_default(user_key, conversation_id, message)
+                commit_turn(user_key, conversation_id, messages_to_save, title=message,
+                            document_injected=bool(pending_messages))
+                if needs_summary:
+                    schedule_summary_refresh(user_key, conversation_id, bool(premium))
             except Exception as e:
                 logger.error(f"Error saving to Firestore in background: {e}")
         
         # Run Firestore writes in background thread to avoid blocking the response
-        threading.Thread(target=save_to_firestore, daemon=True).start()
+        run_in_background(save_to_firestore, name='firestore-save')
         
         return jsonify({
             'type': 'chat',
@@ -210,22 +324,33 @@ def chat_stream():
             model = get_user_model(user_key, 'chat') or 'claude-sonnet-4-20250514-thinking'
         else:
             model = get_user_model(user_key, 'chat') or 'gpt-4o-mini-search-preview-2025-03-11'
+        
+        # Under upstream pressure free-tier requests are degraded or shed before any work is done
+        degradation = overload_detector.degradation_for(premium)
+        if degradation is None:
+            return overloaded_response()
+        if degradation.model:
+            model = degradation.model
+        tracing.annotate(model=model, premium=bool(premium), degraded=degradation.max_context_tokens is not None)
             
+        needs_summary = False
+        needs_creation = not conversation_id
         if conversation_id:
-            context = get_firestore_conversation(user_key, conversation_id)
+            context, summary = get_firestore_conversation_state(user_key, conversation_id)
+            # History covered by the rolling summary is sent as the summary instead
+            context, needs_summary = compact_context(context, summary, bool(premium))
         else:
-            # Create new conversation without setting title yet (will be set later)
-            conversation_id = create_firestore_conversation(user_key)
+            # Created in Firestore only once the request is accepted: creating one may evict
+            # the user's oldest conversation, which a rejected request must not do
+            conversation_id = new_conversation_id()
             context = []
         
-        # Limit context for free models to stay under 32k tokens, premium to 95k tokens (safety buffer)
-        if premium:
-            context = limit_context_to_tokens(context, max_tokens=95000)
-        elif is_free_model(model):
-            context = limit_context_to_tokens(context, max_tokens=30000)
+        context, context_tokens = apply_context_limit(context, premium, model, degradation.max_context_tokens)
         
         # Quick check for image generation requests (only if premium)
         if premium and message.lower().startswith(('generate image', 'gen image', 'create image', 'tạo ảnh', 'tạo tranh', 'gen pic')):
+            if needs_creation:
+                create_firestore_conversation(user_key, conversation_id=conversation_id)
             return jsonify({'type': 'image_request', 'prompt': message, 'conversation_id': conversation_id})
             
         image_bytes = None
@@ -238,46 +363,63 @@ def chat_stream():
                 logger.error(f"Error decoding image data: {e}")
                 return jsonify({'error': 'Invalid image data'}), 400
 
-        # Inject document once as a system message in this conversation if needed
-        pending_messages = []
-        document = get_user_document(user_key)
-        if document:
-            injected_conv = document.get('injected_conversation_id')
-            if injected_conv != conversation_id:
-                system_text = (
-                    f"The user has uploaded a document named '{document['filename']}' "
-                    f"(type: {document['file_type']}). Here is its content for reference. "
-                    f"Use it to answer future questions until the user uploads a new document or asks to ignore it.\n\n"
-                    f"--- DOCUMENT CONTENT START ---\n"
-                    f"{document['content']}\n"
-                    f"--- DOCUMENT CONTENT END ---"
-                )
-                # Persist and include in streaming context immediately (batched later)
-                pending_messages.append({ 'role': 'system', 'content': system_text })
-                context = (context or []) + [{ 'role': 'system', 'content': system_text }]
-                document['injected_conversation_id'] = conversation_id
-                mark_document_injected(user_key, conversation_id)
-                
-                # Re-apply context limiting after document injection
-                if premium:
-                    context = limit_context_to_tokens(context, max_tokens=95000)
-                elif is_free_model(model):
-                    context = limit_context_to_tokens(context, max_tokens=30000)
+        # Add the user's uploaded document (relevant excerpts, or a one-time injection for legacy uploads)
+        context, pending_messages, document_added = add_document_context(user_key, conversation_id, message, context)
+        if document_added:
+            # Re-apply context limiting after document injection
+            context, context_tokens = apply_context_limit(context, premium, model, degradation.max_context_tokens)
 
         final_message = message
 
+        # Enforce token quotas before the upstream call; prompt tokens are charged on admission
+        prompt_tokens = context_tokens + estimate_tokens(final_message)
+        quota = check_token_quota(user_key, premium, prompt_tokens)
+        if not quota.allowed:
+            return quota_exceeded_response(quota)
+        record_token_usage(user_key, prompt_tokens)
+        if needs_creation:
+            create_firestore_conversation(user_key, conversation_id=conversation_id)
+        tracing.annotate(prompt_tokens=prompt_tokens)
+
         def generate():
             full_response = ""
             full_thinking = ""
+            stream_start_ns = time.time_ns()
+            first_chunk = True
+            ACTIVE_STREAMS.inc(kind='chat')
+            stream = ask_ai_stream(
+                final_message, model, context, image_bytes, user_key=user_key, premium=bool(premium),
+                max_tokens=degradation.max_tokens, web_search=degradation.web_search, keepalive=KEEPALIVE_INTERVAL
+            )
             try:
-                for chunk in ask_ai_stream(final_message, model, context, image_bytes):
+                for chunk in stream:
+                    if chunk is KEEPALIVE:
+                        # Queued or waiting on upstream: a comment lets a dead connection surface
+                        yield ": keepalive\n\n"
+                        continue
                     if chunk:
                         try:
                             chunk_data = json.loads(chunk)
                             chunk_type = chunk_data.get('type', 'content')
                             text = chunk_data.get('text', '')
+                            if first_chunk and chunk_type != 'queued':
+                                # Time until the user sees output, including queueing and upstream TTFT
+                                first_chunk = False
+                                tracing.record('chat.first_chunk', stream_start_ns)
                             
-                            if chunk_type == 'thinking':
+                            if chunk_type == 'error':
+                                # The turn is not saved. A request rejected before reaching upstream
+                                # (e.g. the admission wait timed out) gets its prompt charge back; an
+                                # upstream timeout was sent, so only the output so far is charged
+                                if chunk_data.get('code') != 'timeout':
+                                    refund_token_usage(user_key, prompt_tokens)
+                                tracing.annotate(rejected=chunk_data.get('code') or 'error')
+                                yield f"data: {json.dumps({'type': 'error', 'error': text, 'code': chunk_data.get('code'), 'conversation_id': conversation_id})}\n\n"
+                                return
+                            elif chunk_type == 'queued':
+                                # Waiting for an upstream slot; tell the client where it is in line
+                                yield f"data: {json.dumps({'type': 'queued', 'position': chunk_data.get('position'), 'model': model, 'conversation_id': conversation_id})}\n\n"
+                            elif chunk_type == 'thinking':
                                 full_thinking += text
                                 # Send thinking separately with special marker
                                 yield f"data: {json.dumps({'type': 'thinking', 'chunk': text, 'model': model, 'conversation_id': conversation_id})}\n\n"
@@ -298,19 +440,28 @@ def chat_stream():
                 
                 def save_to_firestore():
                     try:
-                        add_firestore_messages_batch(user_key, conversation_id, messages_to_save)
-                        set_conversation_title_if_default(user_key, conversation_id, message)
+                        commit_turn(user_key, conversation_id, messages_to_save, title=message,
+                                    document_injected=bool(pending_messages))
+                        if needs_summary:
+                            schedule_summary_refresh(user_key, conversation_id, bool(premium))
                     except Exception as e:
                         logger.error(f"Error saving to Firestore in background: {e}")
                 
                 # Run Firestore writes in background thread
-                threading.Thread(target=save_to_firestore, daemon=True).start()
+                run_in_background(save_to_firestore, name='firestore-save')
                 
                 yield f"data: {json.dumps({'type': 'done', 'done': True, 'model': model, 'conversation_id': conversation_id})}\n\n"
                     
             except Exception as e:
                 logger.error(f"Error in streaming chat: {e}")
                 yield f"data: {json.dumps({'error': f'Error: {str(e)}'})}\n\n"
+            finally:
+                # Closing the stream early (client disconnected) cancels the upstream call
+                stream.close()
+                # Charge completion tokens (including thinking) produced so far, also when the
+                # client aborted the stream or it failed midway
+                record_token_usage(user_key, estimate_tokens(full_thinking + full_response))
+                ACTIVE_STREAMS.dec(kind='chat')
 
         return current_app.response_class(
             generate(),
@@ -1,44 +1,56 @@
-from flask import Blueprint, render_template, request, jsonify, make_response, send_from_directory
+from flask import Blueprint, render_template, request, jsonify, make_response, send_from_directory, g
 from config import CHAT_MODELS, IMAGE_GEN_MODELS, FREE_MODELS
 from shared_context import (
     get_user_model, set_user_model, clear_user_context,
-    get_firestore_conversations_for_user, get_firestore_conversation,
+    get_firestore_conversations_for_user, get_firestore_conversation, get_conversation_version,
+    get_versioned_conversation, get_conversation_list_versions, messages_since,
     delete_firestore_conversation, create_firestore_conversation,
     set_conversation_title_if_default, add_firestore_message,
     clear_user_document
 )
+from rate_limiter import SlidingWindowRateLimiter
+from admission import admission_controller
+from load_shedding import overload_detector
+from metrics import RATE_LIMIT_REJECTIONS
+from routes.admin import require_admin
 import uuid
 import hashlib
 import logging
-from datetime import datetime, timedelta
-from collections import defaultdict
+import math
 import os
 
 general_bp = Blueprint('general', __name__)
 logger = logging.getLogger(__name__)
 
-# Rate limiting
-rate_limit_storage = defaultdict(list)
+# Rate limiting (sliding-window counter shared by all workers on this host)
 RATE_LIMIT_REQUESTS = 30
 RATE_LIMIT_WINDOW = 60
+rate_limiter = SlidingWindowRateLimiter(RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW)
+
+MAX_HISTORY_PAGE = 200  # messages per paged /conversations/<id> response
 
 def check_rate_limit(user_key):
-    """Simple rate limiting: max requests per time window"""
+    """Sliding-window rate limiting: max requests per time window"""
     if not user_key:
         return False
     
-    now = datetime.utcnow()
-    window_start = now - timedelta(seconds=RATE_LIMIT_WINDOW)
-    
-    requests = rate_limit_storage[user_key]
-    requests = [req_time for req_time in requests if req_time > window_start]
-    rate_limit_storage[user_key] = requests
-    
-    if len(requests) >= RATE_LIMIT_REQUESTS:
-        return False
-    
-    rate_limit_storage[user_key].append(now)
-    return True
+    result = rate_limiter.hit(user_key)
+    # Remembered for the response headers added in add_rate_limit_headers
+    g.rate_limit = result
+    if not result.allowed:
+        RATE_LIMIT_REJECTIONS.inc(limiter='requests')
+    return result.allowed
+
+@general_bp.after_app_request
+def add_rate_limit_headers(response):
+    result = g.get('rate_limit')
+    if result is not None:
+        response.headers['X-RateLimit-Limit'] = str(result.limit)
+        response.headers['X-RateLimit-Remaining'] = str(result.remaining)
+        response.headers['X-RateLimit-Reset'] = str(math.ceil(result.reset_after))
+        if not result.allowed:
+            response.headers['Retry-After'] = str(max(1, math.ceil(result.reset_after)))
+    return response
 
 def load_valid_codes():
     codes_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'codes.txt')
@@ -129,10 +141,30 @@ def validate_code():
         resp.set_cookie('premium_code_hash', '', expires=0)
         return resp, 403
 
+def _with_etag(response, etag):
+    response.set_etag(etag)
+    # Clients may reuse the response but must revalidate it first; the user comes from the cookie
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Cookie')
+    return response
+
+def _not_modified(etag):
+    return _with_etag(make_response('', 304), etag)
+
+def _conversation_list_etag(versions):
+    state = ",".join(sorted(f"{v.get('conversation_id')}:{v.get('version', 0)}" for v in versions))
+    return hashlib.sha256(state.encode('utf-8')).hexdigest()[:32]
+
 @general_bp.route('/conversations', methods=['GET'])
 def list_conversations():
     try:
         user_key = get_user_key()
+        # Cheap projection first: an unchanged list is answered without reading any messages
+        versions = get_conversation_list_versions(user_key)
+        etag = _conversation_list_etag(versions) if versions is not None else None
+        if etag and request.if_none_match.contains(etag):
+            return _not_modified(etag)
+        
         conversations = get_firestore_conversations_for_user(user_key)
         
         # Handle case where Firestore is unavailable
@@ -157,7 +189,9 @@ def list_conversations():
                 'created_at': conv.get('created_at'),
                 'message_count': len(messages)
             })
-        return jsonify({'conversations': summaries})
+        response = jsonify({'conversations': summaries})
+        # Computed from what was just read, which may be newer than the projection
+        return _with_etag(response, _conversation_list_etag(conversations))
     except Exception as e:
         logger.error(f"Error listing conversations: {e}", exc_info=True)
         # Return empty list instead of error to allow app to continue
@@ -180,8 +214,34 @@ def new_conversation():
 def get_conversation(conversation_id):
     try:
         user_key = get_user_key()
-        messages = get_firestore_conversation(user_key, conversation_id)
-        return jsonify({'messages': messages if messages is not None else []})
+        version = get_conversation_version(user_key, conversation_id)
+        if version is None:
+            return jsonify({'messages': []})
+        etag = str(version)
+        if request.if_none_match.contains(etag):
+            return _not_modified(etag)
+        
+        since_version = request.args.get('since_version', type=int)
+        if since_version == version:
+            return _with_etag(jsonify({'messages': [], 'version': version, 'delta': True}), etag)
+        
+        messages, version = get_versioned_conversation(user_key, conversation_id, version)
+        if version is None:
+            return jsonify({'messages': []})
+        payload = {'version': version, 'message_count': len(messages)}
+        limit = request.args.get('limit', type=int)
+        # A delta only makes sense from a version the client got from us, i.e. not from the future
+        if since_version is not None and 0 <= since_version < version:
+            payload.update({'messages': messages_since(messages, since_version), 'delta': True})
+        elif limit and limit > 0:
+            # One page of history: the `limit` messages before index `before` (default: the newest)
+            before = request.args.get('before', default=len(messages), type=int)
+            end = max(0, min(before, len(messages)))
+            start = max(0, end - min(limit, MAX_HISTORY_PAGE))
+            payload.update({'messages': messages[start:end], 'offset': start})
+        else:
+            payload.update({'messages': messages, 'offset': 0})
+        return _with_etag(jsonify(payload), str(version))
     except Exception as e:
         logger.error(f"Error getting conversation {conversation_id}: {e}", exc_info=True)
         return jsonify({'messages': [], 'error': 'Unable to load conversation'})
@@ -250,6 +310,12 @@ def cancel_stream():
         logger.error(f"Error canceling stream: {e}")
         return jsonify({'error': f'Error: {str(e)}'}), 500
 
+@general_bp.route('/admission_stats', methods=['GET'])
+@require_admin
+def admission_stats():
+    """Queue length and wait-time metrics for upstream admission control"""
+    return jsonify({**admission_controller.stats(), 'load': overload_detector.snapshot()})
+
 @general_bp.route('/clear_context', methods=['POST'])
 def clear_context():
     try:
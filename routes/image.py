@@ -1,16 +1,27 @@
-from flask import Blueprint, request, jsonify
-from ai_client import run_async_global
+from flask import Blueprint, request, jsonify, current_app
+from ai_client import run_async_global, run_stream_global, KEEPALIVE, KEEPALIVE_INTERVAL
 from ai_image_client import AIImageClient
 from shared_context import get_user_model
 from config import IMAGE_GEN_MODELS
-from routes.general import get_user_key, get_hashed_codes
+from routes.general import get_user_key, get_hashed_codes, check_rate_limit, RATE_LIMIT_WINDOW
+from rate_limiter import SlidingWindowRateLimiter
+from metrics import ACTIVE_STREAMS, RATE_LIMIT_REJECTIONS
 import logging
 import base64
+import json
+import math
 
 image_bp = Blueprint('image', __name__)
 logger = logging.getLogger(__name__)
 image_client = AIImageClient()
 
+MAX_BATCH_VARIANTS = 4
+MAX_BATCH_ITEMS = 8
+# Each batch fans out to up to MAX_BATCH_ITEMS upstream calls, so batches get their own
+# per-user budget on top of the request limit (same window, so the limiters share a table)
+BATCH_RATE_LIMIT_REQUESTS = 4
+batch_rate_limiter = SlidingWindowRateLimiter(BATCH_RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW)
+
 @image_bp.route('/generate_image', methods=['POST'])
 def generate_image():
     user_key = get_user_key()
@@ -39,6 +50,92 @@ def generate_image():
         logger.error(f"Error generating image: {e}")
         return jsonify({'error': f'Error: {str(e)}'}), 500
 
+@image_bp.route('/generate_image/batch', methods=['POST'])
+def generate_image_batch():
+    user_key = get_user_key()
+    hashed_codes = get_hashed_codes()
+    premium = user_key and user_key in hashed_codes
+    if not premium:
+        return jsonify({'error': 'Image generation is only available for premium users.'}), 403
+    if not check_rate_limit(user_key):
+        return jsonify({'error': 'Rate limit exceeded. Please slow down.'}), 429
+    batch_limit = batch_rate_limiter.hit(f"image_batch:{user_key}")
+    if not batch_limit.allowed:
+        RATE_LIMIT_REJECTIONS.inc(limiter='image_batch')
+        resp = jsonify({'error': 'Too many image batches. Please wait before starting another.'})
+        resp.headers['Retry-After'] = str(max(1, math.ceil(batch_limit.reset_after)))
+        return resp, 429
+    try:
+        data = request.get_json() or {}
+        prompt = data.get('prompt', '').strip()
+        if not prompt:
+            return jsonify({'error': 'Prompt cannot be empty'}), 400
+
+        known_models = {m[0] for m in IMAGE_GEN_MODELS}
+        models = data.get('models') or [data.get('model') or get_user_model(user_key, 'image') or (IMAGE_GEN_MODELS[0][0] if IMAGE_GEN_MODELS else None)]
+        models = list(dict.fromkeys(m for m in models if m))
+        if not models or any(m not in known_models for m in models):
+            return jsonify({'error': 'Unknown image model'}), 400
+
+        try:
+            variants = int(data.get('n', 1))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid number of variants'}), 400
+        if variants < 1 or variants > MAX_BATCH_VARIANTS:
+            return jsonify({'error': f'Number of variants must be between 1 and {MAX_BATCH_VARIANTS}'}), 400
+        total = variants * len(models)
+        if total > MAX_BATCH_ITEMS:
+            return jsonify({'error': f'Too many images requested (max {MAX_BATCH_ITEMS} per batch)'}), 400
+
+        def generate():
+            completed = 0
+            ACTIVE_STREAMS.inc(kind='image_batch')
+            stream = run_stream_global(image_client.generate_images_batch(prompt, models, variants), KEEPALIVE_INTERVAL)
+            try:
+                yield f"data: {json.dumps({'type': 'start', 'total': total, 'models': models, 'n': variants})}\n\n"
+                for result in stream:
+                    if result is KEEPALIVE:
+                        # A comment lets a dead connection surface while generations are slow
+                        yield ": keepalive\n\n"
+                        continue
+                    completed += 1
+                    image_data = result['image_bytes']
+                    image_base64 = base64.b64encode(image_data).decode('utf-8') if image_data else None
+                    payload = {
+                        'type': 'image' if (image_data or result['image_url']) else 'error',
+                        'model': result['model'],
+                        'variant': result['variant'],
+                        'image': f'data:image/jpeg;base64,{image_base64}' if image_base64 else None,
+                        'image_url': result['image_url'],
+                        'elapsed': result['elapsed'],
+                        'since_start': result['since_start'],
+                        'completed': completed,
+                        'total': total
+                    }
+                    if payload['type'] == 'error':
+                        payload['error'] = 'Failed to generate image'
+                    yield f"data: {json.dumps(payload)}\n\n"
+                yield f"data: {json.dumps({'type': 'done', 'done': True, 'completed': completed, 'total': total})}\n\n"
+            except Exception as e:
+                logger.error(f"Error in batch image generation: {e}")
+                yield f"data: {json.dumps({'error': f'Error: {str(e)}'})}\n\n"
+            finally:
+                # Closing early (client disconnected) cancels the generations still running
+                stream.close()
+                ACTIVE_STREAMS.dec(kind='image_batch')
+
+        return current_app.response_class(
+            generate(),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+    except Exception as e:
+        logger.error(f"Error generating image batch: {e}")
+        return jsonify({'error': f'Error: {str(e)}'}), 500
+
 @image_bp.route('/edit_image', methods=['POST'])
 def edit_image():
     user_key = get_user_key()
@@ -1,17 +1,101 @@
 from flask import Blueprint, request, jsonify
 from werkzeug.utils import secure_filename
 from routes.general import get_user_key, get_hashed_codes, set_conversation_title_if_default
-from shared_context import set_user_document
+from shared_context import get_user_document
 from document_processor import DocumentProcessor
+from ingestion import ingestion_manager
+from metrics import IMAGE_PROCESSING_SECONDS
 from PIL import Image
+from typing import Tuple, Optional
 import logging
 import os
 import io
+import mmap
 import base64
+import tempfile
+import time
 
 upload_bp = Blueprint('upload', __name__)
 logger = logging.getLogger(__name__)
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_IMAGE_SIZE = 20 * 1024 * 1024
+
+class SpooledUpload(mmap.mmap):
+    """
+    A memory-mapped upload that other processes can reopen through `path` (None when
+    the platform has no /proc/<pid>/fd). The spool files are unnamed, so a duplicate
+    descriptor is kept open for the path until close_spooled.
+    """
+    path = None
+    _fd = None
+
+def _map_spool(fd: int) -> SpooledUpload:
+    mapped = SpooledUpload(fd, 0, access=mmap.ACCESS_READ)
+    if os.path.isdir('/proc/self/fd'):
+        try:
+            mapped._fd = os.dup(fd)
+            mapped.path = f"/proc/{os.getpid()}/fd/{mapped._fd}"
+        except OSError:
+            pass
+    return mapped
+
+def spool_upload(file, max_size: int) -> Tuple[Optional[mmap.mmap], str]:
+    """
+    Map an uploaded file into memory without reading it into a bytes object.
+
+    Werkzeug already spools large uploads to a temp file, which is mapped directly;
+    small in-memory uploads are copied chunk by chunk into a temp file first. The size
+    limit is enforced while copying. Returns (mapped_file, error) where error is '',
+    'too_large' or 'empty'; mapped_file is a SpooledUpload and the caller must close it
+    with close_spooled.
+    """
+    stream = file.stream
+    try:
+        fd = stream.fileno()
+        stream.flush()
+        size = os.fstat(fd).st_size
+        if size > max_size:
+            return None, 'too_large'
+        if size == 0:
+            return None, 'empty'
+        return _map_spool(fd), ''
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        pass
+
+    stream.seek(0)
+    with tempfile.TemporaryFile() as spool:
+        size = 0
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                return None, 'too_large'
+            spool.write(chunk)
+        if size == 0:
+            return None, 'empty'
+        spool.flush()
+        # The map (and its path) stay valid after the temp file is closed
+        return _map_spool(spool.fileno()), ''
+
+def close_spooled(mapped):
+    if mapped is None:
+        return
+    if getattr(mapped, '_fd', None) is not None:
+        os.close(mapped._fd)
+        mapped._fd, mapped.path = None, None
+    try:
+        mapped.close()
+    except BufferError:
+        # A parser still holds a view; the map is released when it is garbage collected
+        pass
+
+@upload_bp.app_errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': 'File size too large. Please upload a file smaller than 20MB.'}), 413
+
 @upload_bp.route('/upload_image', methods=['POST'])
 def upload_image():
     try:
@@ -36,20 +120,16 @@ def upload_image():
         if file_extension not in allowed_extensions:
             return jsonify({'error': 'Only image files are allowed. Please upload a JPEG, PNG, GIF, WebP, or BMP file.'}), 400
         
-        max_size = 20 * 1024 * 1024
-        file.seek(0, 2)
-        file_size = file.tell()
-        file.seek(0)
-        
-        if file_size > max_size:
+        image_file, spool_error = spool_upload(file, MAX_IMAGE_SIZE)
+        if spool_error == 'too_large':
             return jsonify({'error': 'File size too large. Please upload an image smaller than 20MB.'}), 400
-        
-        file.seek(0)
-        image_data = file.read()
+        if spool_error:
+            return jsonify({'error': 'Invalid image file. Please upload a valid image.'}), 400
         
         # Validate and optimize image in one step
+        processing_start = time.perf_counter()
         try:
-            img = Image.open(io.BytesIO(image_data))
+            img = Image.open(image_file)
             
             # Validate the image by getting its format
             if img.format not in ['JPEG', 'PNG', 'GIF', 'WEBP', 'BMP']:
@@ -70,10 +150,13 @@ def upload_image():
             optimized_buffer = io.BytesIO()
             img.save(optimized_buffer, format='JPEG', quality=85, optimize=True)
             image_data = optimized_buffer.getvalue()
+            IMAGE_PROCESSING_SECONDS.observe(time.perf_counter() - processing_start, operation='upload_optimize')
             
         except Exception as e:
             logger.error(f"Image processing failed: {e}")
             return jsonify({'error': 'Invalid image file. Please upload a valid image.'}), 400
+        finally:
+            close_spooled(image_file)
         
         image_base64 = base64.b64encode(image_data).decode('utf-8')
         
@@ -86,6 +169,30 @@ def upload_image():
         logger.error(f"Error uploading image: {e}", exc_info=True)
         return jsonify({'error': f'Error: {str(e)}'}), 500
 
+@upload_bp.route('/upload_document/status/<job_id>', methods=['GET'])
+def upload_document_status(job_id):
+    user_key = get_user_key()
+    # Jobs are visible to every worker through the shared job table
+    status = ingestion_manager.status(job_id)
+    if status is not None:
+        if status.pop('user_key') != user_key:
+            return jsonify({'error': 'Unknown job'}), 404
+        status.pop('updated_at', None)
+        return jsonify(status)
+    # Pruned from the table: the stored document records which job produced it
+    document = get_user_document(user_key) if user_key else None
+    if document and document.get('job_id') == job_id:
+        return jsonify({
+            'job_id': job_id,
+            'status': 'done',
+            'filename': document.get('filename'),
+            'file_type': document.get('file_type')
+        })
+    if not ingestion_manager.shared:
+        # Without the shared table the job may be running on another worker
+        return jsonify({'job_id': job_id, 'status': 'pending'})
+    return jsonify({'error': 'Unknown job'}), 404
+
 @upload_bp.route('/upload_document', methods=['POST'])
 def upload_document():
     try:
@@ -113,17 +220,18 @@ def upload_document():
         if not is_valid:
             return jsonify({'error': error_message}), 400
         
-        # Read file data
-        file_data = file.read()
-        
-        # Process document and extract text
-        success, content, file_type = DocumentProcessor.process_document(file_data, safe_filename)
+        # Map the spooled upload instead of reading it into memory
+        file_data, spool_error = spool_upload(file, DocumentProcessor.MAX_FILE_SIZE)
+        if spool_error == 'too_large':
+            return jsonify({'error': 'File size too large. Please upload a document smaller than 20MB.'}), 400
+        if spool_error:
+            return jsonify({'error': 'The uploaded document is empty.'}), 400
         
-        if not success:
-            return jsonify({'error': content}), 400
-        
-        # Store document content for the user
-        set_user_document(user_key, content, safe_filename, file_type)
+        # Extraction, chunking and storage run in the background; the client polls the job
+        job = ingestion_manager.submit(user_key, file_data, safe_filename, premium=bool(premium), cleanup=close_spooled)
+        if job is None:
+            close_spooled(file_data)
+            return jsonify({'error': 'Too many documents are being processed right now. Please try again shortly.'}), 503
         
         # If a conversation id was provided in headers or query, try to set a title
         conv_hint = request.args.get('conversation_id') or request.headers.get('X-Conversation-Id')
@@ -137,10 +245,11 @@ def upload_document():
         
         return jsonify({
             'success': True,
+            'job_id': job.job_id,
+            'status': job.status,
             'filename': safe_filename,
-            'file_type': file_type,
-            'message': f'Document "{safe_filename}" uploaded and processed successfully! You can ask multiple questions about its content. Click the green indicator to remove the document when done.'
-        })
+            'message': f'Document "{safe_filename}" uploaded and is being processed. You can ask multiple questions about its content. Click the green indicator to remove the document when done.'
+        }), 202
         
     except Exception as e:
         logger.error(f"Error uploading document: {e}", exc_info=True)
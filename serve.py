@@ -0,0 +1,253 @@
+"""
+Production entry point: serves the app with waitress, optionally across forked workers.
+
+    python serve.py [--workers N] [--threads N] [--host HOST] [--port PORT]
+
+Defaults come from the SERVER_* settings in config.py; command-line flags override them.
+`python app.py` remains the development server.
+"""
+import argparse
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SERVER_HOST = getattr(config, 'SERVER_HOST', '0.0.0.0')
+SERVER_PORT = getattr(config, 'SERVER_PORT', 5000)
+# Worker processes sharing the listening socket; 1 serves from this process
+SERVER_WORKERS = getattr(config, 'SERVER_WORKERS', 1)
+# Each open SSE stream occupies a thread for its whole duration, and requests waiting for
+# an upstream slot (admission.MAX_CONCURRENT_UPSTREAM) hold one too, so this is sized well
+# above the upstream cap rather than by CPU count
+SERVER_THREADS = getattr(config, 'SERVER_THREADS', 64)
+# Open connections per worker, including idle keep-alive ones (waitress defaults to 100)
+SERVER_CONNECTION_LIMIT = getattr(config, 'SERVER_CONNECTION_LIMIT', 256)
+# Idle connections are closed after this many seconds; a connection with a request in
+# progress, such as a long stream, is never closed by it
+SERVER_CHANNEL_TIMEOUT = getattr(config, 'SERVER_CHANNEL_TIMEOUT', 120)
+SERVER_BACKLOG = getattr(config, 'SERVER_BACKLOG', 1024)
+# Import the app once before forking so workers share its memory and start faster
+SERVER_PRELOAD = getattr(config, 'SERVER_PRELOAD', True)
+# Seconds a stopping worker waits for in-flight requests (including open streams) and
+# then for the background Firestore saves they scheduled, in total
+SERVER_SHUTDOWN_TIMEOUT = getattr(config, 'SERVER_SHUTDOWN_TIMEOUT', 60)
+RESPAWN_DELAY = 1.0  # seconds before replacing a worker that exited unexpectedly
+
+_shutdown_requested = False
+
+
+def _load_app():
+    from app import app
+    return app
+
+
+def _request_shutdown(signum, frame):
+    # Only flags the serving loop; repeated signals (Ctrl+C reaches every worker and the
+    # supervisor then sends SIGTERM too) must not interrupt a shutdown in progress
+    global _shutdown_requested
+    if not _shutdown_requested:
+        logger.info(f"Worker {os.getpid()} received signal {signum}, shutting down")
+    _shutdown_requested = True
+
+
+def _serve_until_shutdown(server):
+    """
+    Run waitress's loop until a signal arrives, then stop accepting but keep serving
+    the requests already in progress until they finish or SERVER_SHUTDOWN_TIMEOUT passes.
+
+    waitress's own run() stops its task threads after 5 seconds and stops flushing
+    their output, which would cut off open streams and lose the turns they save.
+    Returns the shutdown deadline.
+    """
+    from waitress import wasyncore
+    from waitress.channel import HTTPChannel
+    from waitress.server import BaseWSGIServer
+
+    # One listener gives a TcpWSGIServer, several (e.g. IPv4 and IPv6) a MultiSocketServer
+    socket_map = server.map if hasattr(server, 'map') else server._map
+    adj = server.adj
+
+    def poll():
+        wasyncore.loop(timeout=adj.asyncore_loop_timeout, map=socket_map, use_poll=adj.asyncore_use_poll, count=1)
+
+    while not _shutdown_requested:
+        poll()
+
+    deadline = time.monotonic() + SERVER_SHUTDOWN_TIMEOUT
+    # Stop accepting; with workers the shared socket stays open in the others
+    for listener in [d for d in list(socket_map.values()) if isinstance(d, BaseWSGIServer)]:
+        wasyncore.dispatcher.close(listener)
+
+    while True:
+        busy = 0
+        for channel in list(socket_map.values()):
+            if not isinstance(channel, HTTPChannel):
+                continue
+            if channel.requests or channel.total_outbufs_len:
+                busy += 1
+            else:
+                # Idle keep-alive connection: close it rather than wait for another request
+                channel.will_close = True
+        if not busy:
+            break
+        if time.monotonic() >= deadline:
+            logger.warning(f"Worker {os.getpid()} stopping with {busy} request(s) still in progress")
+            break
+        poll()
+
+    server.task_dispatcher.shutdown(timeout=1)
+    wasyncore.close_all(socket_map)
+    return deadline
+
+
+def _run_server(app, threads: int, **listen):
+    """Serve until SIGTERM/SIGINT, then finish requests and drain background work. Runs in each worker."""
+    from waitress import create_server
+    import ai_client
+    import background_tasks
+    import tracing
+    from usage_quota import token_quota
+
+    signal.signal(signal.SIGTERM, _request_shutdown)
+    signal.signal(signal.SIGINT, _request_shutdown)
+
+    # One background aiohttp loop per process, started before the first request
+    ai_client.get_background_loop()
+    # With several workers, publish this one's metrics for whichever worker is scraped
+    metrics.start_snapshots()
+
+    server = create_server(
+        app,
+        threads=threads,
+        connection_limit=SERVER_CONNECTION_LIMIT,
+        channel_timeout=SERVER_CHANNEL_TIMEOUT,
+        backlog=SERVER_BACKLOG,
+        ident='LongGBot',
+        **listen
+    )
+    logger.info(f"Worker {os.getpid()} serving with {threads} threads")
+    deadline = None
+    try:
+        deadline = _serve_until_shutdown(server)
+    finally:
+        logger.info(f"Worker {os.getpid()} stopping")
+        # Saves scheduled by requests that just finished get the rest of the shutdown budget
+        remaining = SERVER_SHUTDOWN_TIMEOUT if deadline is None else max(0.0, deadline - time.monotonic())
+        background_tasks.drain(remaining)
+        try:
+            token_quota.flush()
+        except Exception as e:
+            logger.error(f"Error flushing token usage on shutdown: {e}")
+        ai_client.stop_background_loop()
+        tracing.flush()
+        metrics.remove_snapshot()
+
+
+def serve(host: str = SERVER_HOST, port: int = SERVER_PORT, threads: int = SERVER_THREADS):
+    """Serve from this process."""
+    logger.info(f"Serving on http://{host}:{port}")
+    _run_server(_load_app(), threads, host=host, port=port)
+
+
+def serve_workers(workers: int, host: str = SERVER_HOST, port: int = SERVER_PORT,
+                  threads: int = SERVER_THREADS, preload: bool = SERVER_PRELOAD):
+    """
+    Fork `workers` processes that accept from one shared listening socket.
+
+    The parent only supervises: it replaces workers that die and, on SIGTERM or SIGINT,
+    passes SIGTERM on once and waits for every worker to finish its requests and drain. With preload the app is
+    imported here first; nothing may talk to Firestore or start the background loop
+    before the fork, which holds as importing the app only creates clients lazily.
+    """
+    sock = socket.create_server((host, port), backlog=SERVER_BACKLOG)
+    # Workers share one socket, so a scrape lands on any of them: each reports all of them
+    metrics_dir = tempfile.mkdtemp(prefix='longgbot-metrics-')
+    metrics.share_across_workers(metrics_dir)
+    app = _load_app() if preload else None
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            children.add(pid)
+            return
+        # Worker: drop the supervisor's handlers and never return into its loop
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        status = 0
+        try:
+            _run_server(app if app is not None else _load_app(), threads, sockets=[sock])
+        except Exception:
+            logger.exception(f"Worker {os.getpid()} failed")
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        # Workers close their copies as they stop accepting; new connections are then refused
+        sock.close()
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Serving on http://{host}:{port} with {workers} workers")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        metrics.remove_snapshot(pid)
+        if not stopping:
+            logger.error(f"Worker {pid} exited with code {os.waitstatus_to_exitcode(status)}, replacing it")
+            time.sleep(RESPAWN_DELAY)
+            spawn()
+    sock.close()
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run LongGBot with the waitress production server.")
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                        help="worker processes (default %(default)s)")
+    parser.add_argument('--threads', type=int, default=SERVER_THREADS,
+                        help="threads per worker, one per concurrent request or stream (default %(default)s)")
+    parser.add_argument('--no-preload', dest='preload', action='store_false', default=SERVER_PRELOAD,
+                        help="import the app in each worker instead of once before forking")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.workers > 1:
+        if not hasattr(os, 'fork'):
+            parser.error("--workers needs a platform with fork(); run one process per port instead")
+        serve_workers(args.workers, args.host, args.port, args.threads, args.preload)
+    else:
+        serve(args.host, args.port, args.threads)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,7 +1,7 @@
 import json
 import os
 import logging
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 from google.cloud import firestore
 from google.api_core import retry, exceptions
 from datetime import datetime
@@ -9,7 +9,12 @@ import time
 import grpc
 import re
 import secrets
+import threading
 import tiktoken
+from collections import OrderedDict
+from cache_coherence import CacheInvalidationBus, TimedCache
+from tracing import traced
+from metrics import FIRESTORE_SECONDS
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +23,8 @@ MODEL_FILE = "user_models.json"
 
 user_contexts = {}
 user_models = {}
-user_documents = {}
+user_documents = TimedCache()
+_models_file_mtime = None
 
 _firestore_client = None
 
@@ -39,8 +45,23 @@ def get_firestore_client():
             logger.error(f"✗ Failed to recreate Firestore client: {e}")
     return firestore_client
 
+# Invalidates this worker's cached documents and model selections when another worker writes
+invalidation_bus = CacheInvalidationBus(get_firestore_client)
+
 FIRESTORE_COLLECTION = "user_conversations"
 
+def firestore_op(name: str):
+    """Trace and time a Firestore-backed function as span firestore.<name>."""
+    def decorator(func):
+        return traced(f'firestore.{name}')(FIRESTORE_SECONDS.time(function=name)(func))
+    return decorator
+
+# Per-worker copies of recently read conversations, keyed by version: a request only
+# pays for a version lookup when the stored conversation hasn't changed
+CONVERSATION_CACHE_SIZE = 256
+_conversation_cache = OrderedDict()
+_conversation_cache_lock = threading.Lock()
+
 custom_retry = retry.Retry(
     initial=0.3,
     maximum=5.0,
@@ -65,6 +86,7 @@ def validate_conversation_id(conversation_id: str) -> bool:
         return False
     return bool(re.match(r'^[a-zA-Z0-9_-]+$', conversation_id))
 
+@firestore_op('verify_conversation_ownership')
 def verify_conversation_ownership(user_id: str, conversation_id: str) -> bool:
     """Verify that the user owns the conversation"""
     client = get_firestore_client()
@@ -83,6 +105,12 @@ def verify_conversation_ownership(user_id: str, conversation_id: str) -> bool:
         return False
 
 
+def _load_models():
+    global user_models, _models_file_mtime
+    _models_file_mtime = os.path.getmtime(MODEL_FILE)
+    with open(MODEL_FILE, 'r', encoding='utf-8') as f:
+        user_models = json.load(f)
+
 def load_data():
     global user_contexts, user_models
     
@@ -96,8 +124,7 @@ def load_data():
     
     if os.path.exists(MODEL_FILE):
         try:
-            with open(MODEL_FILE, 'r', encoding='utf-8') as f:
-                user_models = json.load(f)
+            _load_models()
             migrated = False
             for user_id, value in list(user_models.items()):
                 if isinstance(value, str):
@@ -148,16 +175,43 @@ def clear_user_context(user_key: str):
         del user_contexts[user_key_str]
         save_data()
 
+def _refresh_models_from_disk():
+    """Without the invalidation listener, pick up selections saved by other workers on this host."""
+    if invalidation_bus.listening:
+        return
+    try:
+        if os.path.exists(MODEL_FILE) and os.path.getmtime(MODEL_FILE) != _models_file_mtime:
+            _load_models()
+    except Exception as e:
+        logger.error(f"Error reloading user models: {e}")
+
 def get_user_model(user_key: str, model_type: str = 'chat') -> Optional[str]:
+    invalidation_bus.ensure_listening()
+    _refresh_models_from_disk()
     user_entry = user_models.get(str(user_key), {})
     return user_entry.get(model_type)
 
 def set_user_model(user_key: str, model_type: str, model: str):
+    global _models_file_mtime
     user_key_str = str(user_key)
+    _refresh_models_from_disk()
     if user_key_str not in user_models or not isinstance(user_models[user_key_str], dict):
         user_models[user_key_str] = {}
     user_models[user_key_str][model_type] = model
     save_data()
+    try:
+        _models_file_mtime = os.path.getmtime(MODEL_FILE)
+    except OSError:
+        pass
+    invalidation_bus.publish('user_model', user_key_str, dict(user_models[user_key_str]))
+
+def _apply_model_invalidation(user_key: str, value: Optional[dict]):
+    if value:
+        user_models[user_key] = value
+    else:
+        user_models.pop(user_key, None)
+
+invalidation_bus.register('user_model', _apply_model_invalidation)
 
 def remove_think_block(text):
     import re
@@ -166,6 +220,7 @@ def remove_think_block(text):
 def get_full_conversation(user_key: str) -> List[Dict]:
     return user_contexts.get(str(user_key), [])
 
+@firestore_op('get_firestore_conversations_for_user')
 def get_firestore_conversations_for_user(user_id):
     client = get_firestore_client()
     if not client:
@@ -184,80 +239,176 @@ def get_firestore_conversations_for_user(user_id):
         return []
 
 def get_firestore_conversation(user_id, conversation_id):
+    return get_firestore_conversation_state(user_id, conversation_id)[0]
+
+@firestore_op('get_firestore_conversation_state')
+def get_firestore_conversation_state(user_id, conversation_id) -> Tuple[List[Dict], Optional[Dict]]:
+    """Messages and rolling summary ({'text', 'covers', 'updated_at'} or None) in one read."""
     if not validate_conversation_id(conversation_id):
         logger.warning(f"Invalid conversation_id format: {conversation_id}")
-        return []
+        return [], None
     
     if not verify_conversation_ownership(user_id, conversation_id):
         logger.warning(f"User {user_id} attempted to access conversation {conversation_id} without ownership")
-        return []
+        return [], None
     
     client = get_firestore_client()
     if not client:
         logger.error("Firestore client not available")
-        return []
+        return [], None
     
     try:
         doc_ref = client.collection(FIRESTORE_COLLECTION).document(f"{user_id}__{conversation_id}")
         doc = doc_ref.get(timeout=5.0)
         if doc.exists:
-            return doc.to_dict().get("messages", [])
-        return []
+            data = doc.to_dict()
+            return data.get("messages", []), data.get("summary")
+        return [], None
     except Exception as e:
         logger.error(f"Error getting conversation {conversation_id}: {e}")
-        return []
-
-def add_firestore_message(user_id, conversation_id, message):
+        return [], None
+
+def _remember_conversation(user_id, conversation_id, version: int, messages: List[Dict]):
+    with _conversation_cache_lock:
+        _conversation_cache[f"{user_id}__{conversation_id}"] = (version, messages)
+        _conversation_cache.move_to_end(f"{user_id}__{conversation_id}")
+        while len(_conversation_cache) > CONVERSATION_CACHE_SIZE:
+            _conversation_cache.popitem(last=False)
+
+@firestore_op('get_conversation_version')
+def get_conversation_version(user_id, conversation_id) -> Optional[int]:
+    """
+    Version of a conversation the user owns, or None if it doesn't exist or isn't theirs.
+    
+    Only the version and owner fields are fetched, so this is cheap even for long
+    conversations. The version is bumped by every write to the messages or title.
+    """
     if not validate_conversation_id(conversation_id):
         logger.warning(f"Invalid conversation_id format: {conversation_id}")
-        return False
+        return None
     
-    if not verify_conversation_ownership(user_id, conversation_id):
-        logger.warning(f"User {user_id} attempted to modify conversation {conversation_id} without ownership")
-        return False
+    client = get_firestore_client()
+    if not client:
+        logger.error("Firestore client not available")
+        return None
     
-    content = message.get('content', '')
-    if isinstance(content, str):
-        message['content'] = sanitize_input(content)
+    try:
+        doc_ref = client.collection(FIRESTORE_COLLECTION).document(f"{user_id}__{conversation_id}")
+        doc = doc_ref.get(field_paths=["user_id", "version"], timeout=3.0)
+        if not doc.exists:
+            return None
+        data = doc.to_dict() or {}
+        if data.get("user_id") != user_id:
+            logger.warning(f"User {user_id} attempted to access conversation {conversation_id} without ownership")
+            return None
+        return data.get("version", 0)
+    except Exception as e:
+        logger.error(f"Error getting version of conversation {conversation_id}: {e}")
+        return None
+
+@firestore_op('get_versioned_conversation')
+def get_versioned_conversation(user_id, conversation_id, version: Optional[int] = None) -> Tuple[List[Dict], Optional[int]]:
+    """
+    Messages and version of a conversation the user owns.
+    
+    Args:
+        version: Current version from get_conversation_version; when this worker already
+            holds that version it is returned without reading the messages again
+    
+    Returns:
+        (messages, version); ([], None) if the conversation can't be read
+    """
+    key = f"{user_id}__{conversation_id}"
+    if version is not None:
+        with _conversation_cache_lock:
+            cached = _conversation_cache.get(key)
+            if cached and cached[0] == version:
+                _conversation_cache.move_to_end(key)
+                return cached[1], version
+    
+    if not validate_conversation_id(conversation_id):
+        logger.warning(f"Invalid conversation_id format: {conversation_id}")
+        return [], None
+    
+    client = get_firestore_client()
+    if not client:
+        logger.error("Firestore client not available")
+        return [], None
     
+    try:
+        # The owner check uses the same read instead of a separate verify_conversation_ownership
+        doc = client.collection(FIRESTORE_COLLECTION).document(key).get(timeout=5.0)
+        if not doc.exists:
+            return [], None
+        data = doc.to_dict() or {}
+        if data.get("user_id") != user_id:
+            logger.warning(f"User {user_id} attempted to access conversation {conversation_id} without ownership")
+            return [], None
+        messages = data.get("messages", [])
+        version = data.get("version", 0)
+        _remember_conversation(user_id, conversation_id, version, messages)
+        return messages, version
+    except Exception as e:
+        logger.error(f"Error getting conversation {conversation_id}: {e}")
+        return [], None
+
+def messages_since(messages: List[Dict], since_version: int) -> List[Dict]:
+    """Messages written after `since_version` (messages stored before versioning count as version 0)."""
+    return [m for m in messages if m.get("version", 0) > since_version]
+
+@firestore_op('get_conversation_list_versions')
+def get_conversation_list_versions(user_id) -> Optional[List[Dict]]:
+    """conversation_id and version of each of the user's conversations, without their messages."""
     client = get_firestore_client()
     if not client:
         logger.error("Firestore client not available")
+        return None
+    
+    try:
+        query = client.collection(FIRESTORE_COLLECTION).where("user_id", "==", user_id).select(["conversation_id", "version"])
+        return [doc.to_dict() for doc in query.stream(timeout=5.0)]
+    except Exception as e:
+        logger.error(f"Error fetching conversation versions: {e}")
+        return None
+
+@firestore_op('set_conversation_summary')
+def set_conversation_summary(user_id, conversation_id, text: str, covers: int) -> bool:
+    """Store the rolling summary of the first `covers` messages, unless a newer one is already stored."""
+    if not validate_conversation_id(conversation_id):
+        return False
+    
+    client = get_firestore_client()
+    if not client:
+        logger.debug("Firestore client not available, skipping summary update")
         return False
     
     try:
         doc_ref = client.collection(FIRESTORE_COLLECTION).document(f"{user_id}__{conversation_id}")
         doc = doc_ref.get(timeout=5.0)
-        
-        if doc.exists:
-            messages = doc.to_dict().get("messages", [])
-            existing_title = doc.to_dict().get("title", "New Conversation")
-        else:
-            messages = []
-            existing_title = "New Conversation"
-        
-        if len(messages) >= 1000:
-            logger.warning(f"Conversation {conversation_id} has too many messages")
+        if not doc.exists or doc.to_dict().get('user_id') != user_id:
             return False
-        
-        # Optimization 2: Pre-calculate token count
-        message['token_count'] = estimate_tokens(message.get('content', ''))
-        
-        messages.append(message)
-        
-        doc_ref.set({
-            "user_id": user_id,
-            "conversation_id": conversation_id,
-            "messages": messages,
-            "title": existing_title,
-            "last_updated": datetime.utcnow().isoformat() + 'Z'
-        }, timeout=5.0)
-        logger.debug(f"Message added to conversation {conversation_id}")
+        current = doc.to_dict().get("summary") or {}
+        if current.get("covers", 0) >= covers:
+            return False
+        doc_ref.update({"summary": {
+            "text": text,
+            "covers": covers,
+            "updated_at": datetime.utcnow().isoformat() + 'Z'
+        }}, timeout=5.0)
         return True
     except Exception as e:
-        logger.error(f"Error adding message to conversation {conversation_id}: {e}")
+        logger.error(f"Error saving summary for conversation {conversation_id}: {e}")
         return False
 
+def add_firestore_message(user_id, conversation_id, message):
+    """
+    Append one message to a conversation the user owns.
+
+    Goes through commit_turn's transaction, so the conversation version stays a strict
+    counter that version-keyed caches and messages_since deltas can rely on.
+    """
+    return commit_turn(user_id, conversation_id, [message]) is not None
+
 def estimate_tokens(text):
     """Estimate token count for text using tiktoken for accuracy."""
     if not text:
@@ -271,63 +422,116 @@ def estimate_tokens(text):
         # Fallback to heuristic if tiktoken fails
         return len(str(text)) // 4 + 10
 
-def add_firestore_messages_batch(user_id, conversation_id, messages_list):
-    """Add multiple messages in a single batch write (append to array)"""
+def _default_title_replacement(current_title, new_title) -> Optional[str]:
+    """The title to store if the conversation still has the default one, else None."""
+    if current_title and current_title.strip().lower() != "new conversation":
+        return None
+    safe = sanitize_input(new_title or "", max_length=100).strip()
+    if not safe:
+        return None
+    if len(safe) > 80:
+        safe = safe[:80] + "…"
+    return safe
+
+@firestore_op('commit_turn')
+def commit_turn(user_id, conversation_id, messages_list, title: Optional[str] = None,
+                document_injected: bool = False) -> Optional[int]:
+    """
+    Persist a finished turn in one Firestore transaction: append the messages, set the
+    title if it is still the default, mark the user's document as injected into this
+    conversation, and bump the conversation version.
+    
+    The document mark only applies if the stored document is still the one this worker
+    injected (same uploaded_at), so a newer upload is never marked by mistake.
+    
+    Returns:
+        The new conversation version, or None if nothing was written
+    """
     if not validate_conversation_id(conversation_id):
         logger.warning(f"Invalid conversation_id format: {conversation_id}")
-        return False
+        return None
     
-    if not verify_conversation_ownership(user_id, conversation_id):
-        logger.warning(f"User {user_id} attempted to modify conversation {conversation_id} without ownership")
-        return False
-        
     client = get_firestore_client()
     if not client:
         logger.error("Firestore client not available")
-        return False
-        
-    try:
-        doc_ref = client.collection(FIRESTORE_COLLECTION).document(f"{user_id}__{conversation_id}")
-        doc = doc_ref.get(timeout=5.0)
+        return None
+    
+    for msg in messages_list:
+        content = msg.get('content', '')
+        if isinstance(content, str):
+            msg['content'] = sanitize_input(content)
+        msg['token_count'] = estimate_tokens(msg.get('content', ''))
+    
+    user_key_str = str(user_id)
+    injected_uploaded_at = (user_documents.get(user_key_str) or {}).get('uploaded_at') if document_injected else None
+    conv_ref = client.collection(FIRESTORE_COLLECTION).document(f"{user_id}__{conversation_id}")
+    doc_ref = client.collection(USER_DOCUMENTS_COLLECTION).document(user_key_str)
+    committed = {}
+    
+    @firestore.transactional
+    def _commit(transaction):
+        # All reads happen before any write, as Firestore transactions require
+        snapshot = conv_ref.get(transaction=transaction, timeout=5.0)
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        if data.get('user_id') != user_id:
+            logger.warning(f"User {user_id} attempted to modify conversation {conversation_id} without ownership")
+            return None
+        document = None
+        if injected_uploaded_at:
+            document = doc_ref.get(transaction=transaction, timeout=5.0)
         
-        if doc.exists:
-            current_messages = doc.to_dict().get("messages", [])
-            existing_title = doc.to_dict().get("title", "New Conversation")
-        else:
-            current_messages = []
-            existing_title = "New Conversation"
-            
-        if len(current_messages) + len(messages_list) >= 1000:
+        messages = data.get("messages", [])
+        if len(messages) + len(messages_list) >= 1000:
             logger.warning(f"Conversation {conversation_id} has too many messages")
-            return False
-            
+            return None
+        
+        version = data.get("version", 0) + 1
         for msg in messages_list:
-            content = msg.get('content', '')
-            if isinstance(content, str):
-                msg['content'] = sanitize_input(content)
-            
-            # Optimization 2: Pre-calculate token count
-            msg['token_count'] = estimate_tokens(msg.get('content', ''))
-            
-            current_messages.append(msg)
-            
-        doc_ref.set({
-            "user_id": user_id,
-            "conversation_id": conversation_id,
-            "messages": current_messages,
-            "title": existing_title,
+            msg['version'] = version
+        committed["messages"] = messages + messages_list
+        update = {
+            "messages": committed["messages"],
+            "version": version,
             "last_updated": datetime.utcnow().isoformat() + 'Z'
-        }, timeout=5.0)
-        return True
+        }
+        new_title = _default_title_replacement(data.get("title"), title) if title else None
+        if new_title:
+            update["title"] = new_title
+        transaction.update(conv_ref, update)
+        
+        if document is not None and document.exists and document.to_dict().get('uploaded_at') == injected_uploaded_at:
+            transaction.update(doc_ref, {'injected_conversation_id': conversation_id})
+        return version
+    
+    try:
+        version = _commit(client.transaction())
+        if version is not None:
+            logger.debug(f"Committed turn to conversation {conversation_id} (version {version})")
+            # The next read of this conversation is then served without a full fetch
+            _remember_conversation(user_id, conversation_id, version, committed["messages"])
+            if injected_uploaded_at:
+                # Only now is the document part of the conversation, so later turns skip it
+                cached = user_documents.get(user_key_str)
+                if cached and cached.get('uploaded_at') == injected_uploaded_at:
+                    cached['injected_conversation_id'] = conversation_id
+                invalidation_bus.publish('user_document', user_key_str)
+        return version
     except Exception as e:
-        logger.error(f"Error in batch write: {e}")
-        return False
+        logger.error(f"Error committing turn to conversation {conversation_id}: {e}")
+        return None
+
+def new_conversation_id():
+    return secrets.token_urlsafe(32)
 
-def create_firestore_conversation(user_id, title=None):
+@firestore_op('create_firestore_conversation')
+def create_firestore_conversation(user_id, title=None, conversation_id=None):
+    """Create a conversation (with an id from new_conversation_id() if given), evicting the oldest at the limit."""
     if title:
         title = sanitize_input(title, max_length=100)
     
-    conv_id = secrets.token_urlsafe(32)
+    conv_id = conversation_id or new_conversation_id()
     
     client = get_firestore_client()
     if not client:
@@ -364,6 +568,7 @@ def create_firestore_conversation(user_id, title=None):
             "conversation_id": conv_id,
             "messages": [],
             "title": title or "New Conversation",
+            "version": 0,
             "created_at": datetime.utcnow().isoformat() + 'Z'
         }, timeout=10.0)
         logger.info(f"Created new conversation {conv_id} for user {user_id}")
@@ -373,6 +578,7 @@ def create_firestore_conversation(user_id, title=None):
         logger.error(f"Error creating conversation: {e}")
         return conv_id
 
+@firestore_op('delete_firestore_conversation')
 def delete_firestore_conversation(user_id, conversation_id):
     if not validate_conversation_id(conversation_id):
         logger.warning(f"Invalid conversation_id format: {conversation_id}")
@@ -390,12 +596,15 @@ def delete_firestore_conversation(user_id, conversation_id):
     try:
         doc_ref = client.collection(FIRESTORE_COLLECTION).document(f"{user_id}__{conversation_id}")
         doc_ref.delete(timeout=5.0)
+        with _conversation_cache_lock:
+            _conversation_cache.pop(f"{user_id}__{conversation_id}", None)
         logger.info(f"Deleted conversation {conversation_id} for user {user_id}")
         return True
     except Exception as e:
         logger.error(f"Error deleting conversation {conversation_id}: {e}")
         return False
 
+@firestore_op('set_conversation_title_if_default')
 def set_conversation_title_if_default(user_id, conversation_id, new_title):
     if not validate_conversation_id(conversation_id):
         return
@@ -418,13 +627,9 @@ def set_conversation_title_if_default(user_id, conversation_id, new_title):
         data = doc.to_dict() or {}
         current = data.get("title")
         
-        if not current or current.strip().lower() == "new conversation":
-            safe = (new_title or "").strip()
-            if not safe:
-                return
-            if len(safe) > 80:
-                safe = safe[:80] + "…"
-            doc_ref.update({"title": safe}, timeout=5.0)
+        safe = _default_title_replacement(current, new_title)
+        if safe:
+            doc_ref.update({"title": safe, "version": firestore.Increment(1)}, timeout=5.0)
             logger.debug(f"Updated title for conversation {conversation_id}")
     except Exception as e:
         logger.error(f"Error setting conversation title: {e}")
@@ -448,12 +653,16 @@ def generate_title_from_text(text: str) -> str:
 
 USER_DOCUMENTS_COLLECTION = "user_documents"
 
-def set_user_document(user_key: str, content: str, filename: str, file_type: str):
+@firestore_op('set_user_document')
+def set_user_document(user_key: str, content: str, filename: str, file_type: str, chunks: Optional[List[Dict]] = None, job_id: Optional[str] = None, token_count: Optional[int] = None):
     user_key_str = str(user_key)
     doc_data = {
         'content': content,
         'filename': filename,
         'file_type': file_type,
+        'chunks': chunks or [],
+        'job_id': job_id,
+        'token_count': token_count,
         'injected_conversation_id': None,
         'uploaded_at': datetime.utcnow().isoformat()
     }
@@ -466,26 +675,31 @@ def set_user_document(user_key: str, content: str, filename: str, file_type: str
             client.collection(USER_DOCUMENTS_COLLECTION).document(user_key_str).set(doc_data, timeout=5.0)
         except Exception as e:
             logger.error(f"Error saving user document to Firestore: {e}")
+    invalidation_bus.publish('user_document', user_key_str)
 
+@firestore_op('get_user_document')
 def get_user_document(user_key: str) -> Optional[Dict]:
     user_key_str = str(user_key)
-    # Return from in-memory cache if available
-    if user_key_str in user_documents:
+    # Return from in-memory cache while it is known to be current
+    if user_documents.fresh(user_key_str, invalidation_bus.cache_ttl()):
         return user_documents[user_key_str]
     # Fall back to Firestore (handles multi-worker deployments and server restarts)
     client = get_firestore_client()
     if not client:
-        return None
+        return user_documents.get(user_key_str)
     try:
         doc = client.collection(USER_DOCUMENTS_COLLECTION).document(user_key_str).get(timeout=5.0)
         if doc.exists:
             data = doc.to_dict()
             user_documents[user_key_str] = data  # Populate cache
             return data
+        user_documents.pop(user_key_str, None)
     except Exception as e:
         logger.error(f"Error fetching user document from Firestore: {e}")
+        return user_documents.get(user_key_str)
     return None
 
+@firestore_op('mark_document_injected')
 def mark_document_injected(user_key: str, conversation_id: str):
     """Mark the document as injected into a conversation. Updates both cache and Firestore."""
     user_key_str = str(user_key)
@@ -499,22 +713,23 @@ def mark_document_injected(user_key: str, conversation_id: str):
             )
         except Exception as e:
             logger.error(f"Error updating injected_conversation_id in Firestore: {e}")
+    invalidation_bus.publish('user_document', user_key_str)
 
+@firestore_op('clear_user_document')
 def clear_user_document(user_key: str):
     user_key_str = str(user_key)
-    if user_key_str in user_documents:
-        del user_documents[user_key_str]
+    user_documents.pop(user_key_str, None)
     client = get_firestore_client()
     if client:
         try:
             client.collection(USER_DOCUMENTS_COLLECTION).document(user_key_str).delete(timeout=5.0)
         except Exception as e:
             logger.error(f"Error deleting user document from Firestore: {e}")
+    invalidation_bus.publish('user_document', user_key_str)
 
 def has_user_document(user_key: str) -> bool:
-    user_key_str = str(user_key)
-    if user_key_str in user_documents:
-        return True
     return get_user_document(user_key) is not None
 
+invalidation_bus.register('user_document', lambda user_key, value: user_documents.pop(user_key, None))
+
 load_data()
\ No newline at end of file
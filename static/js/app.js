@@ -35,17 +35,12 @@ import {
     smoothScrollToBottom,
     initScrollMonitoring,
     enhanceAllAssistantMessagesWithCopy,
+    initMessageActions,
+    renderHistoryMessage,
     getIsStreaming
 } from './modules/chat.js';
 
-import {
-    uploadImage,
-    generateImage,
-    uploadDocument,
-    handlePaste,
-    clearUploadedDocument,
-    initUploadDropzones
-} from './modules/image.js';
+import { createMessageList } from './modules/message_list.js';
 
 import {
     submitCode,
@@ -61,7 +56,8 @@ import {
 
 import {
     getCachedConversation,
-    cacheConversation
+    cacheConversation,
+    prependCachedMessages
 } from './modules/cache.js';
 
 // Global State
@@ -69,6 +65,9 @@ let currentImageData = null;
 let currentImageModel = localStorage.getItem('selectedImageModel') || 'imagen-4.0-ultra-generate-exp-05-20';
 let currentChatModel = localStorage.getItem('selectedChatModel') || window.CURRENT_MODEL || 'gpt-4o-mini-search-preview-2025-03-11';
 let currentConversationId = null;
+let messageList = null;   // virtualized history of the current conversation
+let historyOffset = 0;    // index of the oldest loaded message
+const HISTORY_PAGE_SIZE = 50;
 
 // Parse model configuration from JSON script tag
 const MODEL_CONFIG = JSON.parse(document.getElementById('models-config').textContent);
@@ -85,12 +84,56 @@ const PREMIUM_MODELS = [
     ...ALL_IMAGE_MODELS.filter(id => !FREE_MODELS.includes(id))
 ];
 
+// Image and document upload code is lazy-loaded so it stays off the first-paint path
+let imageModule = null;
+let imageModulePromise = null;
+
+function loadImageModule() {
+    if (!imageModulePromise) {
+        imageModulePromise = import('./modules/image.js').then(module => {
+            imageModule = module;
+            return module;
+        });
+    }
+    return imageModulePromise;
+}
+
+function whenIdle(callback) {
+    if ('requestIdleCallback' in window) {
+        requestIdleCallback(callback, { timeout: 3000 });
+    } else {
+        setTimeout(callback, 1500);
+    }
+}
+
+function onPaste(event) {
+    const setImageData = (data) => currentImageData = data;
+    if (imageModule) {
+        imageModule.handlePaste(event, setImageData);
+        return;
+    }
+    // Clipboard items are only readable during the event, so grab image files now
+    const items = Array.from(event.clipboardData?.items || []);
+    const files = items
+        .filter(item => item.type && item.type.indexOf('image') !== -1)
+        .map(item => item.getAsFile())
+        .filter(Boolean);
+    if (!files.length) return; // plain text paste
+    event.preventDefault();
+    const replay = {
+        clipboardData: { items: files.map(file => ({ type: file.type, getAsFile: () => file })) },
+        preventDefault() { }
+    };
+    loadImageModule().then(module => module.handlePaste(replay, setImageData));
+}
+
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
     addMicroInteractions();
     initConfirmModal();
     updatePremiumIndicator();
     initScrollMonitoring();
+    initMessageActions();
     updateModelSelectors(PREMIUM_MODELS, FREE_MODELS);
 
     // Initialize dark mode from localStorage
@@ -134,11 +177,11 @@ document.addEventListener('DOMContentLoaded', () => {
     // Setup event listeners
     setupEventListeners();
 
-    // Initialize drag-and-drop + auto-upload for both upload modals
-    initUploadDropzones(
+    // Initialize drag-and-drop + auto-upload for both upload modals once the page is idle
+    whenIdle(() => loadImageModule().then(module => module.initUploadDropzones(
         (data) => { currentImageData = data; },
         () => currentConversationId
-    );
+    )));
 
     // Handle viewport changes for mobile
     setupViewportHandling();
@@ -214,9 +257,9 @@ function setupEventListeners() {
     window.logout = logout;
     window.stopResponse = stopResponse;
     window.sendMessage = () => sendMessage(currentImageData, currentConversationId, (id) => currentConversationId = id);
-    window.uploadImage = () => uploadImage((data) => currentImageData = data);
-    window.generateImage = () => generateImage(currentImageModel);
-    window.uploadDocument = () => uploadDocument(currentConversationId);
+    window.uploadImage = () => loadImageModule().then(module => module.uploadImage((data) => currentImageData = data));
+    window.generateImage = () => loadImageModule().then(module => module.generateImage(currentImageModel));
+    window.uploadDocument = () => loadImageModule().then(module => module.uploadDocument(currentConversationId));
     window.submitCode = submitCodeCallback;
     window.modelOptionClick = modelOptionClick;
     window.handleKeyPress = (e) => {
@@ -225,7 +268,7 @@ function setupEventListeners() {
             sendMessage(currentImageData, currentConversationId, (id) => currentConversationId = id);
         }
     };
-    window.handlePaste = (e) => handlePaste(e, (data) => currentImageData = data);
+    window.handlePaste = onPaste;
 
     // Upload menu overlay functions
     window.showUploadMenu = () => {
@@ -300,60 +343,108 @@ function setupViewportHandling() {
 }
 
 // Callbacks to bridge modules
+function resetMessageList() {
+    if (messageList) {
+        messageList.destroy();
+        messageList = null;
+    }
+}
+
+// Show a conversation's history (messages[0] is message number `offset`) in the virtualized list
+function showHistory(conversationId, messages, offset) {
+    historyOffset = offset;
+    const hasOlder = offset > 0;
+    if (messageList) {
+        messageList.replace(messages, hasOlder);
+        return;
+    }
+    messageList = createMessageList(document.getElementById('chatMessages'), renderHistoryMessage, {
+        messages,
+        hasOlder,
+        loadOlder: () => loadOlderMessages(conversationId)
+    });
+}
+
+function loadOlderMessages(conversationId) {
+    const page = { limit: HISTORY_PAGE_SIZE, before: historyOffset };
+    return getConversationMessages(conversationId, null, page).then(data => {
+        if (currentConversationId !== conversationId || !data.messages) return null;
+        const offset = data.offset ?? 0;
+        prependCachedMessages(conversationId, data.messages, offset);
+        historyOffset = offset;
+        return { messages: data.messages, hasOlder: offset > 0 };
+    });
+}
+
 function switchConversationCallback(conversationId) {
     // Store the current conversation ID for sending messages
     currentConversationId = conversationId;
 
     const chatMessages = document.getElementById('chatMessages');
+    resetMessageList();
     chatMessages.innerHTML = '';
+    const isCurrent = () => currentConversationId === conversationId;
 
     // 1. Try to load from cache first for immediate display
-    const cachedMessages = getCachedConversation(conversationId);
-    if (cachedMessages) {
-        cachedMessages.forEach(msg => {
-            addMessage(msg.role === 'user' ? 'user' : 'assistant', msg.content);
-        });
-        // Scroll to bottom after loading cache
-        setTimeout(() => {
-            smoothScrollToBottom(chatMessages, false);
-        }, 0);
-    }
+    const cacheLoaded = getCachedConversation(conversationId).then(cached => {
+        // The user may have switched again while IndexedDB was reading
+        if (cached && isCurrent()) {
+            showHistory(conversationId, cached.messages, cached.offset);
+            // Scroll to bottom after loading cache
+            setTimeout(() => {
+                smoothScrollToBottom(chatMessages, false);
+            }, 0);
+        }
+        return cached;
+    });
 
-    // 2. Fetch from backend to get updates (stale-while-revalidate)
-    getConversationMessages(conversationId)
-        .then(data => {
-            // If we have cached messages, we only want to update if there are changes
-            // For simplicity in this version, we'll just re-render if we didn't have cache,
-            // or if the server has more messages. 
-            // A better approach would be to diff, but for now let's just update the cache
-            // and only re-render if we had nothing cached.
-
-            if (data.messages && data.messages.length > 0) {
-                // Update cache with fresh data
-                cacheConversation(conversationId, data.messages);
-
-                // If we didn't have cache, render now
-                if (!cachedMessages) {
-                    data.messages.forEach(msg => {
-                        addMessage(msg.role === 'user' ? 'user' : 'assistant', msg.content);
-                    });
-                } else if (data.messages.length > cachedMessages.length) {
-                    // If server has more messages, append the new ones
-                    // This is a simple check; in reality we might want to be more robust
-                    const newMessages = data.messages.slice(cachedMessages.length);
-                    newMessages.forEach(msg => {
-                        addMessage(msg.role === 'user' ? 'user' : 'assistant', msg.content);
-                    });
+    // Newest page of history; older pages are fetched as the user scrolls up
+    const loadLatest = cached => getConversationMessages(conversationId, null, { limit: HISTORY_PAGE_SIZE }).then(data => {
+        if (!isCurrent()) return;
+        if (data.messages && data.messages.length > 0) {
+            const offset = data.offset ?? 0;
+            // Update cache with fresh data
+            cacheConversation(conversationId, data.messages, data.version ?? null, offset);
+            showHistory(conversationId, data.messages, offset);
+        } else if (!cached) {
+            addMessage('assistant', "New conversation started! How can I help you?");
+        }
+    });
+
+    // 2. Revalidate with the server (stale-while-revalidate). With a cached version this is a
+    // 304 when nothing changed, or a delta with only the messages written since.
+    cacheLoaded
+        .then(cached => {
+            if (!cached || cached.version === null) return loadLatest(cached);
+            return getConversationMessages(conversationId, cached.version).then(data => {
+                if (!isCurrent()) return;
+                if (data.notModified || (data.delta && data.message_count === undefined)) return;
+                if (!data.delta) {
+                    cacheConversation(conversationId, data.messages, data.version, data.offset ?? 0);
+                    showHistory(conversationId, data.messages, data.offset ?? 0);
+                    return;
                 }
-            } else if (!cachedMessages) {
-                addMessage('assistant', "New conversation started! How can I help you?");
-            }
+                const merged = cached.messages.slice(0, cached.baseCount - cached.offset).concat(data.messages);
+                if (cached.offset + merged.length !== data.message_count) {
+                    // History changed in a way a delta can't express
+                    return loadLatest(cached);
+                }
+                cacheConversation(conversationId, merged, data.version, cached.offset);
+                // Only messages beyond the cached ones need rendering
+                if (messageList) {
+                    messageList.append(merged.slice(cached.messages.length));
+                } else {
+                    showHistory(conversationId, merged, cached.offset);
+                }
+            });
         })
         .catch(err => {
             console.error('Failed to fetch conversation:', err);
-            if (!cachedMessages) {
-                addMessage('assistant', "Failed to load conversation. Please try again.");
-            }
+            cacheLoaded.then(cached => {
+                if (!cached && isCurrent()) {
+                    addMessage('assistant', "Failed to load conversation. Please try again.");
+                }
+            });
         });
 }
 
@@ -388,6 +479,7 @@ function clearContextCallback() {
                         indicator.remove();
                     }
 
+                    resetMessageList();
                     document.getElementById('chatMessages').innerHTML = `
                     <div class="message assistant">
                         <div class="message-content">
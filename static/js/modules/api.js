@@ -58,8 +58,22 @@ export function logout() {
     window.location.reload();
 }
 
+// Last conversation list and its ETag, so an unchanged list costs a 304
+let conversationListResponse = null;
+
 export function fetchConversations() {
-    return fetch('/conversations').then(response => response.json());
+    const headers = {};
+    if (conversationListResponse) headers['If-None-Match'] = conversationListResponse.etag;
+    return fetch('/conversations', { headers }).then(response => {
+        if (response.status === 304 && conversationListResponse) {
+            return conversationListResponse.data;
+        }
+        return response.json().then(data => {
+            const etag = response.headers.get('ETag');
+            conversationListResponse = etag ? { etag, data } : null;
+            return data;
+        });
+    });
 }
 
 export function deleteConversation(conversationId) {
@@ -78,8 +92,29 @@ export function createConversation() {
     }).then(response => response.json());
 }
 
-export function getConversationMessages(conversationId) {
-    return fetch(`/conversations/${conversationId}`).then(response => response.json());
+// With a known version, returns {notModified: true} if nothing changed, or a delta
+// ({delta: true, messages: <only newer ones>, message_count}) instead of the full history.
+// page = {limit, before} fetches only `limit` messages before index `before` (default: the
+// newest); the response's offset is the index of its first message.
+export function getConversationMessages(conversationId, sinceVersion = null, page = null) {
+    const params = new URLSearchParams();
+    const headers = {};
+    if (sinceVersion !== null && sinceVersion !== undefined) {
+        params.set('since_version', sinceVersion);
+        headers['If-None-Match'] = `"${sinceVersion}"`;
+    }
+    if (page) {
+        params.set('limit', page.limit);
+        if (page.before !== undefined) params.set('before', page.before);
+    }
+    const query = params.toString();
+    const url = `/conversations/${conversationId}${query ? `?${query}` : ''}`;
+    return fetch(url, { headers }).then(response => {
+        if (response.status === 304) {
+            return { notModified: true, messages: [], version: sinceVersion };
+        }
+        return response.json();
+    });
 }
 
 export function setModel(modelId, type) {
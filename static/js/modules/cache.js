@@ -1,67 +1,204 @@
-const CACHE_PREFIX = 'conv_';
-const CACHE_EXPIRY_MS = 5 * 60 * 1000; // 5 minutes
+// Conversation cache in IndexedDB: one row per message, so appends don't rewrite the
+// history, and a timestamp index so eviction doesn't read every conversation.
+// All functions return promises and never reject; a missing or broken IndexedDB
+// just means cache misses.
+const CACHE_DB_NAME = 'longgbot-cache';
+const CACHE_DB_VERSION = 1;
+// seq, offset, count and baseCount are positions in the server's message list; a cached
+// history may start at offset > 0 when older messages were never loaded
+const CONVERSATIONS_STORE = 'conversations'; // {id, offset, count, timestamp, version, baseCount}
+const MESSAGES_STORE = 'messages';           // {conversationId, seq, message}
+const LEGACY_CACHE_PREFIX = 'conv_';         // pre-IndexedDB localStorage entries
+// Entries are always revalidated against the server version before being trusted,
+// so they can live much longer than a plain time-based cache
+const CACHE_EXPIRY_MS = 24 * 60 * 60 * 1000; // 24 hours
 const MAX_CACHE_SIZE = 50; // conversations
 
-export function cacheConversation(conversationId, messages) {
+let cacheDbPromise = null;
+
+function openCacheDb() {
+    if (!cacheDbPromise) {
+        cacheDbPromise = new Promise((resolve, reject) => {
+            if (typeof indexedDB === 'undefined') {
+                reject(new Error('IndexedDB is not available'));
+                return;
+            }
+            const request = indexedDB.open(CACHE_DB_NAME, CACHE_DB_VERSION);
+            request.onupgradeneeded = () => {
+                const db = request.result;
+                const conversations = db.createObjectStore(CONVERSATIONS_STORE, { keyPath: 'id' });
+                conversations.createIndex('timestamp', 'timestamp');
+                db.createObjectStore(MESSAGES_STORE, { keyPath: ['conversationId', 'seq'] });
+                removeLegacyCache();
+            };
+            request.onsuccess = () => {
+                const db = request.result;
+                // Another tab upgrading the schema: step aside and reopen on next use
+                db.onversionchange = () => {
+                    db.close();
+                    cacheDbPromise = null;
+                };
+                resolve(db);
+            };
+            request.onerror = () => reject(request.error);
+            request.onblocked = () => reject(new Error('IndexedDB upgrade blocked by another tab'));
+        });
+        cacheDbPromise.catch(e => {
+            console.warn('Conversation cache unavailable:', e);
+        });
+    }
+    return cacheDbPromise;
+}
+
+function removeLegacyCache() {
     try {
-        const cacheData = {
-            messages: messages,
-            timestamp: Date.now()
-        };
-        localStorage.setItem(CACHE_PREFIX + conversationId, JSON.stringify(cacheData));
-        pruneCache();
+        Object.keys(localStorage)
+            .filter(k => k.startsWith(LEGACY_CACHE_PREFIX))
+            .forEach(k => localStorage.removeItem(k));
     } catch (e) {
-        console.warn('Cache write failed:', e);
+        console.warn('Legacy cache cleanup failed:', e);
     }
 }
 
-export function getCachedConversation(conversationId) {
-    try {
-        const cached = localStorage.getItem(CACHE_PREFIX + conversationId);
-        if (!cached) return null;
+// Run `work(stores)` in one transaction; resolves with its result once the transaction commits
+function withStores(mode, work) {
+    return openCacheDb()
+        .then(db => new Promise((resolve, reject) => {
+            const tx = db.transaction([CONVERSATIONS_STORE, MESSAGES_STORE], mode);
+            let result;
+            tx.oncomplete = () => resolve(result);
+            tx.onerror = () => reject(tx.error);
+            tx.onabort = () => reject(tx.error || new Error('Transaction aborted'));
+            result = work({
+                conversations: tx.objectStore(CONVERSATIONS_STORE),
+                messages: tx.objectStore(MESSAGES_STORE)
+            });
+        }));
+}
 
-        const data = JSON.parse(cached);
-        const age = Date.now() - data.timestamp;
+function messageRange(conversationId) {
+    return IDBKeyRange.bound([conversationId, 0], [conversationId, Infinity]);
+}
 
-        if (age > CACHE_EXPIRY_MS) {
-            localStorage.removeItem(CACHE_PREFIX + conversationId);
-            return null;
-        }
+function evictConversation(stores, conversationId) {
+    stores.conversations.delete(conversationId);
+    stores.messages.delete(messageRange(conversationId));
+}
 
-        return data.messages;
-    } catch (e) {
-        return null;
-    }
+// Evict the least recently written conversations beyond MAX_CACHE_SIZE, oldest first via the index
+function pruneCache(stores) {
+    const countRequest = stores.conversations.count();
+    countRequest.onsuccess = () => {
+        let excess = countRequest.result - MAX_CACHE_SIZE;
+        if (excess <= 0) return;
+        const cursorRequest = stores.conversations.index('timestamp').openKeyCursor();
+        cursorRequest.onsuccess = () => {
+            const cursor = cursorRequest.result;
+            if (!cursor || excess <= 0) return;
+            evictConversation(stores, cursor.primaryKey);
+            excess--;
+            cursor.continue();
+        };
+    };
 }
 
-export function updateConversationCache(conversationId, newMessages) {
-    const cached = getCachedConversation(conversationId);
-    if (cached) {
-        // If newMessages is an array, append it. If it's a single message object, wrap it.
-        const messagesToAdd = Array.isArray(newMessages) ? newMessages : [newMessages];
-        cacheConversation(conversationId, [...cached, ...messagesToAdd]);
-    }
+function putMessages(stores, conversationId, firstSeq, messages) {
+    messages.forEach((message, i) => {
+        stores.messages.put({ conversationId, seq: firstSeq + i, message });
+    });
 }
 
-export function clearConversationCache(conversationId) {
-    localStorage.removeItem(CACHE_PREFIX + conversationId);
+// `version` is the server version `messages` correspond to (null if unknown); `offset` is
+// the position of messages[0] in the full history
+export function cacheConversation(conversationId, messages, version = null, offset = 0) {
+    return withStores('readwrite', stores => {
+        stores.messages.delete(messageRange(conversationId));
+        putMessages(stores, conversationId, offset, messages);
+        stores.conversations.put({
+            id: conversationId,
+            offset,
+            count: offset + messages.length,
+            timestamp: Date.now(),
+            version,
+            baseCount: offset + messages.length
+        });
+        pruneCache(stores);
+    }).catch(e => {
+        console.warn('Cache write failed:', e);
+    });
 }
 
-function pruneCache() {
-    try {
-        // Keep cache size under control
-        const keys = Object.keys(localStorage)
-            .filter(k => k.startsWith(CACHE_PREFIX))
-            .map(k => ({
-                key: k,
-                data: JSON.parse(localStorage.getItem(k))
-            }))
-            .sort((a, b) => a.data.timestamp - b.data.timestamp);
+// Resolves with {messages, offset, version, baseCount} or null. messages[0] is message
+// number `offset`; up to position baseCount they are the server's state at `version`, any
+// after that were appended locally since.
+export function getCachedConversation(conversationId) {
+    let cached = null;
+    return withStores('readwrite', stores => {
+        const metaRequest = stores.conversations.get(conversationId);
+        metaRequest.onsuccess = () => {
+            const meta = metaRequest.result;
+            if (!meta) return;
+            if (Date.now() - meta.timestamp > CACHE_EXPIRY_MS) {
+                evictConversation(stores, conversationId);
+                return;
+            }
+            const rowsRequest = stores.messages.getAll(messageRange(conversationId));
+            rowsRequest.onsuccess = () => {
+                // Rows come back in key order, i.e. by seq
+                cached = {
+                    messages: rowsRequest.result.map(row => row.message),
+                    offset: meta.offset ?? 0,
+                    version: meta.version ?? null,
+                    baseCount: meta.baseCount ?? 0
+                };
+            };
+        };
+    })
+        .then(() => cached)
+        .catch(() => null);
+}
 
-        while (keys.length > MAX_CACHE_SIZE) {
-            localStorage.removeItem(keys.shift().key);
-        }
-    } catch (e) {
-        console.warn('Cache pruning failed:', e);
-    }
+export function updateConversationCache(conversationId, newMessages) {
+    // If newMessages is an array, append it. If it's a single message object, wrap it.
+    const messagesToAdd = Array.isArray(newMessages) ? newMessages : [newMessages];
+    return withStores('readwrite', stores => {
+        const metaRequest = stores.conversations.get(conversationId);
+        metaRequest.onsuccess = () => {
+            const meta = metaRequest.result;
+            // Only extend a cached, still-fresh history; a partial one would be wrong
+            if (!meta || Date.now() - meta.timestamp > CACHE_EXPIRY_MS) return;
+            putMessages(stores, conversationId, meta.count, messagesToAdd);
+            stores.conversations.put({
+                ...meta,
+                count: meta.count + messagesToAdd.length,
+                timestamp: Date.now()
+            });
+        };
+    }).catch(e => {
+        console.warn('Cache update failed:', e);
+    });
+}
+
+// Add older messages loaded on scroll-up in front of the cached ones
+export function prependCachedMessages(conversationId, messages, offset) {
+    return withStores('readwrite', stores => {
+        const metaRequest = stores.conversations.get(conversationId);
+        metaRequest.onsuccess = () => {
+            const meta = metaRequest.result;
+            // Only if they are contiguous with what is cached
+            if (!meta || (meta.offset ?? 0) !== offset + messages.length) return;
+            putMessages(stores, conversationId, offset, messages);
+            stores.conversations.put({ ...meta, offset });
+        };
+    }).catch(e => {
+        console.warn('Cache update failed:', e);
+    });
+}
+
+export function clearConversationCache(conversationId) {
+    return withStores('readwrite', stores => {
+        evictConversation(stores, conversationId);
+    }).catch(e => {
+        console.warn('Cache clear failed:', e);
+    });
 }
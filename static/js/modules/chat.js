@@ -3,6 +3,7 @@ import { getCachedElement, showAlert, showCodeModal, hideAllSelectors, hideSideb
 import { fetchWithCode, cancelStream } from './api.js';
 import { updateConversationCache } from './cache.js';
 import { renderMath, convertSquareBracketMath, safeCopy, markdownToPlain, extractSources, linkifyReferences } from './utils.js';
+import { createStreamRenderer, createTextStreamer } from './stream_render.js';
 
 let currentStreamReader = null;
 let isStreaming = false;
@@ -125,9 +126,11 @@ export function sendMessage(currentImageData, currentConversationId, setCurrentC
             // Create a new assistant message for streaming
             const assistantMessageDiv = addMessage('assistant', '', 'streaming');
             let fullResponse = '';
-            let fullThinking = '';
             let hasReceivedFirstChunk = false;
             let thinkingBlock = null;
+            let thinkingStreamer = null;
+            let responseRenderer = null;
+            const scrollToLatest = () => smoothScrollToBottom(document.getElementById('chatMessages'), false);
 
             const reader = response.body.getReader();
             currentStreamReader = reader;
@@ -156,7 +159,7 @@ export function sendMessage(currentImageData, currentConversationId, setCurrentC
                         isStreaming = false;
                         userScrolledUp = false;
                         currentStreamReader = null;
-                        setTimeout(enhanceAllAssistantMessagesWithCopy, 0);
+                        setTimeout(() => enhanceMessageWithCopy(assistantMessageDiv.querySelector('.message-content')), 0);
                         return;
                     }
 
@@ -191,9 +194,17 @@ export function sendMessage(currentImageData, currentConversationId, setCurrentC
                                     currentStreamReader = null;
                                     addMessage('assistant', `Error: ${data.error}`, 'error');
                                     return;
+                                } else if (data.type === 'queued') {
+                                    // Waiting for an upstream slot: show the queue position until content arrives
+                                    const messageContent = assistantMessageDiv.querySelector('.message-content');
+                                    if (messageContent && !hasReceivedFirstChunk && !thinkingBlock) {
+                                        messageContent.innerHTML = `<span class="queued-indicator"><i class="fas fa-hourglass-half"></i> Waiting in queue (position ${data.position})...</span>`;
+                                    }
                                 } else if (data.type === 'thinking' && data.chunk !== undefined) {
                                     // Handle thinking content separately
                                     if (!thinkingBlock) {
+                                        const queuedIndicator = assistantMessageDiv.querySelector('.queued-indicator');
+                                        if (queuedIndicator) queuedIndicator.remove();
                                         // Create thinking section before main content
                                         thinkingBlock = document.createElement('div');
                                         thinkingBlock.className = 'thinking-block';
@@ -209,61 +220,41 @@ export function sendMessage(currentImageData, currentConversationId, setCurrentC
                                         thinkingBlock.appendChild(thinkingContent);
 
                                         assistantMessageDiv.querySelector('.message-content').prepend(thinkingBlock);
+                                        thinkingStreamer = createTextStreamer(thinkingContent, scrollToLatest);
                                     }
 
-                                    fullThinking += data.chunk;
-                                    const thinkingContent = thinkingBlock.querySelector('.thinking-content');
-                                    if (thinkingContent) {
-                                        thinkingContent.textContent = fullThinking;
-                                        smoothScrollToBottom(document.getElementById('chatMessages'), false);
-                                    }
+                                    thinkingStreamer.append(data.chunk);
                                 } else if (data.type === 'content' && data.chunk !== undefined) {
                                     // Handle regular content
                                     if (!hasReceivedFirstChunk) {
                                         hasReceivedFirstChunk = true;
+                                        const queuedIndicator = assistantMessageDiv.querySelector('.queued-indicator');
+                                        if (queuedIndicator) queuedIndicator.remove();
                                     }
 
                                     fullResponse += data.chunk;
                                     const messageContent = assistantMessageDiv.querySelector('.message-content');
 
                                     if (messageContent) {
-                                        if (window._parseTimeout) {
-                                            cancelAnimationFrame(window._parseTimeout);
+                                        if (!responseRenderer) {
+                                            // Response goes after the thinking block; rendered incrementally, once per frame
+                                            const responseDiv = document.createElement('div');
+                                            responseDiv.className = 'response-content';
+                                            messageContent.appendChild(responseDiv);
+                                            responseRenderer = createStreamRenderer(responseDiv, scrollToLatest);
                                         }
-
-                                        window._parseTimeout = requestAnimationFrame(() => {
-                                            // Create or update the response div after thinking
-                                            let responseDiv = messageContent.querySelector('.response-content');
-                                            if (!responseDiv) {
-                                                responseDiv = document.createElement('div');
-                                                responseDiv.className = 'response-content';
-                                                messageContent.appendChild(responseDiv);
-                                            }
-                                            responseDiv.innerHTML = marked.parse(convertSquareBracketMath(fullResponse));
-                                            renderMath(responseDiv);
-                                            smoothScrollToBottom(document.getElementById('chatMessages'), false);
-                                        });
+                                        responseRenderer.append(data.chunk);
                                     }
                                 } else if (data.type === 'done' && data.done) {
                                     if (data.conversation_id && !currentConversationId) {
                                         setCurrentConversationIdCallback(data.conversation_id);
                                     }
 
-                                    if (window._parseTimeout) {
-                                        cancelAnimationFrame(window._parseTimeout);
-                                        window._parseTimeout = null;
-                                    }
+                                    if (thinkingStreamer) thinkingStreamer.finish();
 
                                     const messageContent = assistantMessageDiv.querySelector('.message-content');
-                                    if (messageContent && fullResponse) {
-                                        let responseDiv = messageContent.querySelector('.response-content');
-                                        if (!responseDiv) {
-                                            responseDiv = document.createElement('div');
-                                            responseDiv.className = 'response-content';
-                                            messageContent.appendChild(responseDiv);
-                                        }
-                                        responseDiv.innerHTML = marked.parse(convertSquareBracketMath(fullResponse));
-                                        renderMath(responseDiv);
+                                    if (messageContent && fullResponse && responseRenderer) {
+                                        responseRenderer.finish();
 
                                         // Update the raw markdown data attribute for copy buttons
                                         assistantMessageDiv.setAttribute('data-raw-markdown', fullResponse);
@@ -285,82 +276,8 @@ export function sendMessage(currentImageData, currentConversationId, setCurrentC
                                     userScrolledUp = false;
                                     currentStreamReader = null;
 
-                                    // Add copy buttons to the just-finished message (only the last one for efficiency)
-                                    setTimeout(() => {
-                                        const allAssistantMessages = document.querySelectorAll('.message.assistant .message-content');
-                                        if (allAssistantMessages.length > 0) {
-                                            const last = allAssistantMessages[allAssistantMessages.length - 1];
-                                            // Enhance only the last message
-                                            if (!last.querySelector('.copy-btn-bar')) {
-                                                // (reuse the logic from enhanceAllAssistantMessagesWithCopy for a single message)
-                                                // Get raw markdown from the parent message element's data attribute
-                                                const parentMessage = last.closest('.message');
-                                                let rawMarkdown = parentMessage ? parentMessage.getAttribute('data-raw-markdown') : fullResponse;
-                                                const codeBlocks = last.querySelectorAll('pre > code');
-                                                codeBlocks.forEach((codeBlock, idx) => {
-                                                    const pre = codeBlock.parentElement;
-                                                    if (pre.querySelector('.copy-code-btn')) return;
-                                                    const btn = document.createElement('button');
-                                                    btn.className = 'copy-code-btn btn';
-                                                    btn.title = 'Copy code';
-                                                    btn.innerHTML = '<i class="fas fa-copy"></i>';
-                                                    btn.onclick = function (e) {
-                                                        e.stopPropagation();
-                                                        safeCopy(codeBlock.textContent)
-                                                            .then(() => {
-                                                                btn.classList.add('copied');
-                                                                setTimeout(() => { btn.classList.remove('copied'); }, 1200);
-                                                            })
-                                                            .catch(() => {
-                                                                showAlert('Failed to copy code to clipboard. Please try manually.');
-                                                            });
-                                                    };
-                                                    pre.style.position = 'relative';
-                                                    btn.style.position = 'absolute';
-                                                    btn.style.top = '8px';
-                                                    btn.style.right = '8px';
-                                                    btn.style.zIndex = '2';
-                                                    pre.appendChild(btn);
-                                                });
-                                                const copyBtns = document.createElement('div');
-                                                copyBtns.className = 'copy-btn-bar copy-btn-bar-bottom';
-                                                const markdownBtn = document.createElement('button');
-                                                markdownBtn.className = 'copy-markdown-btn btn';
-                                                markdownBtn.title = 'Copy Markdown';
-                                                markdownBtn.innerHTML = '<i class="fas fa-copy"></i>';
-                                                const plainBtn = document.createElement('button');
-                                                plainBtn.className = 'copy-plain-btn btn';
-                                                plainBtn.title = 'Copy Plain Text';
-                                                plainBtn.innerHTML = '<i class="fas fa-file-alt"></i>';
-                                                copyBtns.appendChild(markdownBtn);
-                                                copyBtns.appendChild(plainBtn);
-                                                last.appendChild(copyBtns);
-                                                markdownBtn.onclick = function (e) {
-                                                    e.stopPropagation();
-                                                    safeCopy(rawMarkdown)
-                                                        .then(() => {
-                                                            markdownBtn.classList.add('copied');
-                                                            setTimeout(() => { markdownBtn.classList.remove('copied'); }, 1200);
-                                                        })
-                                                        .catch(() => {
-                                                            showAlert('Failed to copy markdown to clipboard. Please try manually.');
-                                                        });
-                                                };
-                                                plainBtn.onclick = function (e) {
-                                                    e.stopPropagation();
-                                                    const plain = markdownToPlain(rawMarkdown);
-                                                    safeCopy(plain)
-                                                        .then(() => {
-                                                            plainBtn.classList.add('copied');
-                                                            setTimeout(() => { plainBtn.classList.remove('copied'); }, 1200);
-                                                        })
-                                                        .catch(() => {
-                                                            showAlert('Failed to copy text to clipboard. Please try manually.');
-                                                        });
-                                                };
-                                            }
-                                        }
-                                    }, 0);
+                                    // Add copy buttons to the just-finished message only
+                                    setTimeout(() => enhanceMessageWithCopy(assistantMessageDiv.querySelector('.message-content')), 0);
                                     return;
                                 }
                             } catch (e) {
@@ -393,8 +310,8 @@ export function sendMessage(currentImageData, currentConversationId, setCurrentC
         });
 }
 
-export function addMessage(sender, content, type = 'normal', imageData = null) {
-    const messagesContainer = getCachedElement('chatMessages');
+// Build a message element without inserting it; copy buttons work through initMessageActions
+export function buildMessageElement(sender, content, type = 'normal', imageData = null) {
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${sender}`;
 
@@ -424,30 +341,7 @@ export function addMessage(sender, content, type = 'normal', imageData = null) {
         const tempDiv = document.createElement('div');
         tempDiv.innerHTML = htmlContent;
         const codeBlocks = tempDiv.querySelectorAll('pre > code');
-        codeBlocks.forEach((codeBlock, idx) => {
-            const pre = codeBlock.parentElement;
-            const btn = document.createElement('button');
-            btn.className = 'copy-code-btn btn';
-            btn.title = 'Copy code';
-            btn.innerHTML = '<i class="fas fa-copy"></i>';
-            btn.onclick = function (e) {
-                e.stopPropagation();
-                safeCopy(codeBlock.textContent)
-                    .then(() => {
-                        btn.classList.add('copied');
-                        setTimeout(() => { btn.classList.remove('copied'); }, 1200);
-                    })
-                    .catch(() => {
-                        showAlert('Failed to copy code to clipboard. Please try manually.');
-                    });
-            };
-            pre.style.position = 'relative';
-            btn.style.position = 'absolute';
-            btn.style.top = '8px';
-            btn.style.right = '8px';
-            btn.style.zIndex = '2';
-            pre.appendChild(btn);
-        });
+        codeBlocks.forEach(codeBlock => addCodeCopyButton(codeBlock.parentElement));
         // Copy bar at the end (bottom right) of the message
         let copyBtns = `<div class="copy-btn-bar copy-btn-bar-bottom">
             <button class="copy-markdown-btn btn" title="Copy Markdown"><i class="fas fa-copy"></i></button>
@@ -511,6 +405,17 @@ export function addMessage(sender, content, type = 'normal', imageData = null) {
             messageDiv.setAttribute('data-raw-markdown', rawMarkdown || '');
         } catch (e) { /* ignore */ }
     }
+    return messageDiv;
+}
+
+// Conversation history entry ({role, content}) as a message element
+export function renderHistoryMessage(msg) {
+    return buildMessageElement(msg.role === 'user' ? 'user' : 'assistant', msg.content);
+}
+
+export function addMessage(sender, content, type = 'normal', imageData = null) {
+    const messagesContainer = getCachedElement('chatMessages');
+    const messageDiv = buildMessageElement(sender, content, type, imageData);
     messagesContainer.appendChild(messageDiv);
 
     // Add entrance animation
@@ -541,44 +446,6 @@ export function addMessage(sender, content, type = 'normal', imageData = null) {
         }
     }
 
-    // Add copy markdown/plain event listeners for assistant messages
-    if (sender === 'assistant' && type !== 'error' && type !== 'success') {
-        const markdownBtn = messageDiv.querySelector('.copy-markdown-btn');
-        const plainBtn = messageDiv.querySelector('.copy-plain-btn');
-        if (markdownBtn) {
-            markdownBtn.onclick = function (e) {
-                e.stopPropagation();
-                // Get raw markdown from data attribute, fallback to local variable
-                const markdownToCopy = messageDiv.getAttribute('data-raw-markdown') || rawMarkdown;
-                safeCopy(markdownToCopy)
-                    .then(() => {
-                        markdownBtn.classList.add('copied');
-                        setTimeout(() => { markdownBtn.classList.remove('copied'); }, 1200);
-                    })
-                    .catch(() => {
-                        showAlert('Failed to copy markdown to clipboard. Please try manually.');
-                    });
-            };
-        }
-        if (plainBtn) {
-            plainBtn.onclick = function (e) {
-                e.stopPropagation();
-                // Get raw markdown from data attribute, fallback to local variable
-                const markdownToCopy = messageDiv.getAttribute('data-raw-markdown') || rawMarkdown;
-                // Convert markdown to plain text safely
-                const plain = markdownToPlain(markdownToCopy);
-                safeCopy(plain)
-                    .then(() => {
-                        plainBtn.classList.add('copied');
-                        setTimeout(() => { plainBtn.classList.remove('copied'); }, 1200);
-                    })
-                    .catch(() => {
-                        showAlert('Failed to copy text to clipboard. Please try manually.');
-                    });
-            };
-        }
-    }
-
     // Auto-remove success messages after 3 seconds
     if (type === 'success') {
         setTimeout(() => {
@@ -689,85 +556,76 @@ export function initScrollMonitoring() {
     });
 }
 
+function addCodeCopyButton(pre) {
+    if (pre.querySelector('.copy-code-btn')) return;
+    const btn = document.createElement('button');
+    btn.className = 'copy-code-btn btn';
+    btn.title = 'Copy code';
+    btn.innerHTML = '<i class="fas fa-copy"></i>';
+    pre.style.position = 'relative';
+    btn.style.position = 'absolute';
+    btn.style.top = '8px';
+    btn.style.right = '8px';
+    btn.style.zIndex = '2';
+    pre.appendChild(btn);
+}
+
+// Add code copy buttons and the copy bar to one assistant message's content
+export function enhanceMessageWithCopy(msgContent) {
+    if (!msgContent) return;
+    msgContent.querySelectorAll('pre > code').forEach(codeBlock => addCodeCopyButton(codeBlock.parentElement));
+    // Avoid double-enhancing
+    if (msgContent.querySelector('.copy-btn-bar')) return;
+    // Add copy markdown and plain text buttons at the bottom right
+    const copyBtns = document.createElement('div');
+    copyBtns.className = 'copy-btn-bar copy-btn-bar-bottom';
+    copyBtns.innerHTML = `<button class="copy-markdown-btn btn" title="Copy Markdown"><i class="fas fa-copy"></i></button>
+        <button class="copy-plain-btn btn" title="Copy Plain Text"><i class="fas fa-file-alt"></i></button>`;
+    msgContent.appendChild(copyBtns);
+}
+
 export function enhanceAllAssistantMessagesWithCopy() {
-    const assistantMessages = document.querySelectorAll('.message.assistant .message-content');
-    assistantMessages.forEach(msgContent => {
-        // Avoid double-enhancing
-        if (msgContent.querySelector('.copy-btn-bar')) return;
-        // Get the raw markdown from a data attribute if present, else try to reconstruct
-        let rawMarkdown = '';
-        const parentMsg = msgContent.closest('.message');
-        if (parentMsg && parentMsg.getAttribute('data-raw-markdown')) {
-            rawMarkdown = parentMsg.getAttribute('data-raw-markdown');
+    document.querySelectorAll('.message.assistant .message-content').forEach(enhanceMessageWithCopy);
+}
+
+// One delegated listener serves every copy button, including those in message HTML
+// re-created by the virtualized message list
+export function initMessageActions() {
+    const chatMessages = document.getElementById('chatMessages');
+    if (!chatMessages) return;
+
+    chatMessages.addEventListener('click', function (e) {
+        const btn = e.target.closest('.copy-code-btn, .copy-markdown-btn, .copy-plain-btn');
+        if (!btn || !chatMessages.contains(btn)) return;
+        e.stopPropagation();
+
+        let text;
+        let failure;
+        if (btn.classList.contains('copy-code-btn')) {
+            const codeBlock = btn.closest('pre').querySelector('code');
+            text = codeBlock ? codeBlock.textContent : '';
+            failure = 'Failed to copy code to clipboard. Please try manually.';
         } else {
-            rawMarkdown = msgContent.textContent || '';
+            // Raw markdown from the message's data attribute, else the rendered text
+            const parentMsg = btn.closest('.message');
+            const msgContent = btn.closest('.message-content');
+            const rawMarkdown = (parentMsg && parentMsg.getAttribute('data-raw-markdown')) || (msgContent ? msgContent.textContent : '');
+            if (btn.classList.contains('copy-markdown-btn')) {
+                text = rawMarkdown;
+                failure = 'Failed to copy markdown to clipboard. Please try manually.';
+            } else {
+                // Convert markdown to plain text safely
+                text = markdownToPlain(rawMarkdown);
+                failure = 'Failed to copy text to clipboard. Please try manually.';
+            }
         }
-        // Try to get the markdown from a hidden element if you store it, else fallback to textContent
-        // Add copy code buttons to code blocks
-        const codeBlocks = msgContent.querySelectorAll('pre > code');
-        codeBlocks.forEach((codeBlock, idx) => {
-            const pre = codeBlock.parentElement;
-            if (pre.querySelector('.copy-code-btn')) return;
-            const btn = document.createElement('button');
-            btn.className = 'copy-code-btn btn';
-            btn.title = 'Copy code';
-            btn.innerHTML = '<i class="fas fa-copy"></i>';
-            btn.onclick = function (e) {
-                e.stopPropagation();
-                safeCopy(codeBlock.textContent)
-                    .then(() => {
-                        btn.classList.add('copied');
-                        setTimeout(() => { btn.classList.remove('copied'); }, 1200);
-                    })
-                    .catch(() => {
-                        showAlert('Failed to copy code to clipboard. Please try manually.');
-                    });
-            };
-            pre.style.position = 'relative';
-            btn.style.position = 'absolute';
-            btn.style.top = '8px';
-            btn.style.right = '8px';
-            btn.style.zIndex = '2';
-            pre.appendChild(btn);
-        });
-        // Add copy markdown and plain text buttons at the bottom right
-        const copyBtns = document.createElement('div');
-        copyBtns.className = 'copy-btn-bar copy-btn-bar-bottom';
-        const markdownBtn = document.createElement('button');
-        markdownBtn.className = 'copy-markdown-btn btn';
-        markdownBtn.title = 'Copy Markdown';
-        markdownBtn.innerHTML = '<i class="fas fa-copy"></i>';
-        const plainBtn = document.createElement('button');
-        plainBtn.className = 'copy-plain-btn btn';
-        plainBtn.title = 'Copy Plain Text';
-        plainBtn.innerHTML = '<i class="fas fa-file-alt"></i>';
-        copyBtns.appendChild(markdownBtn);
-        copyBtns.appendChild(plainBtn);
-        msgContent.appendChild(copyBtns);
-        // Markdown copy: fallback to textContent if no raw markdown
-        markdownBtn.onclick = function (e) {
-            e.stopPropagation();
-            safeCopy(rawMarkdown)
-                .then(() => {
-                    markdownBtn.classList.add('copied');
-                    setTimeout(() => { markdownBtn.classList.remove('copied'); }, 1200);
-                })
-                .catch(() => {
-                    showAlert('Failed to copy markdown to clipboard. Please try manually.');
-                });
-        };
-        plainBtn.onclick = function (e) {
-            e.stopPropagation();
-            // Convert markdown to plain text safely
-            const plain = markdownToPlain(rawMarkdown);
-            safeCopy(plain)
-                .then(() => {
-                    plainBtn.classList.add('copied');
-                    setTimeout(() => { plainBtn.classList.remove('copied'); }, 1200);
-                })
-                .catch(() => {
-                    showAlert('Failed to copy text to clipboard. Please try manually.');
-                });
-        };
+        safeCopy(text)
+            .then(() => {
+                btn.classList.add('copied');
+                setTimeout(() => { btn.classList.remove('copied'); }, 1200);
+            })
+            .catch(() => {
+                showAlert(failure);
+            });
     });
 }
@@ -366,6 +366,12 @@ export function uploadDocument(currentConversationId, providedFile = null) {
                 });
 
                 messageInput.parentElement.appendChild(indicator);
+
+                // Extraction runs in the background; track it until the document is ready
+                if (data.job_id && data.status !== 'done' && labelEl) {
+                    labelEl.textContent = `${data.filename} processing...`;
+                    pollDocumentJob(data.job_id, data.filename, indicator, labelEl);
+                }
             } else {
                 addMessage('assistant', `Error uploading document: ${data.error}`, 'error');
                 hideDocumentUpload();
@@ -395,6 +401,41 @@ export function uploadDocument(currentConversationId, providedFile = null) {
         });
 }
 
+const DOCUMENT_POLL_INTERVAL = 1000;
+
+function pollDocumentJob(jobId, filename, indicator, labelEl) {
+    fetch(`/upload_document/status/${encodeURIComponent(jobId)}`)
+        .then(response => response.json().then(data => ({ ok: response.ok, httpStatus: response.status, data })))
+        .then(({ ok, httpStatus, data }) => {
+            // Indicator removed or replaced by another upload: stop tracking this job
+            if (!indicator.isConnected) return;
+            if (!ok && httpStatus !== 404) {
+                // Transient server error (overload, restarting worker): keep polling
+                setTimeout(() => pollDocumentJob(jobId, filename, indicator, labelEl), DOCUMENT_POLL_INTERVAL * 3);
+                return;
+            }
+            if (!ok || data.status === 'error') {
+                addMessage('assistant', `Error processing document: ${data.error || 'Unknown error'}`, 'error');
+                indicator.remove();
+                return;
+            }
+            if (data.status === 'done') {
+                labelEl.textContent = `${filename} loaded (click to remove)`;
+                return;
+            }
+            labelEl.textContent = data.pages_total
+                ? `${filename} processing (${data.pages_done}/${data.pages_total} pages)...`
+                : `${filename} processing...`;
+            setTimeout(() => pollDocumentJob(jobId, filename, indicator, labelEl), DOCUMENT_POLL_INTERVAL);
+        })
+        .catch(error => {
+            console.error('Document status error:', error);
+            if (indicator.isConnected) {
+                setTimeout(() => pollDocumentJob(jobId, filename, indicator, labelEl), DOCUMENT_POLL_INTERVAL * 3);
+            }
+        });
+}
+
 export function initUploadDropzones(getImageDataCallback, getConversationId) {
     const imageFileInput = document.getElementById('imageFile');
     const imageDropzone = document.getElementById('imageDropzone');
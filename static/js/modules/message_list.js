@@ -0,0 +1,220 @@
+// Windowed rendering of conversation history: only messages near the viewport are in the DOM
+const OVERSCAN_PX = 1200;              // rendered beyond each edge of the viewport
+const ESTIMATED_MESSAGE_HEIGHT = 120;  // used until a message has been measured
+const LOAD_OLDER_THRESHOLD_PX = 600;   // distance from the top that triggers loading older messages
+
+/**
+ * Show `messages` in `container` (the scrolling element), keeping only the messages within
+ * OVERSCAN_PX of the viewport mounted; spacers stand in for the rest.
+ *
+ * renderMessage(message) builds a message element once; its HTML is cached so scrolling
+ * back re-creates it without running markdown, math or copy-button setup again. Messages
+ * added later with addMessage() are appended after the list and are not virtualized.
+ *
+ * loadOlder() is called when the user nears the top while hasOlder is set, and resolves
+ * with {messages, hasOlder} for the messages preceding the current first one.
+ */
+export function createMessageList(container, renderMessage, { messages = [], hasOlder = false, loadOlder = null } = {}) {
+    const topSpacer = document.createElement('div');
+    const bottomSpacer = document.createElement('div');
+    topSpacer.className = 'message-list-spacer';
+    bottomSpacer.className = 'message-list-spacer';
+    container.append(topSpacer, bottomSpacer);
+
+    let entries = [];          // {message, html, height}
+    let mounted = new Map();   // entry index -> element, in document order
+    let rangeStart = 0;        // mounted entries are [rangeStart, rangeEnd)
+    let rangeEnd = 0;
+    let messageGap = null;     // vertical margin between messages, read once
+    let frame = null;
+    let loadingOlder = false;
+    let destroyed = false;
+
+    const toEntry = message => ({ message, html: null, height: null });
+
+    function elementFor(index) {
+        const entry = entries[index];
+        let element;
+        if (entry.html === null) {
+            element = renderMessage(entry.message);
+            entry.html = element.outerHTML;
+        } else {
+            const template = document.createElement('template');
+            template.innerHTML = entry.html;
+            element = template.content.firstElementChild;
+        }
+        // Re-mounting while scrolling must not replay the entrance animation
+        element.classList.add('message-list-item');
+        return element;
+    }
+
+    function measure(element) {
+        if (messageGap === null) messageGap = parseFloat(getComputedStyle(element).marginBottom) || 0;
+        return element.offsetHeight + messageGap;
+    }
+
+    function heightOf(index) {
+        return entries[index].height ?? ESTIMATED_MESSAGE_HEIGHT;
+    }
+
+    function heightBetween(start, end) {
+        let total = 0;
+        for (let i = start; i < end; i++) total += heightOf(i);
+        return total;
+    }
+
+    // Top of the list in the container's scroll coordinates
+    function listTop() {
+        return topSpacer.getBoundingClientRect().top - container.getBoundingClientRect().top + container.scrollTop;
+    }
+
+    function visibleRange() {
+        const top = container.scrollTop - listTop() - OVERSCAN_PX;
+        const bottom = container.scrollTop - listTop() + container.clientHeight + OVERSCAN_PX;
+        let start = entries.length;
+        let end = entries.length;
+        let y = 0;
+        for (let i = 0; i < entries.length; i++) {
+            const next = y + heightOf(i);
+            if (start === entries.length && next > top) start = i;
+            if (y >= bottom) {
+                end = i;
+                break;
+            }
+            y = next;
+        }
+        return [Math.min(start, end), end];
+    }
+
+    // Run `change` while keeping a message that stays mounted at the same place on screen
+    function keepingScrollPosition(change, stays = () => true) {
+        let anchor = null;
+        let anchorTop = 0;
+        for (const [index, element] of mounted) {
+            if (stays(index)) {
+                anchor = element;
+                anchorTop = element.getBoundingClientRect().top;
+                break;
+            }
+        }
+        change();
+        if (anchor && anchor.isConnected) {
+            const shift = anchor.getBoundingClientRect().top - anchorTop;
+            if (shift) container.scrollTop += shift;
+        }
+    }
+
+    function update() {
+        frame = null;
+        if (destroyed) return;
+        const [start, end] = visibleRange();
+        keepingScrollPosition(() => {
+            for (const [index, element] of mounted) {
+                if (index < start || index >= end) {
+                    entries[index].height = measure(element);
+                    element.remove();
+                    mounted.delete(index);
+                }
+            }
+            let next = bottomSpacer;
+            for (let i = end - 1; i >= start; i--) {
+                if (!mounted.has(i)) {
+                    const element = elementFor(i);
+                    container.insertBefore(element, next);
+                    mounted.set(i, element);
+                }
+                next = mounted.get(i);
+            }
+            // Keep the map in document order so the first entry is the topmost element
+            mounted = new Map([...mounted.entries()].sort((a, b) => a[0] - b[0]));
+            for (const [index, element] of mounted) entries[index].height = measure(element);
+            rangeStart = start;
+            rangeEnd = end;
+            topSpacer.style.height = `${heightBetween(0, start)}px`;
+            bottomSpacer.style.height = `${heightBetween(end, entries.length)}px`;
+        }, index => index >= start && index < end);
+        maybeLoadOlder();
+    }
+
+    function schedule() {
+        if (frame === null && !destroyed) frame = requestAnimationFrame(update);
+    }
+
+    function maybeLoadOlder() {
+        if (!hasOlder || !loadOlder || loadingOlder) return;
+        if (container.scrollTop - listTop() > LOAD_OLDER_THRESHOLD_PX) return;
+        loadingOlder = true;
+        loadOlder()
+            .then(result => {
+                if (destroyed || !result) return;
+                hasOlder = !!result.hasOlder;
+                prepend(result.messages || []);
+            })
+            .catch(e => {
+                console.warn('Failed to load older messages:', e);
+            })
+            .finally(() => {
+                loadingOlder = false;
+            });
+    }
+
+    function prepend(older) {
+        if (!older.length) return;
+        keepingScrollPosition(() => {
+            entries = older.map(toEntry).concat(entries);
+            mounted = new Map([...mounted.entries()].map(([index, element]) => [index + older.length, element]));
+            rangeStart += older.length;
+            rangeEnd += older.length;
+            topSpacer.style.height = `${heightBetween(0, rangeStart)}px`;
+        });
+        schedule();
+    }
+
+    function reset(newMessages) {
+        mounted.forEach(element => element.remove());
+        mounted = new Map();
+        entries = newMessages.map(toEntry);
+        rangeStart = rangeEnd = entries.length;
+        // Start at the bottom, where a conversation is read from, without rendering the top first
+        topSpacer.style.height = `${heightBetween(0, entries.length)}px`;
+        bottomSpacer.style.height = '0px';
+        container.scrollTop = container.scrollHeight;
+        update();
+        container.scrollTop = container.scrollHeight;
+    }
+
+    function onResize() {
+        // Wrapping changes with the width; mounted messages are re-measured on update
+        entries.forEach(entry => { entry.height = null; });
+        schedule();
+    }
+
+    container.addEventListener('scroll', schedule, { passive: true });
+    window.addEventListener('resize', onResize);
+    reset(messages);
+
+    return {
+        get length() {
+            return entries.length;
+        },
+        append(newMessages) {
+            entries = entries.concat(newMessages.map(toEntry));
+            bottomSpacer.style.height = `${heightBetween(rangeEnd, entries.length)}px`;
+            schedule();
+        },
+        // Replace everything, e.g. when the server's history differs from the cached one
+        replace(newMessages, newHasOlder = false) {
+            hasOlder = newHasOlder;
+            reset(newMessages);
+        },
+        destroy() {
+            destroyed = true;
+            if (frame !== null) cancelAnimationFrame(frame);
+            container.removeEventListener('scroll', schedule);
+            window.removeEventListener('resize', onResize);
+            mounted.forEach(element => element.remove());
+            topSpacer.remove();
+            bottomSpacer.remove();
+        }
+    };
+}
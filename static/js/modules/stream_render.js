@@ -0,0 +1,143 @@
+// Incremental rendering of streamed markdown
+import { renderMath, convertSquareBracketMath } from './utils.js';
+
+const FENCE_OPEN = /^ {0,3}(`{3,}|~{3,})/;
+const LIST_ITEM = /^ {0,3}([-*+]|\d+[.)])\s/;
+// A line after a blank line that may still belong to the block above (indented
+// continuations, block quotes), so the block is not split there
+const BLOCK_CONTINUATION = /^(\s|>)/;
+
+function isFenceClose(line, fence) {
+    const match = /^ {0,3}(`{3,}|~{3,})\s*$/.exec(line);
+    return !!match && match[1][0] === fence[0] && match[1].length >= fence.length;
+}
+
+function opensMathBlock(trimmed) {
+    if (trimmed.startsWith('$$')) return !(trimmed.length > 2 && trimmed.endsWith('$$'));
+    if (trimmed.startsWith('\\[')) return !trimmed.includes('\\]');
+    return false;
+}
+
+// Offset in `text` up to which every markdown block is complete: the start of the last
+// top-level block that follows a blank line and is not inside a code fence or math block.
+// Only complete lines are considered; the line being streamed can't be classified yet.
+export function findStableBoundary(text) {
+    let boundary = 0;
+    let fence = null;
+    let inMath = false;
+    let prevBlank = true;
+    let inList = false;
+    let pos = 0;
+    while (pos < text.length) {
+        const end = text.indexOf('\n', pos);
+        if (end === -1) break;
+        const line = text.slice(pos, end);
+        const trimmed = line.trim();
+        const blank = trimmed === '';
+
+        if (fence) {
+            if (isFenceClose(line, fence)) fence = null;
+        } else if (inMath) {
+            if (trimmed.includes('$$') || trimmed.includes('\\]')) inMath = false;
+        } else {
+            const listItem = LIST_ITEM.test(line);
+            // Items of a loose list stay together so numbering and spacing match a full parse
+            if (prevBlank && !blank && !(listItem ? inList : BLOCK_CONTINUATION.test(line))) boundary = pos;
+            if (listItem) {
+                inList = true;
+            } else if (prevBlank && !blank && !BLOCK_CONTINUATION.test(line)) {
+                inList = false;
+            }
+            const open = FENCE_OPEN.exec(line);
+            if (open) {
+                fence = open[1];
+            } else if (opensMathBlock(trimmed)) {
+                inMath = true;
+            }
+        }
+        prevBlank = blank && !fence && !inMath;
+        pos = end + 1;
+    }
+    return boundary;
+}
+
+/**
+ * Render a growing markdown document into `container` without re-parsing all of it.
+ *
+ * Completed blocks are parsed once and appended; only the trailing, still-growing block
+ * is re-parsed, at most once per animation frame. Reference-style link definitions only
+ * resolve within their own block, which streamed model output does not rely on.
+ */
+export function createStreamRenderer(container, onFrame = null) {
+    let source = '';
+    let committed = 0; // source offset of the first block not yet finalized
+    let tailNodes = [];
+    let frame = null;
+
+    function renderBlocks(markdown) {
+        const staging = document.createElement('div');
+        staging.innerHTML = marked.parse(convertSquareBracketMath(markdown));
+        const nodes = Array.from(staging.childNodes);
+        container.append(...nodes);
+        nodes.forEach(node => {
+            if (node.nodeType === Node.ELEMENT_NODE) renderMath(node);
+        });
+        return nodes;
+    }
+
+    function flush() {
+        frame = null;
+        tailNodes.forEach(node => node.remove());
+        const boundary = findStableBoundary(source.slice(committed));
+        if (boundary > 0) {
+            renderBlocks(source.slice(committed, committed + boundary));
+            committed += boundary;
+        }
+        tailNodes = renderBlocks(source.slice(committed));
+        if (onFrame) onFrame();
+    }
+
+    return {
+        append(chunk) {
+            source += chunk;
+            if (frame === null) frame = requestAnimationFrame(flush);
+        },
+        // Render whatever is pending right away; returns the full markdown
+        finish() {
+            if (frame !== null) cancelAnimationFrame(frame);
+            flush();
+            return source;
+        },
+        get text() {
+            return source;
+        }
+    };
+}
+
+// Append streamed plain text to `element` once per animation frame
+export function createTextStreamer(element, onFrame = null) {
+    const textNode = document.createTextNode('');
+    let pending = '';
+    let frame = null;
+    element.appendChild(textNode);
+
+    function flush() {
+        frame = null;
+        textNode.appendData(pending);
+        pending = '';
+        if (onFrame) onFrame();
+    }
+
+    return {
+        append(chunk) {
+            pending += chunk;
+            if (frame === null) frame = requestAnimationFrame(flush);
+        },
+        finish() {
+            if (frame !== null) {
+                cancelAnimationFrame(frame);
+                flush();
+            }
+        }
+    };
+}
@@ -0,0 +1,24 @@
+from document_index import (
+    CHUNK_TARGET_CHARS, DOCUMENT_CONTEXT_TOKENS, BM25Index, chunk_document, select_chunks
+)
+
+
+def test_single_long_line_is_split_within_budget():
+    # One DOCX paragraph / PDF page with no line breaks, larger than the whole excerpt budget
+    text = " ".join(f"word{i}" for i in range(DOCUMENT_CONTEXT_TOKENS * 2))
+    chunks = chunk_document(text)
+
+    assert len(chunks) > 1
+    assert all(len(chunk['text']) <= CHUNK_TARGET_CHARS for chunk in chunks)
+    assert " ".join(chunk['text'] for chunk in chunks) == text
+
+    # A query with no matching terms falls back to the start of the document
+    selected = select_chunks(BM25Index(chunks), "summarize this")
+    assert selected and selected[0]['id'] == 0
+
+
+def test_long_line_without_spaces_is_cut():
+    text = "x" * (CHUNK_TARGET_CHARS * 3 + 5)
+    chunks = chunk_document(text)
+
+    assert [len(chunk['text']) for chunk in chunks] == [CHUNK_TARGET_CHARS] * 3 + [5]
@@ -0,0 +1,416 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+import urllib.request
+from collections import deque
+from typing import Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+TRACE_BUFFER_SIZE = getattr(config, 'TRACE_BUFFER_SIZE', 200)  # recent traces kept per worker
+MAX_SPANS_PER_TRACE = 256  # further spans are counted as dropped, so a runaway loop can't grow a trace
+TRACE_EXCLUDED_PREFIXES = ('/static/', '/assets/', '/admin/', '/metrics', '/favicon.ico')
+# OTLP/HTTP collector base URL, e.g. http://localhost:4318; unset disables export
+OTLP_ENDPOINT = getattr(config, 'OTLP_ENDPOINT', None) or os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT')
+OTLP_SERVICE_NAME = getattr(config, 'OTLP_SERVICE_NAME', 'longgbot')
+OTLP_EXPORT_INTERVAL = 5.0  # seconds between exports
+OTLP_BATCH_SIZE = 512
+OTLP_MAX_QUEUE = 8192  # finished spans waiting for export; the oldest are dropped beyond this
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+_recent_lock = threading.Lock()
+
+
+class Trace:
+    __slots__ = ('trace_id', 'root', 'spans', 'dropped')
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.root = None
+        self.spans = []
+        self.dropped = 0
+
+    def summary(self) -> dict:
+        root = self.root
+        return {
+            'trace_id': self.trace_id,
+            'name': root.name,
+            'start': root.start_ns / 1e9,
+            'duration_ms': root.duration_ms,
+            'status_code': root.attributes.get('http.status_code'),
+            'error': root.error,
+            'spans': len(self.spans),
+        }
+
+    def to_dict(self) -> dict:
+        data = self.summary()
+        data['dropped_spans'] = self.dropped
+        data['span_list'] = [span.to_dict(self.root.start_ns) for span in sorted(self.spans, key=lambda s: s.start_ns)]
+        return data
+
+
+class Span:
+    """One timed phase of a trace. end_ns is None while the span is open."""
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: dict, start_ns: int = None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+        if len(trace.spans) < MAX_SPANS_PER_TRACE:
+            trace.spans.append(self)
+        else:
+            trace.dropped += 1
+
+    @property
+    def duration_ms(self) -> Optional[float]:
+        return None if self.end_ns is None else (self.end_ns - self.start_ns) / 1e6
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def finish(self, error: Optional[str] = None, end_ns: int = None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = end_ns or time.time_ns()
+        if error:
+            self.error = error
+        if _exporter:
+            _exporter.submit(self)
+
+    def to_dict(self, origin_ns: int) -> dict:
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'offset_ms': (self.start_ns - origin_ns) / 1e6,
+            'duration_ms': self.duration_ms,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class _NoopSpan:
+    """Returned outside a trace, so instrumented code never has to check."""
+    __slots__ = ()
+    span_id = None
+
+    def set(self, key, value):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    current = _current_span.get()
+    return current.trace.trace_id if current else None
+
+
+def annotate(**attributes):
+    """Set attributes on the current span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def start_trace(name: str, traceparent: str = None, **attributes) -> Span:
+    """Start a trace, continuing the caller's W3C traceparent if given, and make its root current."""
+    match = TRACEPARENT.match(traceparent or '')
+    trace = Trace(match.group(1) if match else secrets.token_hex(16))
+    root = Span(trace, name, match.group(2) if match else None, attributes)
+    trace.root = root
+    with _recent_lock:
+        _recent_traces.append(trace)
+    _current_span.set(root)
+    return root
+
+
+def end_trace(root: Span, error: Optional[str] = None):
+    root.finish(error)
+    _current_span.set(None)
+
+
+def span(name: str, **attributes):
+    """
+    Time a phase as a child of the current span: `with tracing.span('name', key=value) as s:`.
+
+    A no-op outside a trace. Works across yields in generators, which only ever resume
+    in the thread or task that started them.
+    """
+    return _SpanContext(name, attributes)
+
+
+class _SpanContext:
+    __slots__ = ('name', 'attributes', '_span', '_parent')
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self._parent = _current_span.get()
+        if self._parent is None:
+            self._span = None
+            return NOOP_SPAN
+        self._span = Span(self._parent.trace, self.name, self._parent.span_id, self.attributes)
+        _current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is not None:
+            self._span.finish(f"{exc_type.__name__}: {exc}" if exc_type and issubclass(exc_type, Exception) else None)
+            _current_span.set(self._parent)
+        return False
+
+
+def traced(name: str):
+    """Decorator wrapping each call of a function or coroutine function in a span."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(name: str, start_ns: int, end_ns: int = None, **attributes):
+    """Add an already finished child span, for phases measured without a `with` block."""
+    parent = _current_span.get()
+    if parent is not None:
+        Span(parent.trace, name, parent.span_id, attributes, start_ns).finish(end_ns=end_ns)
+
+
+def bind(coro):
+    """
+    Run `coro` on the background loop as part of the calling thread's trace.
+
+    Tasks created with run_coroutine_threadsafe start from the loop thread's context,
+    not the caller's, so the current span is carried over explicitly; the time spent
+    waiting for the loop to pick the coroutine up is recorded as 'loop.wait'.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return coro
+    submitted_ns = time.time_ns()
+
+    async def traced_coro():
+        _current_span.set(parent)
+        record('loop.wait', submitted_ns)
+        return await coro
+    wrapped = traced_coro()
+    # Keep the wrapped coroutine's name for the loop's per-coroutine accounting
+    wrapped.__qualname__ = getattr(coro, '__qualname__', wrapped.__qualname__)
+    return wrapped
+
+
+def recent_traces() -> list:
+    with _recent_lock:
+        traces = list(_recent_traces)
+    traces.reverse()
+    return traces
+
+
+def get_trace(trace_id: str) -> Optional[Trace]:
+    with _recent_lock:
+        for trace in _recent_traces:
+            if trace.trace_id == trace_id:
+                return trace
+    return None
+
+
+class TracingMiddleware:
+    """WSGI middleware giving every request a trace that lasts until its response is closed."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(TRACE_EXCLUDED_PREFIXES):
+            return self.wsgi_app(environ, start_response)
+
+        root = start_trace(f"{environ.get('REQUEST_METHOD')} {path}", environ.get('HTTP_TRACEPARENT'),
+                           **{'http.method': environ.get('REQUEST_METHOD'), 'http.target': path})
+
+        def traced_start_response(status, headers, exc_info=None):
+            code = int(status.split(' ', 1)[0])
+            root.set('http.status_code', code)
+            if code >= 500:
+                root.error = status
+            return start_response(status, headers + [('X-Trace-Id', root.trace.trace_id)], exc_info)
+
+        try:
+            iterable = self.wsgi_app(environ, traced_start_response)
+        except Exception as e:
+            end_trace(root, f"{type(e).__name__}: {e}")
+            raise
+        # Streamed bodies are produced while the server iterates, after this returns
+        return _TracedBody(iterable, root)
+
+
+class _TracedBody:
+    __slots__ = ('_iterable', '_root')
+
+    def __init__(self, iterable, root):
+        self._iterable = iterable
+        self._root = root
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            end_trace(self._root)
+
+
+def init_app(app):
+    """Trace requests to `app`, naming each trace after its route rather than its URL."""
+    app.wsgi_app = TracingMiddleware(app.wsgi_app)
+
+    from flask import request
+
+    @app.before_request
+    def name_trace():
+        root = _current_span.get()
+        if root is not None and root is root.trace.root and request.url_rule is not None:
+            root.name = f"{request.method} {request.url_rule.rule}"
+            root.set('flask.endpoint', request.endpoint)
+
+
+class OtlpExporter:
+    """Batches finished spans and posts them as OTLP/HTTP JSON from a daemon thread."""
+
+    def __init__(self, endpoint: str, service_name: str):
+        endpoint = endpoint.rstrip('/')
+        self.url = endpoint if endpoint.endswith('/v1/traces') else f"{endpoint}/v1/traces"
+        self.service_name = service_name
+        self._queue = deque(maxlen=OTLP_MAX_QUEUE)
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._last_error_log = 0.0
+
+    def _ensure_thread(self):
+        """One export thread per process (forked workers start their own)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='otlp-export', daemon=True).start()
+
+    def submit(self, span: Span):
+        self._ensure_thread()
+        self._queue.append(span)
+        if len(self._queue) >= OTLP_BATCH_SIZE:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(OTLP_EXPORT_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        while self._queue:
+            batch = []
+            while self._queue and len(batch) < OTLP_BATCH_SIZE:
+                batch.append(self._queue.popleft())
+            try:
+                self._post(batch)
+            except Exception as e:
+                # A missing collector shouldn't flood the log; spans are dropped either way
+                if time.monotonic() - self._last_error_log > 60:
+                    self._last_error_log = time.monotonic()
+                    logger.warning(f"OTLP export to {self.url} failed: {e}")
+                return
+
+    def _post(self, spans: list):
+        body = json.dumps({
+            'resourceSpans': [{
+                'resource': {'attributes': _otlp_attributes({
+                    'service.name': self.service_name,
+                    'process.pid': os.getpid(),
+                })},
+                'scopeSpans': [{
+                    'scope': {'name': 'longgbot.tracing'},
+                    'spans': [_otlp_span(s) for s in spans],
+                }],
+            }],
+        }).encode('utf-8')
+        req = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=5) as response:
+            response.read()
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def _otlp_span(span: Span) -> dict:
+    data = {
+        'traceId': span.trace.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': 2 if span is span.trace.root else 1,  # SERVER / INTERNAL
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns),
+        'attributes': _otlp_attributes(span.attributes),
+        'status': {'code': 2, 'message': span.error} if span.error else {'code': 0},
+    }
+    if span.parent_id:
+        data['parentSpanId'] = span.parent_id
+    return data
+
+
+def flush():
+    """Export pending spans now (server shutdown)."""
+    if _exporter:
+        _exporter.flush()
+
+
+_exporter = OtlpExporter(OTLP_ENDPOINT, OTLP_SERVICE_NAME) if OTLP_ENDPOINT else None
@@ -0,0 +1,224 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+USAGE_DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usage.db')
+FLUSH_INTERVAL = 5  # seconds between flushes of local counters to the shared store
+
+# Token budgets per tier: (tokens per minute, tokens per day)
+TOKEN_QUOTAS = {
+    'premium': (200000, 3000000),
+    'free': (40000, 300000),
+}
+
+
+class QuotaResult(NamedTuple):
+    allowed: bool
+    minute_remaining: int
+    day_remaining: int
+    retry_after: float
+
+
+class TokenQuota:
+    """
+    Per-user token accounting with per-minute and per-day budgets.
+
+    Usage is recorded in memory and flushed every FLUSH_INTERVAL seconds to a SQLite
+    table shared by all workers on the host; each flush also refreshes this worker's
+    view of the totals, so enforcement is exact within a worker and eventually
+    consistent across workers.
+    """
+
+    def __init__(self, quotas: dict = None, db_path: str = USAGE_DB_FILE, flush_interval: float = FLUSH_INTERVAL):
+        self.quotas = quotas or TOKEN_QUOTAS
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._totals = {}   # key -> [minute_start, minute_tokens, day, day_tokens] (shared view + local)
+        self._pending = {}  # key -> [minute_start, minute_tokens, day, day_tokens] (not yet flushed)
+        self._last_flush = time.time()
+        self._local = threading.local()
+        self._use_sqlite = self._init_db()
+
+    def _init_db(self) -> bool:
+        try:
+            conn = self._connection()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_usage ("
+                "key TEXT PRIMARY KEY, minute_start INTEGER NOT NULL, minute_tokens INTEGER NOT NULL, "
+                "day INTEGER NOT NULL, day_tokens INTEGER NOT NULL)"
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Usage database unavailable, token quotas are per-process: {e}")
+            return False
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=1.0, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _periods(now):
+        return int(now // 60) * 60, int(now // 86400)
+
+    @staticmethod
+    def _roll(entry, minute_start, day):
+        """Reset counters in `entry` that belong to an earlier minute/day."""
+        if entry[0] != minute_start:
+            entry[0], entry[1] = minute_start, 0
+        if entry[2] != day:
+            entry[2], entry[3] = day, 0
+        return entry
+
+    def check(self, key: str, tier: str, tokens: int) -> QuotaResult:
+        """Check whether `tokens` more tokens fit in the user's budget (does not record them)."""
+        now = time.time()
+        self._maybe_flush(now)
+        per_minute, per_day = self.quotas.get(tier, self.quotas['free'])
+        minute_start, day = self._periods(now)
+        with self._lock:
+            entry = self._roll(self._totals.setdefault(key, [minute_start, 0, day, 0]), minute_start, day)
+            minute_used, day_used = entry[1], entry[3]
+
+        minute_remaining = max(0, per_minute - minute_used)
+        day_remaining = max(0, per_day - day_used)
+        if day_used + tokens > per_day:
+            return QuotaResult(False, minute_remaining, day_remaining, (day + 1) * 86400 - now)
+        # A single request larger than the whole minute budget is allowed into an empty minute
+        if minute_used + tokens > per_minute and minute_used > 0:
+            return QuotaResult(False, minute_remaining, day_remaining, minute_start + 60 - now)
+        return QuotaResult(True, minute_remaining, day_remaining, 0.0)
+
+    def record(self, key: str, tokens: int):
+        if not key or tokens <= 0:
+            return
+        self._add(key, tokens)
+
+    def refund(self, key: str, tokens: int):
+        """Give back tokens charged for a request that never reached upstream."""
+        if not key or tokens <= 0:
+            return
+        self._add(key, -tokens)
+
+    def _add(self, key: str, tokens: int):
+        now = time.time()
+        minute_start, day = self._periods(now)
+        with self._lock:
+            for store in (self._totals, self._pending):
+                entry = self._roll(store.setdefault(key, [minute_start, 0, day, 0]), minute_start, day)
+                entry[1] += tokens
+                entry[3] += tokens
+            # Pending deltas may go negative with a refund; totals may not
+            totals = self._totals[key]
+            totals[1], totals[3] = max(0, totals[1]), max(0, totals[3])
+        self._maybe_flush(now)
+
+    def _maybe_flush(self, now):
+        if now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Error flushing token usage: {e}")
+
+    def flush(self):
+        now = time.time()
+        minute_start, day = self._periods(now)
+        with self._lock:
+            # Evict users idle since before today
+            for key in [k for k, v in self._totals.items() if v[2] != day]:
+                del self._totals[key]
+            keys = list(self._totals.keys())
+            if not self._use_sqlite:
+                # Nothing shared to flush to: the local totals are the whole view
+                self._pending = {}
+                return
+            if not self._pending and not keys:
+                return
+            pending, self._pending = self._pending, {}
+
+        try:
+            self._write_pending(pending, day)
+        except Exception:
+            # SQLite busy past its timeout is normal under load: keep the usage for the next flush
+            self._requeue(pending)
+            raise
+
+        if not keys:
+            return
+        # Refresh the local view with what every worker has flushed
+        placeholders = ",".join("?" for _ in keys)
+        rows = self._connection().execute(
+            f"SELECT key, minute_start, minute_tokens, day, day_tokens FROM token_usage WHERE key IN ({placeholders})",
+            keys
+        ).fetchall()
+        with self._lock:
+            for key, *entry in rows:
+                entry = self._roll(entry, minute_start, day)
+                unflushed = self._roll(self._pending.get(key, [minute_start, 0, day, 0]), minute_start, day)
+                self._totals[key] = [minute_start, max(0, entry[1] + unflushed[1]), day, max(0, entry[3] + unflushed[3])]
+
+    def _write_pending(self, pending, day):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, (p_minute, p_minute_tokens, p_day, p_day_tokens) in pending.items():
+                row = conn.execute(
+                    "SELECT minute_start, minute_tokens, day, day_tokens FROM token_usage WHERE key = ?", (key,)
+                ).fetchone()
+                entry = self._roll(list(row) if row else [p_minute, 0, p_day, 0], p_minute, p_day)
+                entry[1] = max(0, entry[1] + p_minute_tokens)
+                entry[3] = max(0, entry[3] + p_day_tokens)
+                conn.execute(
+                    "INSERT OR REPLACE INTO token_usage (key, minute_start, minute_tokens, day, day_tokens) VALUES (?, ?, ?, ?, ?)",
+                    (key, *entry)
+                )
+            conn.execute("DELETE FROM token_usage WHERE day < ?", (day,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _requeue(self, pending):
+        """Merge deltas that failed to flush into the pending entries recorded since."""
+        minute_start, day = self._periods(time.time())
+        with self._lock:
+            for key, failed in pending.items():
+                # Counters of a minute/day that has passed no longer count towards any budget
+                failed = self._roll(list(failed), minute_start, day)
+                entry = self._roll(self._pending.setdefault(key, [minute_start, 0, day, 0]), minute_start, day)
+                entry[1] += failed[1]
+                entry[3] += failed[3]
+
+
+token_quota = TokenQuota()
+
+
+def check_token_quota(user_key: str, premium: bool, prompt_tokens: int) -> QuotaResult:
+    return token_quota.check(user_key, 'premium' if premium else 'free', prompt_tokens)
+
+
+def record_token_usage(user_key: str, tokens: int):
+    token_quota.record(user_key, tokens)
+
+
+def refund_token_usage(user_key: str, tokens: int):
+    token_quota.refund(user_key, tokens)
+
+
+def quota_exceeded_message(result: QuotaResult) -> str:
+    if result.retry_after > 60:
+        return 'Daily token quota exceeded. Please try again tomorrow.'
+    return f'Token quota exceeded. Please wait {math.ceil(result.retry_after)} seconds.'